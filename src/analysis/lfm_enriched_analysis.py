@@ -5,6 +5,9 @@ from tqdm import tqdm
 
 from src import constants
 from src.utils import plot_utils
+from src.utils import listening_event_store
+
+DEBUG = constants.DEBUG
 
 PATH_TO_LFM_ENRICHED = constants.PATH_TO_LFM_ENRICHED
 PATH_TO_LFM_LISTENING_EVENTS = constants.PATH_TO_LFM_LISTENING_EVENTS
@@ -37,6 +40,10 @@ COUNTING_DICT_EMPTY = {
                         FINAL_UNKN: 0
                        }
 
+# order of the major columns in the per user counts
+MAJORS = [FINAL_UNIV, FINAL_SONY, FINAL_WARN, FINAL_INDI, FINAL_UNKN]
+MAJOR_SUMS = [UNIV_SUM, SONY_SUM, WARN_SUM, INDI_SUM, UNKN_SUM]
+
 SI_THRESHOLDS = [0, 0.7, 0.8, 0.9, 1]
 
 
@@ -72,62 +79,110 @@ def lfm_enriched_analysis():
 def create_major_counts_per_user(output_path=OUTPUT_MAJOR_COUNTS, occ_threshold=3, remove_duplicates=True):
     print('Reading label map for LFM-2b from', PATH_TO_LFM_ENRICHED)
     df_label_map = pd.read_csv(PATH_TO_LFM_ENRICHED, sep='\t')[[TRACK_ID, RECORD_LABEL_MAJOR]]
-    track_id_set = set(df_label_map[TRACK_ID].unique())
-    record_label_major_dict = pd.Series(df_label_map[RECORD_LABEL_MAJOR].values, index=df_label_map[TRACK_ID]).to_dict()
-    track_occurrences = []
+    track_majors = create_track_major_codes(df_label_map)
 
-    print('Start processing Listening-Event tsv from', PATH_TO_LFM_LISTENING_EVENTS)
     chunksize = 10 ** 6
-    counter = 0
     df_list = []
+    events_per_user = []
+    # users whose row is complete, a user appearing again in a later chunk would be counted twice
+    finished_users = np.zeros(0, dtype=bool)
+    carry_over = None
+
+    for counter, chunk in enumerate(read_listening_events(chunksize)):
+        if DEBUG: print('chunk #', counter)
+        chunk = chunk[[USER_ID, TRACK_ID]]
+        if carry_over is not None:
+            chunk = pd.concat([carry_over, chunk], ignore_index=True)
+        # the events of the last user of a tsv chunk may continue in the next chunk, they are counted with it
+        last_user = chunk[USER_ID].values[-1]
+        is_last_user = chunk[USER_ID].values == last_user
+        carry_over = chunk[is_last_user]
+        chunk = chunk[~is_last_user]
+        if len(chunk) == 0:
+            continue
+
+        df_chunk, chunk_events_per_user = count_majors_per_user(chunk, track_majors, occ_threshold, remove_duplicates)
+        finished_users = mark_finished_users(finished_users, df_chunk[USER_ID].values)
+        df_list.append(df_chunk)
+        events_per_user.append(chunk_events_per_user)
 
-    for chunk in pd.read_csv(PATH_TO_LFM_LISTENING_EVENTS, sep='\t', chunksize=chunksize):
-        print('chunk #', counter)
-
-        curr_data = []
-        chunk_reduced = chunk[[USER_ID, TRACK_ID]]
-        chunk_grouped = chunk_reduced.groupby(USER_ID)
-        for user in tqdm(chunk_grouped.groups.keys(), total=len(chunk_grouped.groups.keys())):
-            tracks = chunk_grouped.get_group(user)[TRACK_ID]
-            counting_dict = COUNTING_DICT_EMPTY.copy()
-            tracks = tracks.groupby(tracks).filter(lambda x: len(x) >= occ_threshold)
-            if remove_duplicates:
-                tracks = tracks.drop_duplicates()
-
-            for track in tracks:
-                if track in track_id_set:
-                    counting_dict[record_label_major_dict[track]] += 1
-                else:
-                    counting_dict[FINAL_UNKN] += 1
-
-            curr_data.append([
-                user,
-                counting_dict[FINAL_UNIV],
-                counting_dict[FINAL_SONY],
-                counting_dict[FINAL_WARN],
-                counting_dict[FINAL_INDI],
-                counting_dict[FINAL_UNKN],
-                len(tracks)
-            ])
-
-        df_list.append(pd.DataFrame(curr_data, columns=[USER_ID, UNIV_SUM, SONY_SUM, WARN_SUM, INDI_SUM, UNKN_SUM, COMB_SUM]))
-
-        counter += 1
-
-    track_occurrences = np.array(track_occurrences)
-    print(f'Avg. number of track occurrences per user: {np.mean(track_occurrences):,}')
-    print(f'Median number of track occurrences per user: {np.median(track_occurrences):,}')
-
-    print('Completed read of Listening Events tsv')
-    print('Concat single dataframes')
-    df_final = pd.concat(df_list)
-
-    print('Combine duplicate user_ids')
-    df_final = df_final.groupby([USER_ID]).aggregate(np.sum).reset_index()
+    if carry_over is not None and len(carry_over) > 0:
+        df_chunk, chunk_events_per_user = count_majors_per_user(carry_over, track_majors, occ_threshold, remove_duplicates)
+        finished_users = mark_finished_users(finished_users, df_chunk[USER_ID].values)
+        df_list.append(df_chunk)
+        events_per_user.append(chunk_events_per_user)
 
+    events_per_user = np.concatenate(events_per_user)
+    print(f'Avg. number of listening events per user: {np.mean(events_per_user):,}')
+    print(f'Median number of listening events per user: {np.median(events_per_user):,}')
+
+    print('Completed read of Listening Events')
+    df_final = pd.concat(df_list).sort_values([USER_ID]).reset_index(drop=True)
     df_final.to_csv(output_path, index=False)
 
 
+def create_track_major_codes(df_label_map):
+    # array: track_id -> position of its major in MAJOR_SUMS, tracks without (known) major are FINAL_UNKN
+    track_majors = np.full(df_label_map[TRACK_ID].max() + 1, MAJORS.index(FINAL_UNKN), dtype=np.int8)
+    major_codes = df_label_map[RECORD_LABEL_MAJOR].map({major: code for code, major in enumerate(MAJORS)})
+    known = major_codes.notna().values
+    track_majors[df_label_map[TRACK_ID].values[known]] = major_codes.values[known].astype(np.int8)
+    return track_majors
+
+
+'''
+Major counts of all users of the chunk, which has to contain all events of these users. Tracks a user listened to less
+than occ_threshold times are left out, with remove_duplicates every track of a user is counted once, else with its
+number of listening events. Returns the rows (one per user) and the number of listening events per user.
+'''
+def count_majors_per_user(chunk, track_majors, occ_threshold, remove_duplicates):
+    users = chunk[USER_ID].values.astype(np.int64)
+    tracks = chunk[TRACK_ID].values.astype(np.int64)
+
+    # listening events per (user, track)
+    track_factor = max(int(tracks.max()) + 1, len(track_majors))
+    pair_keys, pair_counts = np.unique(users * track_factor + tracks, return_counts=True)
+    kept = pair_counts >= occ_threshold
+    pair_keys, pair_counts = pair_keys[kept], pair_counts[kept]
+    pair_users, pair_tracks = np.divmod(pair_keys, track_factor)
+
+    unknown = MAJORS.index(FINAL_UNKN)
+    pair_majors = np.full(len(pair_tracks), unknown, dtype=np.int64)
+    labeled = pair_tracks < len(track_majors)
+    pair_majors[labeled] = track_majors[pair_tracks[labeled]]
+
+    # users without a track above the threshold get a row of zeros
+    chunk_users, events_per_user = np.unique(users, return_counts=True)
+    user_positions = np.searchsorted(chunk_users, pair_users)
+    counts = np.bincount(user_positions * len(MAJORS) + pair_majors,
+                         weights=None if remove_duplicates else pair_counts,
+                         minlength=len(chunk_users) * len(MAJORS)).astype(np.int64).reshape(len(chunk_users), len(MAJORS))
+
+    df_chunk = pd.DataFrame(counts, columns=MAJOR_SUMS)
+    df_chunk.insert(0, USER_ID, chunk_users)
+    df_chunk[COMB_SUM] = counts.sum(axis=1)
+    return df_chunk, events_per_user
+
+
+def mark_finished_users(finished_users, users):
+    if len(users) > 0 and users.max() >= len(finished_users):
+        finished_users = np.concatenate([finished_users, np.zeros(users.max() + 1 - len(finished_users), dtype=bool)])
+    if finished_users[users].any():
+        raise ValueError('Listening events are not grouped by user, convert them with utils/listening_event_store.py')
+    finished_users[users] = True
+    return finished_users
+
+
+def read_listening_events(chunksize):
+    # chunks of the memory-mapped listening events if they exist (see utils/listening_event_store.py), else of the tsv
+    store = listening_event_store.open_store()
+    if store is not None:
+        print('Start processing Listening-Events from', store.store_path)
+        return store.iter_chunks([USER_ID, TRACK_ID], chunksize)
+    print('Start processing Listening-Event tsv from', PATH_TO_LFM_LISTENING_EVENTS)
+    return pd.read_csv(PATH_TO_LFM_LISTENING_EVENTS, sep='\t', chunksize=chunksize)
+
+
 def lfm_SI_analysis(major_count_input=OUTPUT_MAJOR_COUNTS, combine_indi_unkn=False, occ_threshold=3, length_threshold=60):
     df = pd.read_csv(major_count_input)
 
@@ -20,6 +20,9 @@ import datetime
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 
+from src.utils import mpd_table_cache
+from src.utils import slice_source
+
 
 total_playlists = 0
 total_tracks = 0
@@ -41,18 +44,20 @@ num_followers_histogram = collections.Counter()
 
 quick = False
 max_files_for_quick_processing = 5
+# read the parquet tables of the MPD (see utils/mpd_table_cache.py) instead of the json slices if they exist
+use_table_cache = True
 
 
 def process_mpd(path):
+    if use_table_cache and mpd_table_cache.exists():
+        process_mpd_tables()
+        show_summary()
+        return
+
     count = 0
-    filenames = sorted(os.listdir(path))
-    for filename in tqdm(filenames, total=len(filenames)):
+    # path: directory of the slices or an archive (see utils/slice_source.py)
+    for filename, mpd_slice in tqdm(slice_source.open_source(path).iter_slices()):
         if filename.startswith("mpd.slice.") and filename.endswith(".json"):
-            fullpath = os.sep.join((path, filename))
-            f = open(fullpath)
-            js = f.read()
-            f.close()
-            mpd_slice = json.loads(js)
             process_info(mpd_slice["info"])
             for playlist in mpd_slice["playlists"]:
                 process_playlist(playlist)
@@ -64,6 +69,53 @@ def process_mpd(path):
     show_summary()
 
 
+def process_mpd_tables():
+    global total_playlists, total_tracks, total_descriptions
+
+    slice_infos = mpd_table_cache.get_slice_infos()
+    slice_names = sorted(slice_infos.keys())
+    if quick:
+        slice_names = slice_names[:max_files_for_quick_processing + 1]
+
+    # one slice at a time, only the columns used by the stats are read
+    for slice_name in tqdm(slice_names, total=len(slice_names)):
+        process_info(slice_infos[slice_name])
+
+        playlists = mpd_table_cache.read_playlists(slice_names=[slice_name])
+        total_playlists += len(playlists)
+        n_tracks.extend(playlists["num_tracks"].tolist())
+        if "description" in playlists.columns:
+            total_descriptions += playlists["description"].notna().sum()
+
+        titles.update(playlists["name"])
+        nnames = playlists["name"].map(normalize_name)
+        ntitles.update(nnames)
+        update_histogram(title_histogram, nnames)
+
+        update_histogram(playlist_length_histogram, playlists["num_tracks"])
+        update_histogram(last_modified_histogram, playlists["modified_at"])
+        update_histogram(num_edits_histogram, playlists["num_edits"])
+        update_histogram(num_followers_histogram, playlists["num_followers"])
+
+        slice_tracks = mpd_table_cache.read_tracks(["album_uri", "track_uri", "artist_uri", "track_name", "artist_name",
+                                                    "album_name"], slice_names=[slice_name])
+        total_tracks += len(slice_tracks)
+        albums.update(slice_tracks["album_uri"].unique())
+        tracks.update(slice_tracks["track_uri"].unique())
+        artists.update(slice_tracks["artist_uri"].unique())
+
+        update_histogram(artist_histogram, slice_tracks["artist_name"])
+        update_histogram(album_histogram, slice_tracks["album_name"])
+        full_name_counts = slice_tracks.groupby(["track_name", "artist_name"], observed=True).size()
+        for (track_name, artist_name), count in full_name_counts.items():
+            track_histogram[track_name + " by " + artist_name] += count
+
+
+def update_histogram(histogram, values):
+    counts = values.value_counts()
+    histogram.update(counts[counts > 0].to_dict())
+
+
 def show_summary():
     print()
     print("number of playlists", total_playlists)
@@ -6,6 +6,7 @@ import pandas as pd
 
 from src import constants
 from src.utils import plot_utils
+from src.utils import slice_source
 
 DEBUG = constants.DEBUG
 
@@ -41,33 +42,31 @@ SI_THRESHOLDS = [0, 0.7, 0.8, 0.9, 1]
 
 
 def create_simpson_index_file():
-    all_slices = os.listdir(PATH_TO_SLICES_ENRICHED)
+    source = slice_source.open_source(PATH_TO_SLICES_ENRICHED)
 
     count = 0
 
     df_list = []
 
-    for filename in tqdm(all_slices, total=len(all_slices)):
+    for filename, single_slice in tqdm(source.iter_slices()):
         count += 1
         curr_data = []
         if filename.startswith('mpd.slice') and filename.endswith('.json'):
-            with open(PATH_TO_SLICES_ENRICHED + filename, 'r') as read_file:
-                single_slice = json.load(read_file)
-                for playlist in single_slice['playlists']:
-                    counting_dict = COUNTING_DICT_EMPTY.copy()
-                    for track in playlist['tracks']:
-                        counting_dict[track[RECORD_LABEL_MAJOR]] += 1
-
-                    curr_data.append([
-                        playlist['pid'],
-                        counting_dict[FINAL_UNIV],
-                        counting_dict[FINAL_SONY],
-                        counting_dict[FINAL_WARN],
-                        counting_dict[FINAL_INDI],
-                        len(playlist['tracks'])
-                    ])
-
-                df_list.append(pd.DataFrame(curr_data, columns=[PID, UNIV_SUM, SONY_SUM, WARN_SUM, INDI_SUM, COMB_SUM]))
+            for playlist in single_slice['playlists']:
+                counting_dict = COUNTING_DICT_EMPTY.copy()
+                for track in playlist['tracks']:
+                    counting_dict[track[RECORD_LABEL_MAJOR]] += 1
+
+                curr_data.append([
+                    playlist['pid'],
+                    counting_dict[FINAL_UNIV],
+                    counting_dict[FINAL_SONY],
+                    counting_dict[FINAL_WARN],
+                    counting_dict[FINAL_INDI],
+                    len(playlist['tracks'])
+                ])
+
+            df_list.append(pd.DataFrame(curr_data, columns=[PID, UNIV_SUM, SONY_SUM, WARN_SUM, INDI_SUM, COMB_SUM]))
 
     df_final = pd.concat(df_list)
 
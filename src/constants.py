@@ -28,6 +28,27 @@ PATH_TO_LFM_LISTENING_EVENTS = os.path.join(dirname, '../data/lfm-2b_original/li
 # Folder for crawler output:
 CRAWLER_OUTPUT_FOLDER = os.path.join(dirname, '../data/generated/')
 
+# source of the MPD slices for all scripts reading them (see utils/slice_source.py): a directory of json slices, the
+# distribution zip (e.g. '../data/spotify_million_playlist_dataset.zip') or a .tar.zst archive
+MPD_SLICE_SOURCE = PATH_TO_SLICES_ORIGINAL
+
+# number of processes which parse the MPD slices (None: one per cpu, 1: no worker processes)
+INPUT_PROCESSES = None
+
+# parquet tables of all MPD slices (see utils/mpd_table_cache.py), used instead of the json slices if they exist
+MPD_TABLE_CACHE_PATH = os.path.join(dirname, '../data/generated/mpd_tables/')
+
+# incremental input list of the MPD: only slices which changed since the last run are parsed (see utils/slice_manifest.py)
+MPD_SLICE_MANIFEST = True
+MPD_SLICE_MANIFEST_PATH = os.path.join(dirname, '../data/generated/mpd_slice_manifest/')
+
+# occurrences of the LFM-2b tracks: number of listening events (True) instead of 1 per track (False)
+LFM_OCC_FROM_LISTENING_EVENTS = False
+# rows of the listening events read at once
+LISTENING_EVENTS_CHUNK_SIZE = 10 ** 7
+# memory-mapped arrays of the listening events (see utils/listening_event_store.py), used instead of the tsv if they exist
+LISTENING_EVENT_STORE_PATH = os.path.join(dirname, '../data/generated/listening_events/')
+
 # ######################################
 # ##### Spotify crawler constants ######
 # ######################################
@@ -37,10 +58,43 @@ LAST_SAVE_INDEX = -1
 SAVING_STEP = 5000
 ALBUM_REQUEST_BULK_SIZE = 20
 
+# async spotify client: if enabled, bulk requests are sent concurrently with max. SPOTIFY_MAX_IN_FLIGHT requests at
+# once, all sharing a token bucket of SPOTIFY_RATE_LIMIT requests per second (bursts up to SPOTIFY_RATE_BURST).
+# Rate limited requests (429) are retried after 'Retry-After' seconds, at most SPOTIFY_MAX_RETRIES times
+SPOTIFY_ASYNC = False
+SPOTIFY_MAX_IN_FLIGHT = 8
+SPOTIFY_RATE_LIMIT = 10
+SPOTIFY_RATE_BURST = 10
+SPOTIFY_MAX_RETRIES = 5
+
+# persistent cache of spotify album and track responses, shared by all datasets (no dataset tag). Cached responses
+# expire after SPOTIFY_CACHE_TTL seconds (None: never). In cache only mode no request is sent to spotify
+SPOTIFY_CACHE = True
+SPOTIFY_CACHE_ONLY = False
+SPOTIFY_CACHE_PATH = os.path.join(dirname, '../data/generated/spotify_response_cache.sqlite')
+SPOTIFY_CACHE_TTL = None
+
+# index of all <track_uri, album_uri> pairs of the MPD slices (see utils/track_album_index.py), shared by all datasets.
+# If it exists, the album crawler takes the albums of all indexed tracks from it instead of requesting them
+TRACK_ALBUM_INDEX = True
+TRACK_ALBUM_INDEX_PATH = os.path.join(dirname, '../data/generated/track_album_index.sqlite')
+
+# budgets of the spotify, discogs and wikipedia crawlers (see utils/crawl_scheduler.py). Rows are looked up by descending
+# occurrences, a crawler stops and saves when CRAWL_COVERAGE_TARGET of all occurrences are resolved, after
+# CRAWL_MAX_SECONDS or after CRAWL_MAX_REQUESTS requests (None: no limit). The coverage is reported every
+# CRAWL_REPORT_EVERY_S seconds
+CRAWL_COVERAGE_TARGET = None
+CRAWL_MAX_SECONDS = None
+CRAWL_MAX_REQUESTS = None
+CRAWL_REPORT_EVERY_S = 60
+
 # Flags for failed lookups
 BULK_FAILED_FLAG = 'Error: Bulk lookup failed (404)'
 FAILED_LOOKUP_FLAG = 'Error: Lookup failed (404)'
 
+# spotify ids are 22 characters in base62, uris not matching 'spotify:<type>:<id>' are not sent to the api
+SPOTIFY_ID_PATTERN = r'[0-9A-Za-z]{22}'
+
 # columns for spotify crawler
 TRACK_URI = 'track_uri'
 ALBUM_URI = 'album_uri'
@@ -134,6 +188,29 @@ LABEL_MAP_DISCOGS_EXT = os.path.join(dirname, '../data/generated/label_map_disco
 ARCHIVE_DISCOGS_LOOKUP_PATH = os.path.join(dirname, '../data/generated/archive_discogs_lookup' + DATASET_TAG + '.pkl')
 ARCHIVE_DISCOGS_ID_MAP_PATH = os.path.join(dirname, '../data/generated/archive_discogs_id_map' + DATASET_TAG + '.pkl')
 
+# monthly labels dump of discogs (https://data.discogs.com/) and the SQLite file it is ingested to (see
+# label_crawler/discogs_dump.py). With DISCOGS_OFFLINE the discogs crawler resolves all labels from this file instead of
+# sending requests
+DISCOGS_DUMP_PATH = os.path.join(dirname, '../data/discogs/discogs_labels.xml.gz')
+DISCOGS_DUMP_DB_PATH = os.path.join(dirname, '../data/generated/discogs_labels.sqlite')
+DISCOGS_OFFLINE = False
+
+# discogs api: DISCOGS_MAX_IN_FLIGHT workers look up labels at the same time (1: one after another), all sharing the rate
+# limit of DISCOGS_RATE_LIMIT requests per minute, which is updated from the response headers. Rate limited requests
+# (429) are retried at most DISCOGS_MAX_RETRIES times
+DISCOGS_MAX_IN_FLIGHT = 1
+DISCOGS_RATE_LIMIT = 60
+DISCOGS_MAX_RETRIES = 5
+# labels are fetched as raw json with one GET /labels/{id} per label
+DISCOGS_API_URL = 'https://api.discogs.com'
+DISCOGS_REQUEST_TIMEOUT_S = 30
+
+# sublabel closure of the major labels (see label_crawler/discogs_major_closure.py) and the sublabels of the visited
+# labels, which are read again after DISCOGS_CLOSURE_TTL_S
+ARCHIVE_DISCOGS_MAJOR_CLOSURE_PATH = os.path.join(dirname, '../data/generated/archive_discogs_major_closure.pkl')
+ARCHIVE_DISCOGS_SUBLABEL_NODES_PATH = os.path.join(dirname, '../data/generated/archive_discogs_sublabel_nodes.pkl')
+DISCOGS_CLOSURE_TTL_S = 30 * 24 * 60 * 60
+
 
 # ##### Wikipedia label crawler ######
 
@@ -164,6 +241,20 @@ LABEL_MAP_WIKIPEDIA_EXT = os.path.join(dirname, '../data/generated/label_map_wik
 ARCHIVE_WIKIPEDIA_LOOKUP_PATH = os.path.join(dirname, '../data/generated/archive_wiki_lookup' + DATASET_TAG + '.pkl')
 ARCHIVE_WIKIPEDIA_URL_MAP_PATH = os.path.join(dirname, '../data/generated/archive_wiki_url_map' + DATASET_TAG + '.pkl')
 
+# read the pages of the english wikipedia as wikitext from the action api (up to 50 pages per request, see
+# label_crawler/wikipedia_api.py) instead of the rendered html. The keyword counts are then counted in the wikitext
+WIKI_USE_API = False
+WIKIPEDIA_API_URL = 'https://en.wikipedia.org/w/api.php'
+WIKIPEDIA_USER_AGENT = 'MT_label_crawler (https://github.com/nostromo7/MT_label_crawler)'
+WIKIPEDIA_REQUEST_TIMEOUT_S = 30
+
+# articles dump of the english wikipedia (https://dumps.wikimedia.org/enwiki/) or a subset of it in the same format and
+# the SQLite file it is ingested to (see label_crawler/wikipedia_dump.py). With WIKI_OFFLINE the wikipedia crawler reads
+# pages and searches labels in this file instead of sending requests
+WIKIPEDIA_DUMP_PATH = os.path.join(dirname, '../data/wikipedia/enwiki-latest-pages-articles.xml.bz2')
+WIKIPEDIA_DUMP_DB_PATH = os.path.join(dirname, '../data/generated/wikipedia_pages.sqlite')
+WIKI_OFFLINE = False
+
 
 # ##### Interim mapping ######
 
@@ -2,23 +2,47 @@ import sys
 import os
 import pandas as pd
 import numpy as np
+from tqdm import tqdm
 
 from src import constants
+from src.utils import listening_event_store
+
+""" LFM-2b crawler preprocessing
+
+Creates the list of track_uris of the LFM-2b dataset. The occurrences of a track are either 1 or, with
+LFM_OCC_FROM_LISTENING_EVENTS, its number of listening events, so the crawlers look up the most played tracks first.
+The listening events (~2B rows) are read in chunks of track_ids only and counted with numpy.bincount, the memory used
+depends on the highest track_id, not on the number of events. If the memory-mapped listening events exist (see
+utils/listening_event_store.py), they are counted instead of parsing the tsv.
+"""
 
 # get constants
+DEBUG = constants.DEBUG
+
 TRACK_URI = constants.TRACK_URI
 OCC = constants.OCC
+TRACK_ID = 'track_id'
 
 INPUT_PATH = constants.PATH_TO_LFM_ORIGINAL
+PATH_TO_LFM_LISTENING_EVENTS = constants.PATH_TO_LFM_LISTENING_EVENTS
 OUTPUT_PATH = constants.INPUT_TRACK_URIS
 CRAWLER_OUTPUT_FOLDER = constants.CRAWLER_OUTPUT_FOLDER
 
+LFM_OCC_FROM_LISTENING_EVENTS = constants.LFM_OCC_FROM_LISTENING_EVENTS
+LISTENING_EVENTS_CHUNK_SIZE = constants.LISTENING_EVENTS_CHUNK_SIZE
+
 
-def create_track_uri_list(output_path=OUTPUT_PATH):
+def create_track_uri_list(output_path=OUTPUT_PATH, occ_from_listening_events=LFM_OCC_FROM_LISTENING_EVENTS):
 
     print('Create new list of track_uris from: ', INPUT_PATH)
-    track_uri_df = pd.read_csv(INPUT_PATH, sep='\t').drop(['track_id'], axis=1)
-    track_uri_df[OCC] = 1
+    track_uri_df = pd.read_csv(INPUT_PATH, sep='\t')
+    if occ_from_listening_events:
+        # tracks without listening events have 0 occurrences
+        play_counts = count_listening_events(minlength=track_uri_df[TRACK_ID].max() + 1)
+        track_uri_df[OCC] = play_counts[track_uri_df[TRACK_ID].values]
+    else:
+        track_uri_df[OCC] = 1
+    track_uri_df = track_uri_df.drop([TRACK_ID], axis=1)
     track_uri_df[TRACK_URI] = 'spotify:track:' + track_uri_df['uri'].astype(str)
     track_uri_df = track_uri_df.drop(['uri'], axis=1)
 
@@ -30,6 +54,26 @@ def create_track_uri_list(output_path=OUTPUT_PATH):
     track_uri_df.to_csv(output_path, index=False)
 
 
+def count_listening_events(path=PATH_TO_LFM_LISTENING_EVENTS, chunksize=LISTENING_EVENTS_CHUNK_SIZE, minlength=0):
+    # returns the number of listening events per track_id (the index of the array), at least minlength track_ids
+    store = listening_event_store.open_store() if path == PATH_TO_LFM_LISTENING_EVENTS else None
+    if store is not None:
+        print('Count listening events per track from', store.store_path)
+        chunks = store.iter_chunks([TRACK_ID], chunksize)
+    else:
+        print('Count listening events per track from', path)
+        chunks = pd.read_csv(path, sep='\t', usecols=[TRACK_ID], dtype={TRACK_ID: np.int64}, chunksize=chunksize)
+
+    play_counts = np.zeros(minlength, dtype=np.int64)
+    for chunk in tqdm(chunks):
+        chunk_counts = np.bincount(chunk[TRACK_ID].values)
+        if len(chunk_counts) > len(play_counts):
+            play_counts = np.concatenate([play_counts, np.zeros(len(chunk_counts) - len(play_counts), dtype=np.int64)])
+        play_counts[:len(chunk_counts)] += chunk_counts
+    if DEBUG: print('Counted', play_counts.sum(), 'listening events of', np.count_nonzero(play_counts), 'tracks')
+    return play_counts
+
+
 def main():
     if not os.path.exists(CRAWLER_OUTPUT_FOLDER):
         os.mkdir(CRAWLER_OUTPUT_FOLDER)
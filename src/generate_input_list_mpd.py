@@ -1,11 +1,15 @@
 import sys
 import os
-import json
+import copy
 import time
 import pandas as pd
+from collections import Counter
 from tqdm import tqdm
 
 from src import constants
+from src.utils import mpd_table_cache
+from src.utils import slice_source
+from src.utils import slice_manifest
 
 """" Spotify crawler preprocessing
 
@@ -14,64 +18,180 @@ Extracts relevant information from original data slices:
     album_name...   name of album, if multiple names per uri exist, concat them
     artist_name...  name of artist, if multiple names exist per uri, concat them
     occurrences...  number of occurrences of uri in original data slices 
+If the parquet tables of the MPD exist (see utils/mpd_table_cache.py), only the needed columns are read from them
+instead of parsing the slices. Otherwise the partial aggregates of the slices are recorded in a manifest (see
+utils/slice_manifest.py) and a rerun only parses the slices which are new or changed since the last run.
 """
 
 # get constants
 DEBUG = constants.DEBUG
 
-PATH_TO_SLICES_ORIGINAL = constants.PATH_TO_SLICES_ORIGINAL
+MPD_SLICE_SOURCE = constants.MPD_SLICE_SOURCE
 CRAWLER_OUTPUT_FOLDER = constants.CRAWLER_OUTPUT_FOLDER
+MPD_TABLE_CACHE_PATH = constants.MPD_TABLE_CACHE_PATH
 
 SORTED_ALBUM_URIS = constants.SORTED_ALBUM_URIS
+INPUT_PROCESSES = constants.INPUT_PROCESSES
+MPD_SLICE_MANIFEST = constants.MPD_SLICE_MANIFEST
 
+# number of slices aggregated by a worker process at once, only one partial aggregate per task is merged
+SLICES_PER_TASK = 8
 
-def generate_sorted_albums_df(playlist_max=None, cols_to_select=['album_uri', 'album_name', 'artist_name']):
-    print('Generate new sorted albums dataframe from MPD slices at', PATH_TO_SLICES_ORIGINAL)
+
+def generate_sorted_albums_df(playlist_max=None, processes=INPUT_PROCESSES):
     start = time.time()
-    df_list = []
-    count = 1
-    all_slices = os.listdir(PATH_TO_SLICES_ORIGINAL)
-    for filename in tqdm(all_slices, total=len(all_slices)):
-        if filename.startswith('mpd.slice') and filename.endswith('.json'):
-            with open(PATH_TO_SLICES_ORIGINAL + filename, 'r') as read_file:
-                tmp = time.time()
-                if DEBUG:
-                    print('Current File: ' + filename + ', ' + str(count) + f'/1000 ({(tmp - start):.2}s)')
-                count += 1
-                playlist_list = []
-                # make list of single playlists of slice
-                for playlist in json.load(read_file)['playlists']:
-                    playlist_df = pd.DataFrame(playlist['tracks'], columns=cols_to_select)
-                    playlist_list.append(playlist_df)
-
-            # concat single playlist dfs and aggregate occurrences
-            file_df = pd.concat(playlist_list, axis=0)
-            file_df['occurrences'] = playlist_df['album_uri']
-            file_df = file_df.groupby(['album_uri']).aggregate({
-                'album_name': lambda d: ', '.join(set(d)),
-                'artist_name': lambda d: ', '.join(set(d)),
-                'occurrences': 'size'
-            }).reset_index()
-            df_list.append(file_df)
-
-        if count == playlist_max:
-            print('reached max number of playlists: ', playlist_max)
-            break
-
-    print('Concatenating single slice dfs...')
-    df = pd.concat(df_list, axis=0)
-    df = df.groupby(['album_uri']).aggregate({
-                        'album_name': lambda d: ', '.join(set(d)),
-                        'artist_name': lambda d: ', '.join(set(d)),
-                        'occurrences': 'sum'
-                    }).reset_index()
-    df = df.sort_values(['occurrences'], ascending=False).reset_index(drop=True)
+    if mpd_table_cache.exists():
+        df = create_albums_df_from_tables(playlist_max)
+    else:
+        df = create_albums_df_from_slices(playlist_max, processes)
+
+    df = df.sort_values(['occurrences', 'album_uri'], ascending=[False, True]).reset_index(drop=True)
     print('Saving...')
     df.to_csv(SORTED_ALBUM_URIS, index=False)
     end = time.time()
     print("Saved generated sorted album_uri df to: " + SORTED_ALBUM_URIS + f', ({(end - start) / 60:.2}m)')
 
 
+def create_albums_df_from_slices(playlist_max=None, processes=INPUT_PROCESSES):
+    print('Generate new sorted albums dataframe from MPD slices at', MPD_SLICE_SOURCE)
+    source = slice_source.open_source(MPD_SLICE_SOURCE)
+    slice_names = None
+    if playlist_max is not None:
+        print('limit to max number of slices: ', playlist_max)
+        slice_names = source.get_slice_names()[:playlist_max]
+
+    if DEBUG: print('Parse slices with', processes if processes is not None else os.cpu_count(), 'processes')
+    if MPD_SLICE_MANIFEST:
+        occurrences, album_names, artist_names = aggregate_with_manifest(source, slice_names, processes)
+    else:
+        occurrences, album_names, artist_names = Counter(), {}, {}
+        for partial in tqdm(slice_source.map_slices(aggregate_slices, source, slice_names, SLICES_PER_TASK, processes)):
+            merge_partial_aggregate((occurrences, album_names, artist_names), partial)
+
+    print('Creating sorted album df...')
+    album_uris = list(occurrences.keys())
+    return pd.DataFrame({
+        'album_uri': album_uris,
+        'album_name': [', '.join(sorted(album_names[album_uri])) for album_uri in album_uris],
+        'artist_name': [', '.join(sorted(artist_names[album_uri])) for album_uri in album_uris],
+        'occurrences': [occurrences[album_uri] for album_uri in album_uris]
+    })
+
+
+def aggregate_with_manifest(source, slice_names=None, processes=INPUT_PROCESSES):
+    manifest = slice_manifest.SliceManifest()
+    aggregate = manifest.aggregate if manifest.aggregate is not None else (Counter(), {}, {})
+    changed, removed, excluded = manifest.get_changes(source, slice_names)
+    print(len(changed), 'new or changed slices,', len(removed), 'removed slices,', len(excluded), 'excluded slices,',
+          len(manifest.entries) - len(removed) - len(excluded) - len(set(changed) & set(manifest.entries.keys())),
+          'unchanged slices')
+
+    # the contributions of the old versions are taken out before the new ones are added
+    for filename in removed + changed:
+        if filename in manifest.entries:
+            subtract_partial_aggregate(aggregate, manifest.load_partial(filename))
+    for filename in removed:
+        manifest.remove(filename)
+
+    if len(changed) > 0:
+        for slice_partials in tqdm(slice_source.map_slices(aggregate_each_slice, source, changed, SLICES_PER_TASK,
+                                                           processes)):
+            for filename, partial in slice_partials:
+                merge_partial_aggregate(aggregate, partial)
+                manifest.put(filename, partial)
+    if manifest.modified:
+        manifest.save(aggregate)
+    if len(excluded) == 0:
+        return aggregate
+
+    # the manifest keeps the aggregate over all recorded slices, the one of this run is built from the smaller side
+    if len(excluded) < len(manifest.entries) - len(excluded):
+        run_aggregate = copy.deepcopy(aggregate)
+        for filename in excluded:
+            subtract_partial_aggregate(run_aggregate, manifest.load_partial(filename))
+    else:
+        run_aggregate = (Counter(), {}, {})
+        excluded_names = set(excluded)
+        for filename in manifest.entries.keys():
+            if filename not in excluded_names:
+                merge_partial_aggregate(run_aggregate, manifest.load_partial(filename))
+    return run_aggregate
+
+
+def create_albums_df_from_tables(playlist_max=None):
+    print('Generate new sorted albums dataframe from MPD tables at', MPD_TABLE_CACHE_PATH)
+    slice_names = mpd_table_cache.get_slice_names()
+    if playlist_max is not None:
+        print('limit to max number of slices: ', playlist_max)
+        slice_names = slice_names[:playlist_max]
+
+    track_df = mpd_table_cache.read_tracks(['album_uri', 'album_name', 'artist_name'], slice_names)
+    occurrences = track_df['album_uri'].value_counts()
+    df = pd.DataFrame({'album_uri': occurrences.index, 'occurrences': occurrences.values})
+    for column in ['album_name', 'artist_name']:
+        # only the unique names of each album are joined
+        names = track_df[['album_uri', column]].drop_duplicates()
+        names = names.astype({column: str}).groupby('album_uri')[column].agg(lambda d: ', '.join(sorted(d)))
+        df[column] = df['album_uri'].map(names)
+    return df[['album_uri', 'album_name', 'artist_name', 'occurrences']]
+
+
+'''
+Partial aggregate of the given slices, runs in a worker process: album_uri -> occurrences (Counter) and album_uri -> set
+of album names / artist names (dicts). Only plain python objects are built, they are cheap to send to the parent.
+'''
+def aggregate_slices(slices):
+    occurrences = Counter()
+    album_names = {}
+    artist_names = {}
+    for _, mpd_slice in slices:
+        for playlist in mpd_slice['playlists']:
+            for track in playlist['tracks']:
+                album_uri = track['album_uri']
+                occurrences[album_uri] += 1
+                album_names.setdefault(album_uri, set()).add(track['album_name'])
+                artist_names.setdefault(album_uri, set()).add(track['artist_name'])
+    return occurrences, album_names, artist_names
+
+
+def aggregate_each_slice(slices):
+    # one partial aggregate per slice, for the manifest
+    return [(filename, aggregate_slices([(filename, mpd_slice)])) for filename, mpd_slice in slices]
+
+
+'''
+The names of an album are counted per partial aggregate they appear in, so the partial aggregate of a slice can be
+taken out again (subtract_partial_aggregate) without losing names which also appear in other slices.
+'''
+def merge_partial_aggregate(aggregate, partial):
+    occurrences, album_names, artist_names = aggregate
+    partial_occurrences, partial_album_names, partial_artist_names = partial
+    occurrences.update(partial_occurrences)
+    for album_uri, names in partial_album_names.items():
+        album_names.setdefault(album_uri, Counter()).update(names)
+    for album_uri, names in partial_artist_names.items():
+        artist_names.setdefault(album_uri, Counter()).update(names)
+
+
+def subtract_partial_aggregate(aggregate, partial):
+    occurrences, album_names, artist_names = aggregate
+    partial_occurrences, partial_album_names, partial_artist_names = partial
+    occurrences.subtract(partial_occurrences)
+    for album_uri in partial_occurrences.keys():
+        if occurrences[album_uri] <= 0:
+            del occurrences[album_uri]
+    for names_per_album, partial_names_per_album in [(album_names, partial_album_names),
+                                                      (artist_names, partial_artist_names)]:
+        for album_uri, names in partial_names_per_album.items():
+            album_name_counts = names_per_album[album_uri]
+            album_name_counts.subtract(names)
+            for name in names:
+                if album_name_counts[name] <= 0:
+                    del album_name_counts[name]
+            if len(album_name_counts) == 0:
+                del names_per_album[album_uri]
+
+
 def main():
     if not os.path.exists(CRAWLER_OUTPUT_FOLDER):
         os.mkdir(CRAWLER_OUTPUT_FOLDER)
@@ -5,7 +5,9 @@ import time
 import pandas as pd
 from tqdm import tqdm
 
-import constants
+from src import constants
+from src.utils import mpd_table_cache
+from src.utils import slice_source
 
 '''
 This script is mapping low-level record labels and the final major label classification back into the MPD dataset. 
@@ -13,7 +15,7 @@ This script is mapping low-level record labels and the final major label classif
 
 DEBUG = constants.DEBUG
 
-PATH_TO_SLICES_ORIGINAL = constants.PATH_TO_SLICES_ORIGINAL
+MPD_SLICE_SOURCE = constants.MPD_SLICE_SOURCE
 PATH_TO_SLICES_ENRICHED = constants.PATH_TO_SLICES_ENRICHED
 
 ALBUM_URIS_ENRICHED = constants.ALBUM_URIS_ENRICHED
@@ -33,35 +35,41 @@ def write_label_info_back():
     record_label_major_dict = pd.Series(df_record_labels[RECORD_LABEL_MAJOR].values, index=df_record_labels[ALBUM_URI]).to_dict()
     start = time.time()
     count = 1
-    all_slices = os.listdir(PATH_TO_SLICES_ORIGINAL)
 
-    for filename in tqdm(all_slices, total=len(all_slices)):
+    for filename, single_slice in tqdm(iter_slices()):
         if filename.startswith('mpd.slice') and filename.endswith('.json'):
-            with open(PATH_TO_SLICES_ORIGINAL + filename, 'r') as read_file:
-                tmp = time.time()
-                if DEBUG:
-                    print('Current File: ' + filename + ', ' + str(count) + f'/1000 ({(tmp - start):.2}s)')
-                count += 1
-                single_slice = json.load(read_file)
-                for playlist in single_slice['playlists']:
-                    for track in playlist['tracks']:
-                        try:
-                            record_label_low = record_label_low_dict[track['album_uri']]
-                            record_label_low = record_label_low if record_label_low != FINAL_UNKN else FINAL_INDI
-                            track['record_label_low'] = record_label_low
-                        except KeyError:
-                            track['record_label_low'] = FINAL_UNKN
-                        try:
-                            record_label_major = record_label_major_dict[track['album_uri']]
-                            record_label_major = record_label_major if record_label_major != FINAL_UNKN else FINAL_INDI
-                            track['record_label_major'] = record_label_major
-                        except KeyError:
-                            track['record_label_major'] = FINAL_UNKN
+            tmp = time.time()
+            if DEBUG:
+                print('Current File: ' + filename + ', ' + str(count) + f'/1000 ({(tmp - start):.2}s)')
+            count += 1
+            for playlist in single_slice['playlists']:
+                for track in playlist['tracks']:
+                    try:
+                        record_label_low = record_label_low_dict[track['album_uri']]
+                        record_label_low = record_label_low if record_label_low != FINAL_UNKN else FINAL_INDI
+                        track['record_label_low'] = record_label_low
+                    except KeyError:
+                        track['record_label_low'] = FINAL_UNKN
+                    try:
+                        record_label_major = record_label_major_dict[track['album_uri']]
+                        record_label_major = record_label_major if record_label_major != FINAL_UNKN else FINAL_INDI
+                        track['record_label_major'] = record_label_major
+                    except KeyError:
+                        track['record_label_major'] = FINAL_UNKN
 
             with open(PATH_TO_SLICES_ENRICHED + filename, 'w') as write_file:
                 json.dump(single_slice, write_file, indent=4)
 
 
+def iter_slices():
+    # the slices are restored from the parquet tables of the MPD if they exist, which is faster than parsing the json
+    if mpd_table_cache.exists():
+        for slice_name in mpd_table_cache.get_slice_names():
+            yield slice_name + '.json', mpd_table_cache.read_slice(slice_name)
+    else:
+        yield from slice_source.open_source(MPD_SLICE_SOURCE).iter_slices()
+
+
 def main():
     if not os.path.exists(PATH_TO_SLICES_ENRICHED):
         os.mkdir(PATH_TO_SLICES_ENRICHED)
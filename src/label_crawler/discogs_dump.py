@@ -0,0 +1,181 @@
+import sys
+import os
+import re
+import gzip
+import json
+import sqlite3
+import threading
+import xml.etree.ElementTree as ElementTree
+from tqdm import tqdm
+
+from src import constants
+
+""" Offline Discogs labels from the monthly data dump
+
+Discogs publishes all labels once a month as discogs_<date>_labels.xml.gz (https://data.discogs.com/). ingest() streams
+the xml into a SQLite file with one row per label (id, name, profile, urls, parent label) and the sublabel relations,
+names are indexed case insensitive and without the number Discogs appends to duplicate names (e.g. 'Island (2)').
+With DISCOGS_OFFLINE the discogs crawler resolves labels with this file instead of the search and label requests:
+    search_label_id()...    label id for a label name, exact matches only, the entry without number wins
+    get_label()...          DumpLabel with the same attributes as a label of discogs_client (name, profile, urls,
+                            parent_label), so the crawler classifies it the same way
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+DISCOGS_DUMP_PATH = constants.DISCOGS_DUMP_PATH
+DISCOGS_DUMP_DB_PATH = constants.DISCOGS_DUMP_DB_PATH
+
+# labels inserted at once
+INSERT_BULK_SIZE = 10000
+# number appended by discogs to duplicate label names
+NAME_NUMBER_PATTERN = re.compile(r' \(\d+\)$')
+
+
+class DumpLabel:
+    def __init__(self, label_id, name, profile=None, urls=None, parent_label=None):
+        self.id = label_id
+        self.name = name
+        self.profile = profile
+        self.urls = urls
+        # DumpLabel with id and name of the parent, None if the label has no parent (like discogs_client)
+        self.parent_label = parent_label
+
+
+def get_name_key(name):
+    return NAME_NUMBER_PATTERN.sub('', name).strip().lower() if name is not None else None
+
+
+def ingest(dump_path=DISCOGS_DUMP_PATH, db_path=DISCOGS_DUMP_DB_PATH):
+    print('Ingest Discogs labels from', dump_path)
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    connection.execute('CREATE TABLE labels (id INTEGER PRIMARY KEY, name TEXT, name_key TEXT, profile TEXT, urls TEXT, '
+                       'parent_id INTEGER, parent_name TEXT)')
+    connection.execute('CREATE TABLE sublabels (parent_id INTEGER NOT NULL, label_id INTEGER NOT NULL, '
+                       'PRIMARY KEY (parent_id, label_id)) WITHOUT ROWID')
+
+    label_rows = []
+    sublabel_rows = []
+    for label in tqdm(iter_dump_labels(dump_path)):
+        label_rows.append((label['id'], label['name'], get_name_key(label['name']), label['profile'],
+                           json.dumps(label['urls']), label['parent_id'], label['parent_name']))
+        sublabel_rows.extend((label['id'], sublabel_id) for sublabel_id in label['sublabels'])
+        if len(label_rows) >= INSERT_BULK_SIZE:
+            insert_labels(connection, label_rows, sublabel_rows)
+            label_rows, sublabel_rows = [], []
+    insert_labels(connection, label_rows, sublabel_rows)
+
+    # indices are created after the inserts, which is faster than updating them with every row
+    connection.execute('CREATE INDEX labels_name_key ON labels (name_key)')
+    connection.execute('CREATE INDEX labels_parent_id ON labels (parent_id)')
+    connection.commit()
+    label_count = connection.execute('SELECT COUNT(*) FROM labels').fetchone()[0]
+    connection.close()
+    os.replace(tmp_path, db_path)
+    print('Saved', label_count, 'labels to', db_path)
+
+
+def insert_labels(connection, label_rows, sublabel_rows):
+    connection.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?, ?, ?)', label_rows)
+    connection.executemany('INSERT OR IGNORE INTO sublabels VALUES (?, ?)', sublabel_rows)
+    connection.commit()
+
+
+'''
+Streams the <label> elements of the dump (the children of <labels>) as dicts, the sublabels of a label are <label>
+elements as well, only the top level ones are returned. Parsed elements are cleared, so memory does not grow with the
+size of the dump.
+'''
+def iter_dump_labels(dump_path=DISCOGS_DUMP_PATH):
+    open_dump = gzip.open if dump_path.endswith('.gz') else open
+    with open_dump(dump_path, 'rb') as dump_file:
+        depth = 0
+        root = None
+        for event, element in ElementTree.iterparse(dump_file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1 and element.tag == 'label':
+                yield parse_label(element)
+                root.clear()
+
+
+def parse_label(element):
+    parent = element.find('parentLabel')
+    urls = [url.text.strip() for url in element.findall('urls/url') if url.text is not None and url.text.strip() != '']
+    return {
+        'id': int(element.findtext('id')),
+        'name': element.findtext('name'),
+        'profile': element.findtext('profile'),
+        'urls': urls,
+        'parent_id': int(parent.get('id')) if parent is not None and parent.get('id') else None,
+        'parent_name': parent.text if parent is not None else None,
+        'sublabels': [int(sublabel.get('id')) for sublabel in element.findall('sublabels/label') if sublabel.get('id')]
+    }
+
+
+class DiscogsDump:
+    def __init__(self, db_path=DISCOGS_DUMP_DB_PATH):
+        self.db_path = db_path
+        # read only, a missing file is not created. Shared by the workers of the crawler, queries are serialized
+        self.connection = sqlite3.connect('file:' + db_path + '?mode=ro', uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def search_label_id(self, label_name):
+        # returns the id of the label with this name (case insensitive), None if there is none
+        with self.lock:
+            rows = self.connection.execute('SELECT id, name FROM labels WHERE name_key = ?',
+                                           (get_name_key(label_name),)).fetchall()
+        if len(rows) == 0:
+            return None
+        # exact spelling first, then names without the number of a duplicate, then the oldest entry
+        rows.sort(key=lambda row: (row[1] != label_name, row[1].lower() != label_name.lower(),
+                                   NAME_NUMBER_PATTERN.search(row[1]) is not None, row[0]))
+        return rows[0][0]
+
+    def get_label(self, label_id):
+        with self.lock:
+            row = self.connection.execute('SELECT id, name, profile, urls, parent_id, parent_name FROM labels '
+                                          'WHERE id = ?', (label_id,)).fetchone()
+        if row is None:
+            return None
+        parent_label = DumpLabel(row[4], row[5]) if row[4] is not None else None
+        return DumpLabel(row[0], row[1], row[2], json.loads(row[3]) if row[3] is not None else None, parent_label)
+
+    def get_sublabel_ids(self, label_id):
+        # sublabels listed by the label and labels which list it as parent
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                'SELECT label_id FROM sublabels WHERE parent_id = ? UNION SELECT id FROM labels WHERE parent_id = ? '
+                'ORDER BY 1', (label_id, label_id))]
+
+    def close(self):
+        self.connection.close()
+
+
+def open_dump(db_path=DISCOGS_DUMP_DB_PATH):
+    if not os.path.exists(db_path):
+        print('No ingested Discogs dump at', db_path, '- run discogs_dump.py first')
+        return None
+    return DiscogsDump(db_path)
+
+
+def main():
+    ingest(sys.argv[1] if len(sys.argv) > 1 else DISCOGS_DUMP_PATH)
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt')
+        sys.exit(-1)
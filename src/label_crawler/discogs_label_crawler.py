@@ -8,10 +8,20 @@ import numpy as np
 from tqdm import tqdm
 import re
 import requests
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 from src import constants
 from src import discogs_credentials
+from src.utils.result_buffer import ResultBuffer
+from src.utils.checkpoint_journal import RowJournal, atomic_to_csv
+from src.utils import archive_store
+from src.utils.crawl_scheduler import CrawlScheduler
+from src.label_crawler import discogs_dump
+from src.label_crawler import discogs_major_closure
+from src.label_crawler import discogs_rate_limiter
 
 # get constants
 INPUT_LABEL_MAP = constants.LABEL_MAP_TRIVIAL
@@ -27,6 +37,10 @@ DISCOGS_KEYWORD_SONY_SUM = constants.DISCOGS_KEYWORD_SONY_SUM
 DISCOGS_KEYWORD_WARN_SUM = constants.DISCOGS_KEYWORD_WARN_SUM
 DISCOGS_KEYWORD_INDI_SUM = constants.DISCOGS_KEYWORD_INDI_SUM
 
+# columns written by the crawler for each looked up label
+RESULT_COLUMNS = [CLASS_DISCOGS, DISCOGS_WIKI_URL, DISCOGS_KEYWORD_UNIV_SUM, DISCOGS_KEYWORD_SONY_SUM,
+                  DISCOGS_KEYWORD_WARN_SUM, DISCOGS_KEYWORD_INDI_SUM]
+
 FINAL_UNIV = constants.FINAL_UNIV
 FINAL_SONY = constants.FINAL_SONY
 FINAL_WARN = constants.FINAL_WARN
@@ -42,14 +56,22 @@ DISCOGS_MAX_DEPTH = constants.DISCOGS_MAX_DEPTH
 # global variables
 FINALS = [FINAL_UNIV, FINAL_SONY, FINAL_WARN, FINAL_INDI, FINAL_UNKN]
 DISCOGS_FLAGS = [DISCOGS_FAIL_FLAG, DISCOGS_TRY_FLAG, DISCOGS_NO_ID_FLAG, DISCOGS_NO_PAR_FLAG, DISCOGS_MAX_DEPTH]
+# labels with these flags are not looked up again, labels whose lookup failed (e.g. a rate limited or failed request)
+# are looked up again in the next run
+DISCOGS_DONE_FLAGS = [flag for flag in DISCOGS_FLAGS if flag != DISCOGS_FAIL_FLAG]
 
 ARCHIVE_LOOKUP_PATH = constants.ARCHIVE_DISCOGS_LOOKUP_PATH
 ARCHIVE_DISCOGS_ID_MAP_PATH = constants.ARCHIVE_DISCOGS_ID_MAP_PATH
+DISCOGS_OFFLINE = constants.DISCOGS_OFFLINE
+DISCOGS_MAX_IN_FLIGHT = constants.DISCOGS_MAX_IN_FLIGHT
+DISCOGS_API_URL = constants.DISCOGS_API_URL
+DISCOGS_REQUEST_TIMEOUT_S = constants.DISCOGS_REQUEST_TIMEOUT_S
 
-# dict: <label_id, DiscogsEntry>
-ARCHIVE_LOOKUP = {}
-# dict: <label_name, label_id>
-ARCHIVE_ID_MAP = {}
+# archive stores (see utils/archive_store.py), opened by load_archives()
+# store: <label_id, DiscogsEntry>
+ARCHIVE_LOOKUP = None
+# store: <label_name, label_id>
+ARCHIVE_ID_MAP = None
 
 UNIV_DISCOGS_ID = 38404
 SONY_DISCOGS_ID = 353657
@@ -60,15 +82,40 @@ MAJORS_DICT = {
     'Sony': SONY_DISCOGS_ID,
     'Warner': WARN_DISCOGS_ID
 }
+# dict: <discogs id of a major, major>
+MAJOR_IDS = discogs_major_closure.MAJOR_IDS
 
 LABEL_MAP = pd.DataFrame()
+RESULT_BUFFER = None
+SCHEDULER = None
+# results since the last full save, replayed when a run is resumed
+LABEL_MAP_JOURNAL = RowJournal(OUTPUT_LABEL_MAP_EXT, RECORD_LABEL_LOW)
 DISCOGS_CLIENT = discogs_client.Client(discogs_credentials.user_agent,
                                        user_token=discogs_credentials.discogs_token)
+# all requests share the rate limit reported by discogs (see discogs_rate_limiter.py)
+RATE_BUCKET = discogs_rate_limiter.TokenBucket()
+discogs_rate_limiter.install(DISCOGS_CLIENT, RATE_BUCKET)
+# pooled connections for the raw label requests, one per worker
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': discogs_credentials.user_agent,
+                        'Authorization': 'Discogs token=' + discogs_credentials.discogs_token})
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(DISCOGS_MAX_IN_FLIGHT, 10)))
+# with concurrent workers: archive writes and checkpoints are serialized, a label page is extracted by one worker only
+ARCHIVE_LOCK = threading.RLock()
+LABEL_FLIGHTS = discogs_rate_limiter.SingleFlight()
+# ingested discogs dump, labels are resolved offline if it's set (see discogs_dump.py)
+DISCOGS_DUMP = None
+# dict: <label_id, set of majors> of all labels below the majors (see discogs_major_closure.py)
+MAJOR_CLOSURE = {}
+# resolves shortcut, wiki page and keyword aggregate of archived labels from their parents (see AncestorResolver)
+RESOLVER = None
 
 DEBUG = constants.DEBUG
 STOP_AT = None
 SAVE_AFTER = 1000
 MAX_DEPTH = 6
+# order of the keyword counts of a DiscogsEntry
+KEYWORDS = ['universal', 'sony', 'warner', 'independent']
 
 
 class Classification(Enum):
@@ -87,24 +134,138 @@ class Classification(Enum):
 
 # this class captures all relevant information of a discogs page
 class DiscogsEntry:
+    # version of the tuple of to_record(), increased with every change of the fields
+    RECORD_VERSION = 1
+    __slots__ = ('shortcut', 'parent_label', 'label_name', 'description', 'keyword_counts', 'wiki_page', 'payload')
+
     def __init__(self, shortcut: Classification = DISCOGS_FAIL_FLAG):
+        # shortcut to end of discogs chain
         self.shortcut = shortcut
-    # shortcut to end of discogs chain
-    shortcut = DISCOGS_FAIL_FLAG
-    # id of parent label, leading to next entry in archive
-    parent_label = None
-    # Name of the label for understandability
-    label_name = None
-    # description of discogs page, used for keyword search
-    description = None
-    # keyword collection
-    keywords = {}
-    # if wikipedia page is listed
-    wiki_page = None
+        # id of parent label, leading to next entry in archive
+        self.parent_label = None
+        # Name of the label for understandability
+        self.label_name = None
+        # description of discogs page, used for keyword search
+        self.description = None
+        # keyword counts in the order of KEYWORDS, None if the description was not searched
+        self.keyword_counts = None
+        # if wikipedia page is listed
+        self.wiki_page = None
+        # raw json of the label request (GET /labels/{id}), None for labels of the dump
+        self.payload = None
+
+    @property
+    def keywords(self):
+        # keyword collection
+        return dict(zip(KEYWORDS, self.keyword_counts)) if self.keyword_counts is not None else {}
+
+    @keywords.setter
+    def keywords(self, collection):
+        self.keyword_counts = tuple(int(collection.get(keyword, 0)) for keyword in KEYWORDS) if collection else None
+
+    def to_record(self):
+        # plain tuple which is stored in the archive, it does not depend on this class
+        return (self.RECORD_VERSION, self.shortcut, self.parent_label, self.label_name, self.description,
+                self.keyword_counts, self.wiki_page, self.payload)
+
+    @classmethod
+    def from_record(cls, record):
+        if record[0] != cls.RECORD_VERSION:
+            raise ValueError('Unknown version ' + str(record[0]) + ' of a DiscogsEntry record')
+        entry = cls.__new__(cls)
+        (_, entry.shortcut, entry.parent_label, entry.label_name, entry.description, entry.keyword_counts,
+         entry.wiki_page, entry.payload) = record
+        return entry
+
+    def __setstate__(self, state):
+        # entries pickled as instances (archives of older versions) only hold the attributes which were set
+        self.__init__()
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+'''
+Resolves the labels of the archive from their chain of parent labels, without requests:
+    resolve()...            shortcut and wiki page, like extract_discogs_page() sets them when a label is crawled: the
+                            major if the parent is a major id, else the ones of the parent (the wiki page of the
+                            parent wins), a label without parent keeps its own
+    aggregate_keywords()... keyword aggregate over the parents, weighted by depth like merge_keywords_collections()
+Results are cached per label (keyword aggregates per label and depth) and all labels on a resolved path point to the
+result of its end (path compression), so resolving siblings or a whole label map walks every chain once. A chain which
+runs into itself is a cycle and resolved as DISCOGS_MAX_DEPTH. Archive entries are never changed once they are added,
+only results which end at a parent that is not in the archive (yet) are not cached.
+'''
+class AncestorResolver:
+    def __init__(self, archive, max_depth=MAX_DEPTH):
+        self.archive = archive
+        self.max_depth = max_depth
+        # dict: <label_id, (shortcut, wiki_page)>
+        self.resolved = {}
+        # dict: <(label_id, depth), keyword aggregate>
+        self.keyword_aggregates = {}
+
+    def resolve(self, label_id):
+        path = []
+        on_path = set()
+        current = label_id
+        cacheable = True
+        while True:
+            if current in self.resolved:
+                shortcut, wiki_page = self.resolved[current]
+                break
+            if current in on_path:
+                if DEBUG: print('Cycle of parent labels at', current)
+                shortcut, wiki_page = DISCOGS_MAX_DEPTH, None
+                break
+            entry = self.archive[current]
+            path.append(current)
+            on_path.add(current)
+
+            parent_id = entry.parent_label
+            if parent_id is None:
+                shortcut, wiki_page = entry.shortcut, None
+                break
+            major = MAJOR_IDS.get(parent_id)
+            if major is not None:
+                shortcut, wiki_page = major, None
+                break
+            if parent_id not in self.archive:
+                shortcut, wiki_page = entry.shortcut, None
+                cacheable = False
+                break
+            current = parent_id
+
+        # from the top of the path down, the wiki page of a parent is inherited
+        for path_label_id in reversed(path):
+            if wiki_page is None:
+                wiki_page = self.archive[path_label_id].wiki_page
+            if cacheable:
+                self.resolved[path_label_id] = (shortcut, wiki_page)
+        return shortcut, wiki_page
+
+    def aggregate_keywords(self, entry, depth=0):
+        # returns the keyword aggregate and if it can be cached
+        if depth > self.max_depth or entry.parent_label is None:
+            return entry.keywords, True
+        if entry.parent_label not in self.archive:
+            return entry.keywords, False
+        parent_aggregate, cacheable = self.get_keyword_aggregate(entry.parent_label, depth + 1)
+        return merge_keywords_collections(entry.keywords, parent_aggregate, depth + 1), cacheable
+
+    def get_keyword_aggregate(self, label_id, depth):
+        key = (label_id, depth)
+        if key in self.keyword_aggregates:
+            return self.keyword_aggregates[key], True
+        aggregate, cacheable = self.aggregate_keywords(self.archive[label_id], depth)
+        if cacheable:
+            self.keyword_aggregates[key] = aggregate
+        return aggregate, cacheable
 
 
 def run_crawler(input_map=INPUT_LABEL_MAP, index_from=-1):
-    global LABEL_MAP
+    global LABEL_MAP, RESULT_BUFFER, SCHEDULER
 
     if DEBUG: print('load:', input_map)
     if input_map == INPUT_LABEL_MAP:
@@ -114,37 +275,106 @@ def run_crawler(input_map=INPUT_LABEL_MAP, index_from=-1):
         LABEL_MAP[[DISCOGS_KEYWORD_UNIV_SUM, DISCOGS_KEYWORD_SONY_SUM, DISCOGS_KEYWORD_WARN_SUM, DISCOGS_KEYWORD_INDI_SUM]] = [0, 0, 0, 0]
     else:
         LABEL_MAP = pd.read_csv(input_map, dtype={DISCOGS_WIKI_URL: str})
+    replayed_rows = LABEL_MAP_JOURNAL.replay(LABEL_MAP)
+    if DEBUG: print('Replayed', replayed_rows, 'rows from', LABEL_MAP_JOURNAL.path)
+
+    pending_mask = ~LABEL_MAP[CLASS_DISCOGS].isin(FINALS + DISCOGS_DONE_FLAGS) & (LABEL_MAP.index > index_from)
+    if STOP_AT is not None:
+        pending_mask &= LABEL_MAP[RECORD_LABEL_LOW] == STOP_AT
+    label_names = LABEL_MAP[RECORD_LABEL_LOW].values
+    RESULT_BUFFER = ResultBuffer(LABEL_MAP, RESULT_COLUMNS, LABEL_MAP_JOURNAL)
+    # labels are looked up by descending occurrences until all are done or a crawl budget is reached
+    SCHEDULER = CrawlScheduler(LABEL_MAP['occurrences'].values, LABEL_MAP[CLASS_DISCOGS].isin(FINALS).values, 'discogs')
+
+    if DISCOGS_MAX_IN_FLIGHT > 1:
+        lookups = lookup_concurrently(label_names, SCHEDULER.positions(pending_mask), DISCOGS_MAX_IN_FLIGHT)
+    else:
+        lookups = ((position, get_major_label_classification(label_names[position]))
+                   for position in SCHEDULER.positions(pending_mask))
 
-    for index, entry in tqdm(LABEL_MAP.iterrows(), total=LABEL_MAP.shape[0]):
-        if STOP_AT is not None and entry[RECORD_LABEL_LOW] != STOP_AT:
-            continue
+    # results are written by this thread only, in the order the lookups are done
+    for counter, (position, discogs_entry) in enumerate(lookups):
+        label_name = label_names[position]
+        keyword_aggregate = aggregate_keywords(discogs_entry)
+        set_result(position, discogs_entry.shortcut, discogs_entry.wiki_page, keyword_aggregate)
 
-        if index > index_from and entry[CLASS_DISCOGS] not in FINALS and entry[CLASS_DISCOGS] not in DISCOGS_FLAGS:
-            if DEBUG: print('------------------')
-            if DEBUG: print('start lookup for: ', entry[RECORD_LABEL_LOW])
-            discogs_entry = get_major_label_classification(entry[RECORD_LABEL_LOW])
+        if discogs_entry.shortcut in FINALS:
+            SCHEDULER.resolve(position)
+        if DEBUG: print(label_name, ' --> ', discogs_entry.shortcut, keyword_aggregate)
 
-            keyword_aggregate = aggregate_keywords(discogs_entry)
-            LABEL_MAP.loc[index, [CLASS_DISCOGS, DISCOGS_WIKI_URL]] = [discogs_entry.shortcut, discogs_entry.wiki_page]
-            LABEL_MAP.loc[index, DISCOGS_KEYWORD_UNIV_SUM] = keyword_aggregate['universal'] if 'universal' in keyword_aggregate.keys() else 0
-            LABEL_MAP.loc[index, DISCOGS_KEYWORD_SONY_SUM] = keyword_aggregate['sony'] if 'sony' in keyword_aggregate.keys() else 0
-            LABEL_MAP.loc[index, DISCOGS_KEYWORD_WARN_SUM] = keyword_aggregate['warner'] if 'warner' in keyword_aggregate.keys() else 0
-            LABEL_MAP.loc[index, DISCOGS_KEYWORD_INDI_SUM] = keyword_aggregate['independent'] if 'independent' in keyword_aggregate.keys() else 0
+        if (counter + 1) % SAVE_AFTER == 0:
+            if DEBUG: print('checkpoint after', counter + 1, 'lookups')
+            checkpoint()
 
-            if DEBUG: print(entry[RECORD_LABEL_LOW], ' --> ', discogs_entry.shortcut, keyword_aggregate)
+    if DEBUG: print('Discogs requests:', RATE_BUCKET.request_count, ', rate limited:', RATE_BUCKET.rate_limited_count)
+    save_label_map()
+    save_archives()
 
-        if index > index_from and index % SAVE_AFTER == 0:
-            if DEBUG: print('saving at', index)
-            save_label_map()
-            save_archives()
 
+'''
+Looks up the labels at the given positions with max_in_flight worker threads, all sharing the rate limit. Yields
+(position, DiscogsEntry) as the lookups finish, only a few positions are taken ahead of the running lookups so the
+crawl budgets of the scheduler still apply.
+'''
+def lookup_concurrently(label_names, positions, max_in_flight):
+    def lookup(position):
+        return position, get_major_label_classification(label_names[position])
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = deque()
+        for position in positions:
+            futures.append(executor.submit(lookup, position))
+            while len(futures) >= 2 * max_in_flight or (len(futures) > 0 and futures[0].done()):
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+
+
+def set_result(position, shortcut, wiki_page, keyword_aggregate):
+    RESULT_BUFFER.set_row(position, [
+        shortcut,
+        wiki_page,
+        keyword_aggregate.get('universal', 0),
+        keyword_aggregate.get('sony', 0),
+        keyword_aggregate.get('warner', 0),
+        keyword_aggregate.get('independent', 0)
+    ])
+
+
+'''
+Classifies all labels of an existing output again from the archives only, without requests: labels which were looked
+up get the shortcut, wiki page and keyword aggregate their current chain of parents in the archive resolves to.
+'''
+def reclassify_from_archive(input_map=OUTPUT_LABEL_MAP_EXT):
+    global LABEL_MAP, RESULT_BUFFER
+
+    if DEBUG: print('reclassify:', input_map)
+    LABEL_MAP = pd.read_csv(input_map, dtype={DISCOGS_WIKI_URL: str})
+    RESULT_BUFFER = ResultBuffer(LABEL_MAP, RESULT_COLUMNS, LABEL_MAP_JOURNAL)
+    resolver = get_resolver()
+
+    reclassified = 0
+    for position, label_name in enumerate(tqdm(LABEL_MAP[RECORD_LABEL_LOW].values)):
+        label_id = ARCHIVE_ID_MAP.get(label_name)
+        if label_id is None:
+            continue
+        major = discogs_major_closure.get_major(MAJOR_CLOSURE, label_id)
+        if major is None and label_id in ARCHIVE_LOOKUP.keys():
+            shortcut, wiki_page = resolver.resolve(label_id)
+            set_result(position, shortcut, wiki_page, aggregate_keywords(ARCHIVE_LOOKUP[label_id]))
+        elif major is not None or label_id in DISCOGS_FLAGS:
+            discogs_entry = get_major_label_classification(label_name)
+            set_result(position, discogs_entry.shortcut, discogs_entry.wiki_page, aggregate_keywords(discogs_entry))
+        else:
+            continue
+        reclassified += 1
+
+    print('Reclassified', reclassified, 'labels from the archive')
     save_label_map()
-    save_archives()
 
 
 def get_major_label_classification(label_name) -> DiscogsEntry:
-    global ARCHIVE_LOOKUP
-
+    if DEBUG: print('start lookup for: ', label_name)
     label_id = get_discogs_label_id(label_name)
 
     # check if label was found
@@ -152,52 +382,92 @@ def get_major_label_classification(label_name) -> DiscogsEntry:
         return DiscogsEntry(label_id)
 
     elif label_id is not None:
-        if label_id not in ARCHIVE_LOOKUP.keys():
-            ARCHIVE_LOOKUP[label_id] = extract_discogs_page(label_id)
+        # labels of the major closure are classified without walking up their parents
+        major = discogs_major_closure.get_major(MAJOR_CLOSURE, label_id)
+        if major is not None:
+            if DEBUG: print('Found', label_id, 'in major closure')
+            return DiscogsEntry(major)
 
-        return ARCHIVE_LOOKUP[label_id]
+        try:
+            return get_archived_page(label_id)
+        except LabelRequestError as e:
+            # the label or one of its parents could not be read, none of them is archived so they are looked up again
+            # in the next run
+            if DEBUG: print('Lookup of', label_name, 'failed:', e)
+            return DiscogsEntry(DISCOGS_FAIL_FLAG)
     else:
         return DiscogsEntry(DISCOGS_NO_ID_FLAG)
 
 
-def get_discogs_label_id(label_name):
-    global ARCHIVE_ID_MAP
+def get_archived_page(label_id, depth=0, path=()) -> DiscogsEntry:
+    # extracts the page of a label if it is not archived yet, concurrent workers wait for the one extracting it
+    def extract():
+        if label_id not in ARCHIVE_LOOKUP.keys():
+            discogs_entry = extract_discogs_page(label_id, depth, path)
+            with ARCHIVE_LOCK:
+                ARCHIVE_LOOKUP[label_id] = discogs_entry
+        return ARCHIVE_LOOKUP[label_id]
+
+    if label_id in ARCHIVE_LOOKUP.keys():
+        return ARCHIVE_LOOKUP[label_id]
+    # two workers extracting each others parents at the same time are a cycle of parent labels
+    return LABEL_FLIGHTS.run(label_id, extract, lambda: DiscogsEntry(DISCOGS_MAX_DEPTH))
+
+
+def set_id(label_name, label_id):
+    with ARCHIVE_LOCK:
+        ARCHIVE_ID_MAP[label_name] = label_id
 
+
+def get_discogs_label_id(label_name):
     if label_name in ARCHIVE_ID_MAP.keys():
         return ARCHIVE_ID_MAP[label_name]
 
+    elif DISCOGS_DUMP is not None:
+        label_id = DISCOGS_DUMP.search_label_id(label_name)
+        if label_id is None:
+            if DEBUG: print('No id found in dump for', label_name)
+            set_id(label_name, DISCOGS_NO_ID_FLAG)
+            return None
+        set_id(label_name, label_id)
+        return label_id
+
     else:
         try:
+            count_request()
             res = DISCOGS_CLIENT.search(label_name, type='label', page=1, per_page=5)
 
             if len(res.page(0)) > 0:
                 # get first entry of first page of result
                 label_id = res.page(0)[0].id
-                ARCHIVE_ID_MAP[label_name] = label_id
+                set_id(label_name, label_id)
                 return label_id
             else:
                 if DEBUG: print('No id found for', label_name)
-                ARCHIVE_ID_MAP[label_name] = DISCOGS_NO_ID_FLAG
+                set_id(label_name, DISCOGS_NO_ID_FLAG)
                 return None
-        except (requests.exceptions.ConnectionError, json.decoder.JSONDecodeError) as e:
-            # happened first on 'South By Sea Music'
+        except (requests.exceptions.ConnectionError, json.decoder.JSONDecodeError, discogs_client.exceptions.HTTPError) as e:
+            # happened first on 'South By Sea Music'. A failed request does not mean that the label does not exist,
+            # it's not archived and the label is flagged as failed lookup, which is looked up again in the next run
             if DEBUG: print('Connection Error: ', e)
-            ARCHIVE_ID_MAP[label_name] = DISCOGS_NO_ID_FLAG
-            return None
+            return DISCOGS_FAIL_FLAG
 
 
-def extract_discogs_page(label_id, depth=0) -> DiscogsEntry:
+def extract_discogs_page(label_id, depth=0, path=()) -> DiscogsEntry:
     global ARCHIVE_LOOKUP
 
     if depth > MAX_DEPTH:
         if DEBUG: print('Max depth reached for', label_id)
         return DiscogsEntry(DISCOGS_MAX_DEPTH)
 
-    # check if label has already been loaded
-    label_full = DISCOGS_CLIENT.label(label_id)
+    label_full, payload = get_label(label_id)
+    if label_full is None:
+        if DEBUG: print('Label', label_id, 'not found')
+        return DiscogsEntry(DISCOGS_FAIL_FLAG)
 
     # create new entry object
     discogs_entry = DiscogsEntry(DISCOGS_TRY_FLAG)
+    discogs_entry.payload = payload
     # get name & description
     try:
         discogs_entry.label_name = label_full.name
@@ -225,15 +495,20 @@ def extract_discogs_page(label_id, depth=0) -> DiscogsEntry:
                 discogs_entry.shortcut = FINAL_WARN
                 return discogs_entry
 
+            # a parent which is already on the path of this lookup would repeat the same labels until the max depth
+            if parent_id == label_id or parent_id in path:
+                if DEBUG: print('Cycle of parent labels at', parent_id)
+                discogs_entry.shortcut = DISCOGS_MAX_DEPTH
+                return discogs_entry
+
             # if no match occurred and a parent exists, repeat lookup for parent
-            if parent_id not in ARCHIVE_LOOKUP.keys():
-                if DEBUG: print('Start recursive lookup for:', parent_id)
-                ARCHIVE_LOOKUP[parent_id] = extract_discogs_page(parent_id, depth + 1)
+            if DEBUG and parent_id not in ARCHIVE_LOOKUP.keys(): print('Start recursive lookup for:', parent_id)
+            parent_entry = get_archived_page(parent_id, depth + 1, path + (label_id,))
             # set shortcut of parent also for child
-            discogs_entry.shortcut = ARCHIVE_LOOKUP[parent_id].shortcut
+            discogs_entry.shortcut = parent_entry.shortcut
             # if no wikipage has been found yet, take the one from parent
-            if ARCHIVE_LOOKUP[parent_id].wiki_page is not None:
-                discogs_entry.wiki_page = ARCHIVE_LOOKUP[parent_id].wiki_page
+            if parent_entry.wiki_page is not None:
+                discogs_entry.wiki_page = parent_entry.wiki_page
 
         # if no parent label is listed, check if profile text contains 'independent' keyword
         except AttributeError as e:
@@ -247,7 +522,55 @@ def extract_discogs_page(label_id, depth=0) -> DiscogsEntry:
     finally:
         discogs_entry.keywords = count_keywords(discogs_entry.description)
 
-        return discogs_entry
+    return discogs_entry
+
+
+def get_label(label_id):
+    # (label, raw json) of the dump if it's used (no json), else of one label request. (None, None) if there is no label,
+    # raises LabelRequestError if the request failed
+    if DISCOGS_DUMP is not None:
+        return DISCOGS_DUMP.get_label(label_id), None
+    payload = fetch_label(label_id)
+    if payload is None:
+        return None, None
+    return parse_label(payload), payload
+
+
+'''
+A label request which failed for another reason than a missing label (e.g. a timeout, a 5xx response or a 429 after all
+retries). The label may exist, so nothing is archived for it.
+'''
+class LabelRequestError(Exception):
+    pass
+
+
+def fetch_label(label_id):
+    # raw json of GET /labels/{id}, None if the label does not exist (404). Raises LabelRequestError if the request failed
+    count_request()
+    try:
+        response = discogs_rate_limiter.send(RATE_BUCKET, SESSION.get, DISCOGS_API_URL + '/labels/' + str(label_id),
+                                             timeout=DISCOGS_REQUEST_TIMEOUT_S)
+        if response.status_code == 404:
+            if DEBUG: print('Label', label_id, 'does not exist')
+            return None
+        response.raise_for_status()
+        return response.json()
+    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError) as e:
+        if DEBUG: print('Connection Error for', label_id, ':', e)
+        raise LabelRequestError('label request for ' + str(label_id) + ' failed: ' + str(e)) from e
+
+
+def parse_label(payload):
+    # only the fields used by the crawler, with the attributes of a label of discogs_client (like the dump labels)
+    parent = payload.get('parent_label')
+    parent_label = discogs_dump.DumpLabel(parent['id'], parent.get('name')) if parent is not None else None
+    return discogs_dump.DumpLabel(payload['id'], payload.get('name'), payload.get('profile'), payload.get('urls'),
+                                  parent_label)
+
+
+def count_request():
+    if SCHEDULER is not None:
+        SCHEDULER.count_request()
 
 
 def count_keywords(description):
@@ -266,16 +589,16 @@ def count_keywords(description):
 
 
 def aggregate_keywords(entry: DiscogsEntry, depth=0):
-    res_collection = entry.keywords
+    # the aggregates of the parents are cached by the resolver
+    return get_resolver().aggregate_keywords(entry, depth)[0]
 
-    if depth > MAX_DEPTH:
-        return res_collection
 
-    if entry.parent_label is not None:
-        if entry.parent_label in ARCHIVE_LOOKUP.keys():
-            res_collection = merge_keywords_collections(res_collection, aggregate_keywords(ARCHIVE_LOOKUP[entry.parent_label], depth + 1), depth + 1)
+def get_resolver():
+    global RESOLVER
 
-    return res_collection
+    if RESOLVER is None or RESOLVER.archive is not ARCHIVE_LOOKUP or RESOLVER.max_depth != MAX_DEPTH:
+        RESOLVER = AncestorResolver(ARCHIVE_LOOKUP, MAX_DEPTH)
+    return RESOLVER
 
 
 def merge_keywords_collections(col1, col2, depth):
@@ -301,39 +624,46 @@ def indi_keyword_in_text(description):
 
 
 def load_archives():
-    global ARCHIVE_LOOKUP, ARCHIVE_ID_MAP
-    try:
-        with open(ARCHIVE_LOOKUP_PATH, 'rb+') as read_file:
-            ARCHIVE_LOOKUP = pickle.load(read_file)
-            if DEBUG: print('using existing archive', ARCHIVE_LOOKUP_PATH)
-    except FileNotFoundError as e:
-        if DEBUG: print('No archive existed at', ARCHIVE_LOOKUP_PATH, ', creating an empty one.')
-        ARCHIVE_LOOKUP = {}
-    try:
-        with open(ARCHIVE_DISCOGS_ID_MAP_PATH, 'rb+') as read_file:
-            ARCHIVE_ID_MAP = pickle.load(read_file)
-            if DEBUG: print('using existing archive', ARCHIVE_DISCOGS_ID_MAP_PATH)
-    except FileNotFoundError as e:
-        if DEBUG: print('No id_archive existed at', ARCHIVE_DISCOGS_ID_MAP_PATH, ', creating an empty one.')
-        ARCHIVE_ID_MAP = {}
+    global ARCHIVE_LOOKUP, ARCHIVE_ID_MAP, MAJOR_CLOSURE
+
+    ARCHIVE_LOOKUP = archive_store.open_archive(ARCHIVE_LOOKUP_PATH, archive_store.encode_record,
+                                                archive_store.get_record_decoder(DiscogsEntry))
+    ARCHIVE_ID_MAP = archive_store.open_archive(ARCHIVE_DISCOGS_ID_MAP_PATH)
+    if DEBUG: print('Opened archives', ARCHIVE_LOOKUP.store_path, 'and', ARCHIVE_ID_MAP.store_path)
+    MAJOR_CLOSURE = discogs_major_closure.load_closure()
+
+
+def checkpoint():
+    if DEBUG: print('checkpoint')
+    if SCHEDULER is not None:
+        SCHEDULER.report(force=True)
+    if RESULT_BUFFER is not None:
+        RESULT_BUFFER.flush()
+    save_archives()
 
 
 def save_archives():
+    # only the entries set since the last save are written
     if DEBUG: print('saving archives')
-    with open(ARCHIVE_LOOKUP_PATH, 'wb+') as write_file:
-        pickle.dump(ARCHIVE_LOOKUP, write_file)
-    with open(ARCHIVE_DISCOGS_ID_MAP_PATH, 'wb+') as write_file:
-        pickle.dump(ARCHIVE_ID_MAP, write_file)
+    with ARCHIVE_LOCK:
+        if ARCHIVE_LOOKUP is not None:
+            ARCHIVE_LOOKUP.checkpoint()
+        if ARCHIVE_ID_MAP is not None:
+            ARCHIVE_ID_MAP.checkpoint()
 
 
 def save_label_map():
     if DEBUG: print('Saving df')
-    LABEL_MAP.to_csv(OUTPUT_LABEL_MAP_EXT, index=False)
-    LABEL_MAP.drop([DISCOGS_WIKI_URL, DISCOGS_KEYWORD_UNIV_SUM, DISCOGS_KEYWORD_SONY_SUM, DISCOGS_KEYWORD_WARN_SUM, DISCOGS_KEYWORD_INDI_SUM], axis=1).to_csv(OUTPUT_LABEL_MAP, index=False)
+    if RESULT_BUFFER is not None:
+        RESULT_BUFFER.flush()
+    atomic_to_csv(LABEL_MAP, OUTPUT_LABEL_MAP_EXT, index=False)
+    atomic_to_csv(LABEL_MAP.drop([DISCOGS_WIKI_URL, DISCOGS_KEYWORD_UNIV_SUM, DISCOGS_KEYWORD_SONY_SUM, DISCOGS_KEYWORD_WARN_SUM, DISCOGS_KEYWORD_INDI_SUM], axis=1), OUTPUT_LABEL_MAP, index=False)
+    LABEL_MAP_JOURNAL.clear()
 
 
-def main(debug=None, max_depth=6):
+def main(debug=None, max_depth=6, offline=None, reclassify=False):
     global INPUT_LABEL_MAP, OUTPUT_LABEL_MAP, ARCHIVE_LOOKUP_PATH, ARCHIVE_DISCOGS_ID_MAP_PATH, DEBUG, MAX_DEPTH
+    global DISCOGS_OFFLINE, DISCOGS_DUMP
 
     print()
     print('##########################################################')
@@ -343,9 +673,18 @@ def main(debug=None, max_depth=6):
     if debug is not None:
         DEBUG = debug
     MAX_DEPTH = max_depth
+    if offline is not None:
+        DISCOGS_OFFLINE = offline
+    if DISCOGS_OFFLINE:
+        DISCOGS_DUMP = discogs_dump.open_dump()
+        if DISCOGS_DUMP is None:
+            return -1
+        print('Resolve labels offline from', DISCOGS_DUMP.db_path)
 
     load_archives()
-    if os.path.exists(OUTPUT_LABEL_MAP_EXT):
+    if reclassify and os.path.exists(OUTPUT_LABEL_MAP_EXT):
+        reclassify_from_archive(OUTPUT_LABEL_MAP_EXT)
+    elif os.path.exists(OUTPUT_LABEL_MAP_EXT):
         run_crawler(OUTPUT_LABEL_MAP_EXT)
     else:
         run_crawler(INPUT_LABEL_MAP)
@@ -358,6 +697,5 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         print('Keyboard Interrupt')
-        save_label_map()
-        save_archives()
+        checkpoint()
         sys.exit(-1)
@@ -0,0 +1,144 @@
+import sys
+import os
+import pickle
+import time
+from collections import deque
+from tqdm import tqdm
+
+from src import constants
+from src.utils.checkpoint_journal import DictJournal, atomic_pickle_dump
+from src.label_crawler import discogs_dump
+
+""" Top-down sublabel closure of the major labels on Discogs
+
+Walks once from the discogs ids of Universal, Sony and Warner down through their sublabel trees and stores for every
+label below a major (and the majors themselves) the set of majors it belongs to:
+    ARCHIVE_DISCOGS_MAJOR_CLOSURE_PATH...   dict: <label_id, set of majors (FINAL_UNIV, FINAL_SONY, FINAL_WARN)>
+The discogs crawler classifies a label id in the closure with a single major right away, instead of walking up the
+parent labels with one request per level. Labels outside the closure are still resolved bottom-up.
+
+The sublabels are read from the ingested dump (see discogs_dump.py) if DISCOGS_OFFLINE is set, else from the label
+requests of the discogs api. The sublabel ids of every visited label are kept in a node archive with the time they were
+read, a rerun (refresh) only reads labels again which are older than DISCOGS_CLOSURE_TTL_S and labels which were not
+reached before, an interrupted walk continues where it stopped.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+FINAL_UNIV = constants.FINAL_UNIV
+FINAL_SONY = constants.FINAL_SONY
+FINAL_WARN = constants.FINAL_WARN
+
+DISCOGS_OFFLINE = constants.DISCOGS_OFFLINE
+ARCHIVE_DISCOGS_MAJOR_CLOSURE_PATH = constants.ARCHIVE_DISCOGS_MAJOR_CLOSURE_PATH
+ARCHIVE_DISCOGS_SUBLABEL_NODES_PATH = constants.ARCHIVE_DISCOGS_SUBLABEL_NODES_PATH
+DISCOGS_CLOSURE_TTL_S = constants.DISCOGS_CLOSURE_TTL_S
+
+UNIV_DISCOGS_ID = 38404
+SONY_DISCOGS_ID = 353657
+WARN_DISCOGS_ID = 2345
+
+# dict: <discogs id of a major, major>
+MAJOR_IDS = {
+    UNIV_DISCOGS_ID: FINAL_UNIV,
+    SONY_DISCOGS_ID: FINAL_SONY,
+    WARN_DISCOGS_ID: FINAL_WARN
+}
+
+SAVE_AFTER = 1000
+
+# dict: <label_id, (list of sublabel ids, time they were read)>
+NODES = {}
+NODES_JOURNAL = DictJournal(ARCHIVE_DISCOGS_SUBLABEL_NODES_PATH)
+
+
+def build_closure(offline=DISCOGS_OFFLINE, ttl=DISCOGS_CLOSURE_TTL_S):
+    global NODES
+
+    NODES = NODES_JOURNAL.load()
+    if offline:
+        dump = discogs_dump.open_dump()
+        if dump is None:
+            return None
+        get_sublabel_ids = dump.get_sublabel_ids
+    else:
+        get_sublabel_ids = get_api_sublabel_ids
+
+    closure = {}
+    read_count = 0
+    now = time.time()
+    for major_id, major in MAJOR_IDS.items():
+        print('Walk sublabels of', major, '(' + str(major_id) + ')')
+        visited = set()
+        queue = deque([major_id])
+        with tqdm() as progress:
+            while len(queue) > 0:
+                label_id = queue.popleft()
+                if label_id in visited:
+                    continue
+                visited.add(label_id)
+                closure.setdefault(label_id, set()).add(major)
+                progress.update()
+
+                node = NODES.get(label_id)
+                if node is None or now - node[1] > ttl:
+                    sublabel_ids = get_sublabel_ids(label_id)
+                    if sublabel_ids is not None:
+                        node = (sublabel_ids, time.time())
+                        NODES[label_id] = node
+                    read_count += 1
+                    if read_count % SAVE_AFTER == 0:
+                        NODES_JOURNAL.checkpoint(NODES)
+                if node is not None:
+                    queue.extend(node[0])
+
+    NODES_JOURNAL.compact(NODES)
+    atomic_pickle_dump(closure, ARCHIVE_DISCOGS_MAJOR_CLOSURE_PATH)
+    ambiguous = sum(1 for majors in closure.values() if len(majors) > 1)
+    print('Saved closure of', len(closure), 'labels (' + str(ambiguous), 'below more than one major) after reading',
+          read_count, 'labels to', ARCHIVE_DISCOGS_MAJOR_CLOSURE_PATH)
+    return closure
+
+
+def get_api_sublabel_ids(label_id):
+    # sublabel ids of a label from its label request, None if the label does not exist or the request failed
+    from src.label_crawler import discogs_label_crawler
+    try:
+        payload = discogs_label_crawler.fetch_label(label_id)
+    except discogs_label_crawler.LabelRequestError as e:
+        if DEBUG: print(e)
+        return None
+    if payload is None:
+        return None
+    return [sublabel['id'] for sublabel in payload.get('sublabels', [])]
+
+
+def load_closure(closure_path=ARCHIVE_DISCOGS_MAJOR_CLOSURE_PATH):
+    if not os.path.exists(closure_path):
+        if DEBUG: print('No major closure at', closure_path)
+        return {}
+    with open(closure_path, 'rb') as read_file:
+        return pickle.load(read_file)
+
+
+def get_major(closure, label_id):
+    # major of a label id, None if it's not below exactly one major
+    majors = closure.get(label_id)
+    if majors is not None and len(majors) == 1:
+        return next(iter(majors))
+    return None
+
+
+def main(offline=None):
+    build_closure(offline if offline is not None else DISCOGS_OFFLINE)
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt')
+        NODES_JOURNAL.checkpoint(NODES)
+        sys.exit(-1)
@@ -0,0 +1,161 @@
+import time
+import threading
+from concurrent.futures import Future
+
+from src import constants
+
+""" Rate limit of the discogs api
+
+Discogs allows DISCOGS_RATE_LIMIT authenticated requests in a moving window of 60 seconds and reports the remaining
+budget with every response (X-Discogs-Ratelimit, X-Discogs-Ratelimit-Remaining). All requests of the discogs crawler
+take a token from one TokenBucket, which is refilled at limit / 60 tokens per second and never holds more tokens than
+the last response reported as remaining, so the full quota is used continuously without running into 429 responses.
+A 429 response blocks the bucket for 'Retry-After' seconds before the request is sent again.
+
+install(client) puts the bucket in front of every request of a discogs_client.Client (its own backoff is disabled),
+SingleFlight makes sure concurrent workers of the crawler never fetch the same label at the same time.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+RATE_LIMIT = constants.DISCOGS_RATE_LIMIT
+MAX_RETRIES = constants.DISCOGS_MAX_RETRIES
+
+WINDOW_S = 60
+# used if a 429 response comes without a (valid) 'Retry-After' header
+DEFAULT_RETRY_AFTER_S = 10
+
+
+class TokenBucket:
+    def __init__(self, rate_limit=RATE_LIMIT, window_s=WINDOW_S):
+        self.capacity = rate_limit
+        self.rate = rate_limit / window_s
+        self.tokens = rate_limit
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+        self.request_count = 0
+        self.rate_limited_count = 0
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    time.sleep(self.blocked_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.request_count += 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+    def update(self, headers):
+        # the budget reported by discogs also counts requests of other clients with the same token
+        try:
+            limit = int(headers['X-Discogs-Ratelimit'])
+            remaining = int(headers['X-Discogs-Ratelimit-Remaining'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            if limit != self.capacity and limit > 0:
+                self.capacity = limit
+                self.rate = limit / WINDOW_S
+            self.tokens = min(self.tokens, remaining)
+
+    def block_for(self, seconds):
+        # a rate limited response blocks all workers, not only the one which got the 429
+        with self.lock:
+            self.rate_limited_count += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def get_retry_after(headers):
+    try:
+        return max(float(headers.get('Retry-After')), 0)
+    except (AttributeError, TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER_S
+
+
+def send(bucket, request, *args, **kwargs):
+    # sends request(*args, **kwargs) (returning a requests.Response) within the rate limit, 429 responses are retried
+    attempt = 0
+    while True:
+        bucket.acquire()
+        response = request(*args, **kwargs)
+        bucket.update(response.headers)
+        if response.status_code != 429 or attempt >= MAX_RETRIES:
+            return response
+        attempt += 1
+        retry_after = get_retry_after(response.headers)
+        if DEBUG: print('Discogs rate limit reached, retry after', retry_after, 's (attempt', attempt, ')')
+        bucket.block_for(retry_after)
+
+
+def install(client, bucket):
+    # every request of the discogs client goes through the bucket
+    fetcher = client._fetcher
+    fetcher.backoff_enabled = False
+    request = fetcher.request
+    fetcher.request = lambda *args, **kwargs: send(bucket, request, *args, **kwargs)
+
+
+'''
+Runs function() once per key at a time: a thread asking for a key which is already running waits for its result
+instead of running it again. If waiting would close a cycle (the running thread waits, directly or through other threads,
+for a key of the asking thread), run() returns on_cycle() instead of waiting forever.
+'''
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # dict: <key, (future, thread which runs it)>
+        self.calls = {}
+        # dict: <thread, key it waits for>
+        self.waiting = {}
+
+    def run(self, key, function, on_cycle):
+        thread = threading.current_thread()
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                future = Future()
+                self.calls[key] = (future, thread)
+            elif self.waits_for(call[1], thread):
+                return on_cycle()
+            else:
+                self.waiting[thread] = key
+
+        if call is not None:
+            try:
+                return call[0].result()
+            finally:
+                with self.lock:
+                    del self.waiting[thread]
+
+        try:
+            result = function()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def waits_for(self, owner, thread):
+        # True if owner is thread or waits (through other threads) for a key run by thread
+        visited = set()
+        while owner is not None and owner not in visited:
+            if owner is thread:
+                return True
+            visited.add(owner)
+            key = self.waiting.get(owner)
+            owner = self.calls[key][1] if key in self.calls else None
+        return False
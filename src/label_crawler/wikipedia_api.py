@@ -0,0 +1,194 @@
+import re
+import requests
+import urllib.parse
+
+from src import constants
+
+""" Wikipedia pages from the MediaWiki Action API
+
+Instead of the rendered html of every page, the wikipedia crawler can read the wikitext of pages from the action api
+(WIKI_USE_API). One query returns the wikitext of up to MAX_TITLES titles and resolves their redirects in the same call,
+prefetch() collects the pages the crawler will look up next (the next labels of the label map, the links of an infobox)
+and get_page() only sends a request for pages which were not prefetched.
+
+A page is returned as WikiPage with the links of the infobox fields the crawler uses (parent companies, distributors,
+labels), its text for the keyword counts and all its links. Links are given like the hrefs of the rendered page
+('/wiki/Sony_Music'), so they can be compared to the links of the html pages and the major urls.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+WIKIPEDIA_API_URL = constants.WIKIPEDIA_API_URL
+WIKIPEDIA_USER_AGENT = constants.WIKIPEDIA_USER_AGENT
+WIKIPEDIA_REQUEST_TIMEOUT_S = constants.WIKIPEDIA_REQUEST_TIMEOUT_S
+
+# titles per query, the limit of the api for clients without bot rights
+MAX_TITLES = 50
+# prefetched pages which are never read (e.g. links after a classification) are dropped when there are more
+MAX_PREFETCHED = 10 * MAX_TITLES
+# hosts of the pages which are read from the api, pages of other wikis are read as html
+API_HOSTS = ['', 'en.wikipedia.org', 'en.m.wikipedia.org']
+# links to pages of these namespaces are no links to labels or companies
+SKIPPED_NAMESPACES = ['file', 'image', 'category', 'wikipedia', 'help', 'template', 'wikt', 'commons']
+
+INFOBOX_PATTERN = re.compile(r'\{\{\s*infobox', re.IGNORECASE)
+# [[target]], [[target|text]], [[target#section|text]]
+LINK_PATTERN = re.compile(r'\[\[\s*([^\[\]|#]+?)\s*(?:#[^\[\]|]*)?(?:\|[^\[\]]*)?\]\]')
+
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': WIKIPEDIA_USER_AGENT})
+
+# dict: <title, WikiPage or None for pages which do not exist>, prefetched pages until they are read by get_page()
+PAGES = {}
+
+
+class WikiPage:
+    def __init__(self, infobox_links, text, links):
+        # dict: <field (e.g. 'parent_companies'), list of links>, None if the page has no infobox
+        self.infobox_links = infobox_links
+        self.text = text
+        self.links = links
+
+
+def get_title(wiki_url):
+    # title of an english wikipedia url or link ('/wiki/Sony_Music' -> 'Sony Music'), None for other urls
+    parts = urllib.parse.urlsplit(wiki_url)
+    if parts.netloc not in API_HOSTS or not parts.path.startswith('/wiki/') or parts.query != '':
+        return None
+    title = urllib.parse.unquote(parts.path[len('/wiki/'):]).replace('_', ' ').strip()
+    return title if title != '' else None
+
+
+def to_link(title):
+    # href of a title like on the rendered pages, the first letter of a title is always upper case
+    title = title.strip().replace(' ', '_')
+    title = title[:1].upper() + title[1:]
+    return '/wiki/' + urllib.parse.quote(title, safe="/:;@$!*(),~'")
+
+
+def get_page(title, infobox_keywords, count_request=None):
+    # WikiPage of a title, None if the page does not exist. Raises requests.exceptions.RequestException
+    if title not in PAGES:
+        fetch_pages([title], infobox_keywords, count_request)
+    return PAGES.pop(title, None)
+
+
+def prefetch(titles, infobox_keywords, count_request=None):
+    # fetches the pages of all titles which are not fetched yet, failed requests are retried by get_page()
+    if len(PAGES) > MAX_PREFETCHED:
+        PAGES.clear()
+    titles = list(dict.fromkeys(title for title in titles if title is not None and title not in PAGES))
+    try:
+        fetch_pages(titles, infobox_keywords, count_request)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        if DEBUG: print('Prefetch of', len(titles), 'pages failed:', e)
+
+
+def fetch_pages(titles, infobox_keywords, count_request=None):
+    for start in range(0, len(titles), MAX_TITLES):
+        chunk = titles[start:start + MAX_TITLES]
+        params = {'action': 'query', 'format': 'json', 'formatversion': 2, 'redirects': 1, 'prop': 'revisions',
+                  'rvprop': 'content', 'rvslots': 'main', 'titles': '|'.join(chunk)}
+        # dict: <requested title, title of the page after normalization and redirects>
+        targets = {title: title for title in chunk}
+        # dict: <title of a page, wikitext>, None if the page does not exist
+        contents = {}
+        continue_params = {}
+        while True:
+            if count_request is not None:
+                count_request()
+            response = SESSION.get(WIKIPEDIA_API_URL, params=dict(params, **continue_params),
+                                   timeout=WIKIPEDIA_REQUEST_TIMEOUT_S)
+            response.raise_for_status()
+            result = response.json()
+            query = result.get('query', {})
+            for mapping in query.get('normalized', []) + query.get('redirects', []):
+                for title, target in targets.items():
+                    if target == mapping['from']:
+                        targets[title] = mapping['to']
+            for page in query.get('pages', []):
+                if page.get('missing') or page.get('invalid'):
+                    contents[page['title']] = None
+                elif len(page.get('revisions', [])) > 0:
+                    contents[page['title']] = page['revisions'][0]['slots']['main']['content']
+            # the content of many large pages is returned in more than one response
+            if 'continue' not in result:
+                break
+            continue_params = result['continue']
+
+        for title, target in targets.items():
+            wikitext = contents.get(target)
+            PAGES[title] = parse_page(wikitext, infobox_keywords) if wikitext is not None else None
+        if DEBUG: print('Fetched', len(chunk), 'pages from the api')
+
+
+def parse_page(wikitext, infobox_keywords):
+    # infobox_keywords: dict <field, names of the infobox rows of the field>
+    infobox = get_infobox(wikitext)
+    infobox_links = None
+    if infobox is not None:
+        rows = get_infobox_rows(infobox)
+        infobox_links = {}
+        for field, keywords in infobox_keywords.items():
+            infobox_links[field] = []
+            for keyword in keywords:
+                if keyword in rows:
+                    infobox_links[field] = get_links(rows[keyword])
+                    break
+    return WikiPage(infobox_links, wikitext, get_links(wikitext))
+
+
+def get_infobox(wikitext):
+    # text of the first infobox template, without the braces
+    match = INFOBOX_PATTERN.search(wikitext)
+    if match is None:
+        return None
+    depth = 0
+    position = match.start()
+    while position < len(wikitext) - 1:
+        pair = wikitext[position:position + 2]
+        if pair == '{{':
+            depth += 1
+            position += 2
+        elif pair == '}}':
+            depth -= 1
+            position += 2
+            if depth == 0:
+                return wikitext[match.start() + 2:position - 2]
+        else:
+            position += 1
+    return wikitext[match.start() + 2:]
+
+
+def get_infobox_rows(infobox):
+    # dict: <name of the row (lower case), value>, the rows are split at the '|' which are not in a template or link
+    rows = {}
+    depth = 0
+    start = 0
+    parts = []
+    for position, character in enumerate(infobox):
+        if character in '{[':
+            depth += 1
+        elif character in '}]':
+            depth -= 1
+        elif character == '|' and depth == 0:
+            parts.append(infobox[start:position])
+            start = position + 1
+    parts.append(infobox[start:])
+
+    for part in parts[1:]:
+        name, separator, value = part.partition('=')
+        if separator != '':
+            rows.setdefault(name.strip().lower().replace('_', ' '), value.strip())
+    return rows
+
+
+def get_links(wikitext):
+    links = []
+    for target in LINK_PATTERN.findall(wikitext):
+        namespace, separator, _ = target.lstrip(':').partition(':')
+        if separator != '' and namespace.strip().lower() in SKIPPED_NAMESPACES:
+            continue
+        links.append(to_link(target.lstrip(':')))
+    return links
@@ -12,10 +12,17 @@ import re
 import requests
 import math
 import urllib
+from collections import deque
 from enum import Enum
 from tqdm import tqdm
 
 from src import constants
+from src.utils.result_buffer import ResultBuffer
+from src.utils.checkpoint_journal import RowJournal, atomic_to_csv
+from src.utils import archive_store
+from src.utils.crawl_scheduler import CrawlScheduler
+from src.label_crawler import wikipedia_api
+from src.label_crawler import wikipedia_dump
 
 ####### get constants ########
 
@@ -25,9 +32,14 @@ OUTPUT_LABEL_MAP_EXT = constants.LABEL_MAP_WIKIPEDIA_EXT
 
 ARCHIVE_WIKIPEDIA_LOOKUP_PATH = constants.ARCHIVE_WIKIPEDIA_LOOKUP_PATH
 ARCHIVE_WIKIPEDIA_URL_MAP_PATH = constants.ARCHIVE_WIKIPEDIA_URL_MAP_PATH
+WIKI_USE_API = constants.WIKI_USE_API
+WIKI_OFFLINE = constants.WIKI_OFFLINE
 
-ARCHIVE_LOOKUP = {}
-ARCHIVE_URL_MAP = {}
+# archive stores (see utils/archive_store.py), opened by load_archives()
+ARCHIVE_LOOKUP = None
+ARCHIVE_URL_MAP = None
+# ingested wikipedia dump, only used offline
+WIKIPEDIA_DUMP = None
 
 # columns combining discogs and wikipedia crawler
 RECORD_LABEL_LOW = constants.RECORD_LABEL_LOW
@@ -44,6 +56,10 @@ WIKI_KEYWORD_SONY_SUM = constants.WIKI_KEYWORD_SONY_SUM
 WIKI_KEYWORD_WARN_SUM = constants.WIKI_KEYWORD_WARN_SUM
 WIKI_KEYWORD_INDI_SUM = constants.WIKI_KEYWORD_INDI_SUM
 
+# columns written by the crawler for each looked up label
+RESULT_COLUMNS = [CLASS_WIKIPEDIA, WIKI_URL, WIKI_HAS_INDI_LINK, WIKI_KEYWORD_UNIV_SUM, WIKI_KEYWORD_SONY_SUM,
+                  WIKI_KEYWORD_WARN_SUM, WIKI_KEYWORD_INDI_SUM]
+
 FINAL_UNIV = constants.FINAL_UNIV
 FINAL_SONY = constants.FINAL_SONY
 FINAL_WARN = constants.FINAL_WARN
@@ -83,6 +99,14 @@ WARN_WIKI_URLS = ['/wiki/Warner_Music_Group', '/wiki/Warner_Bros.', '/wiki/Warne
 INDI_WIKI_URL = '/wiki/Independent_record_label'
 
 WIKIPEDIA_BASE_URL = 'https://en.wikipedia.org'
+# order of the keyword counts of a WikipediaEntry
+KEYWORDS = ['universal', 'sony', 'warner', 'independent']
+# dict: <field of a WikipediaEntry, names of the infobox rows with its links>
+INFOBOX_KEYWORDS = {
+    'parent_companies': ['parent company', 'parent', 'parents'],
+    'distributors': ['distributor(s)', 'distributors', 'distributor'],
+    'labels': ['label', 'labels', 'label(s)']
+}
 
 DEBUG = False
 STOP_AT = None
@@ -93,6 +117,10 @@ MAX_LOOKUP_TIME_S = 600
 # Set language to english as there are more infoboxes on label pages in the english wiki version
 wikipedia.set_lang('en')
 LABEL_MAP = pd.DataFrame()
+RESULT_BUFFER = None
+SCHEDULER = None
+# results since the last full save, replayed when a run is resumed
+LABEL_MAP_JOURNAL = RowJournal(OUTPUT_LABEL_MAP_EXT, RECORD_LABEL_LOW)
 
 class Classification(Enum):
     WIKI_TRY_FLAG = WIKI_TRY_FLAG
@@ -110,26 +138,123 @@ class Classification(Enum):
 
 # this class captures all relevant information of a wikipedia page
 class WikipediaEntry:
+    # version of the tuple of to_record(), increased with every change of the fields
+    RECORD_VERSION = 1
+    __slots__ = ('shortcut', 'url', 'parent_companies', 'distributors', 'labels', 'keyword_counts', 'contains_indi')
+
     def __init__(self, shortcut=Classification.WIKI_TRY_FLAG):
+        # the type of the wikipedia entry (see enum EntryType)
         self.shortcut = shortcut
-    # the type of the wikipedia entry (see enum EntryType)
-    shortcut = None
-    # the url is the identifier of the page
-    url = None
-    # for a record label: a list of parent companies
-    parent_companies = []
-    # for a record label: a list of distributors
-    distributors = []
-    # for a band/artist: a list of labels
-    labels = []
-    # keyword collection of 4 targets when no simpler classification happened
-    keywords = {}
-    # boolean if entry or descendant contains link to wiki/indi page
-    contains_indi = False
+        # the url is the identifier of the page
+        self.url = None
+        # for a record label: the links of parent companies
+        self.parent_companies = ()
+        # for a record label: the links of distributors
+        self.distributors = ()
+        # for a band/artist: the links of labels
+        self.labels = ()
+        # keyword counts of 4 targets (order of KEYWORDS) when no simpler classification happened, else None
+        self.keyword_counts = None
+        # boolean if entry or descendant contains link to wiki/indi page
+        self.contains_indi = False
+
+    @property
+    def keywords(self):
+        # keyword collection
+        return dict(zip(KEYWORDS, self.keyword_counts)) if self.keyword_counts is not None else {}
+
+    @keywords.setter
+    def keywords(self, collection):
+        self.keyword_counts = tuple(int(collection.get(keyword, 0)) for keyword in KEYWORDS) if collection else None
+
+    def to_record(self):
+        # plain tuple which is stored in the archive, it does not depend on this class
+        return (self.RECORD_VERSION, self.shortcut, self.url, self.parent_companies, self.distributors, self.labels,
+                self.keyword_counts, self.contains_indi)
+
+    @classmethod
+    def from_record(cls, record):
+        if record[0] != cls.RECORD_VERSION:
+            raise ValueError('Unknown version ' + str(record[0]) + ' of a WikipediaEntry record')
+        entry = cls.__new__(cls)
+        (_, entry.shortcut, entry.url, parent_companies, distributors, labels, entry.keyword_counts,
+         entry.contains_indi) = record
+        entry.parent_companies = intern_links(parent_companies)
+        entry.distributors = intern_links(distributors)
+        entry.labels = intern_links(labels)
+        return entry
+
+    def __setstate__(self, state):
+        # entries pickled as instances (archives of older versions) only hold the attributes which were set
+        self.__init__()
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, value in state.items():
+            if name in ['parent_companies', 'distributors', 'labels']:
+                value = intern_links(value)
+            setattr(self, name, value)
+
+
+def intern_links(links):
+    # the same links (e.g. of a major) are on many pages, they are kept once in memory
+    return tuple(sys.intern(link) if link is not None else None for link in links)
+
+
+'''
+Evaluates the keyword aggregates and indi flags of the pages in the archive over the graph of their links (parent
+companies, distributors and labels), without requests:
+    aggregate_keywords()... keywords of the page merged with the aggregates of its archived links, weighted by depth
+                            (see merge_keywords_collections()), only pages with keywords are merged with their links
+    aggregate_indi()...     True if the page or one of its archived links up to the max depth links to the indi page
+Each page is evaluated once per depth and the result is shared by all pages linking to it, a page linked by thousands of
+labels (e.g. a distributor) is evaluated at most max_depth + 2 times. The depth grows with every link, so a cycle of links
+is followed at most until the max depth. The archive must not change while an evaluator is used.
+'''
+class LinkGraphEvaluator:
+    def __init__(self, archive, max_depth=MAX_DEPTH):
+        self.archive = archive
+        self.max_depth = max_depth
+        # dict: <(link, depth), keyword aggregate>
+        self.keyword_aggregates = {}
+        # dict: <(link, depth), indi flag>
+        self.indi_flags = {}
+
+    def get_links(self, entry):
+        return [link for link in entry.parent_companies + entry.distributors + entry.labels if link in self.archive]
+
+    def aggregate_keywords(self, entry, depth=0):
+        res_collection = entry.keywords
+        if depth > self.max_depth:
+            return res_collection
+        depth += 1
+
+        if res_collection:
+            for link in self.get_links(entry):
+                res_collection = merge_keywords_collections(res_collection, self.get_keyword_aggregate(link, depth), depth)
+        return res_collection
+
+    def get_keyword_aggregate(self, link, depth):
+        key = (link, depth)
+        if key not in self.keyword_aggregates:
+            self.keyword_aggregates[key] = self.aggregate_keywords(self.archive[link], depth)
+        return self.keyword_aggregates[key]
+
+    def aggregate_indi(self, entry, depth=0):
+        if depth > self.max_depth:
+            return False
+        if entry.contains_indi:
+            return True
+        return any(self.get_indi(link, depth + 1) for link in self.get_links(entry))
+
+    def get_indi(self, link, depth):
+        key = (link, depth)
+        if key not in self.indi_flags:
+            self.indi_flags[key] = self.aggregate_indi(self.archive[link], depth)
+        return self.indi_flags[key]
 
 
 def run_crawler(input_map=INPUT_LABEL_MAP, index_from=-1):
-    global LABEL_MAP
+    global LABEL_MAP, RESULT_BUFFER, SCHEDULER
 
     if DEBUG: print('loading label map', input_map)
     if input_map == INPUT_LABEL_MAP:
@@ -139,39 +264,82 @@ def run_crawler(input_map=INPUT_LABEL_MAP, index_from=-1):
         LABEL_MAP[[WIKI_KEYWORD_UNIV_SUM, WIKI_KEYWORD_SONY_SUM, WIKI_KEYWORD_WARN_SUM, WIKI_KEYWORD_INDI_SUM]] = [0, 0, 0, 0]
     else:
         LABEL_MAP = pd.read_csv(input_map, dtype={DISCOGS_WIKI_URL: str, WIKI_URL: str, WIKI_HAS_INDI_LINK: bool})
+    replayed_rows = LABEL_MAP_JOURNAL.replay(LABEL_MAP)
+    if DEBUG: print('Replayed', replayed_rows, 'rows from', LABEL_MAP_JOURNAL.path)
+
+    pending_mask = ~LABEL_MAP[CLASS_WIKIPEDIA].isin(FINALS + WIKI_FLAGS) & (LABEL_MAP.index > index_from)
+    if STOP_AT is not None:
+        pending_mask &= LABEL_MAP[RECORD_LABEL_LOW] == STOP_AT
+    label_names = LABEL_MAP[RECORD_LABEL_LOW].values
+    label_occurrences = LABEL_MAP['occurrences'].values
+    classes_wikipedia = LABEL_MAP[CLASS_WIKIPEDIA].values
+    discogs_wiki_urls = LABEL_MAP[DISCOGS_WIKI_URL].values
+    RESULT_BUFFER = ResultBuffer(LABEL_MAP, RESULT_COLUMNS, LABEL_MAP_JOURNAL)
+    # labels are looked up by descending occurrences until all are done or a crawl budget is reached
+    SCHEDULER = CrawlScheduler(label_occurrences, LABEL_MAP[CLASS_WIKIPEDIA].isin(FINALS).values, 'wikipedia')
+
+    positions = SCHEDULER.positions(pending_mask)
+    if WIKI_USE_API and WIKIPEDIA_DUMP is None:
+        positions = prefetch_positions(positions, discogs_wiki_urls)
+
+    for counter, position in enumerate(positions):
+        label_name = label_names[position]
+        occurrences = label_occurrences[position]
+        class_wikipedia = classes_wikipedia[position]
+        discogs_wiki_url = discogs_wiki_urls[position]
+        if DEBUG: print('------------------')
+        if DEBUG: print('start lookup for: ', label_name, f'({occurrences}occ) -> ', class_wikipedia)
+        wikipedia_entry = get_major_label_classification(label_name, discogs_wiki_url)
+        RESULT_BUFFER.set(position, CLASS_WIKIPEDIA, wikipedia_entry.shortcut)
+        RESULT_BUFFER.set(position, WIKI_URL, wikipedia_entry.url)
+
+        if wikipedia_entry.shortcut in FINALS:
+            SCHEDULER.resolve(position)
+        if DEBUG: print(label_name, ' --> ', wikipedia_entry.shortcut)
+
+        if (counter + 1) % SAVE_AFTER == 0:
+            if DEBUG: print('checkpoint after', counter + 1, 'lookups')
+            checkpoint()
 
-    for index, entry in tqdm(LABEL_MAP.iterrows(), total=LABEL_MAP.shape[0]):
-    # for index, entry in LABEL_MAP.iterrows():
-        if STOP_AT is not None and entry[RECORD_LABEL_LOW] != STOP_AT:
-            continue
+    save_archives()
+    # the aggregates are read from the finished archive, keywords of each wiki entry are not touched
+    set_aggregates()
+    save_label_map()
 
-        if index > index_from and entry[CLASS_WIKIPEDIA] not in FINALS and entry[CLASS_WIKIPEDIA] not in WIKI_FLAGS:
-        #if True:
-            if DEBUG: print('------------------')
-            if DEBUG: print('start lookup for: ', entry[RECORD_LABEL_LOW], f'({entry.occurrences}occ) -> ', entry[CLASS_WIKIPEDIA])
-            wikipedia_entry = get_major_label_classification(entry[RECORD_LABEL_LOW], entry[DISCOGS_WIKI_URL])
-            LABEL_MAP.loc[index, CLASS_WIKIPEDIA] = wikipedia_entry.shortcut
-            LABEL_MAP.loc[index, WIKI_URL] = wikipedia_entry.url
 
-            # aggregate over keywords: keywords of each wiki entry are not touched
-            keyword_aggregate = aggregate_keywords(wikipedia_entry)
-            LABEL_MAP.loc[index, [WIKI_KEYWORD_UNIV_SUM]] = keyword_aggregate['universal'] if 'universal' in keyword_aggregate.keys() else 0
-            LABEL_MAP.loc[index, [WIKI_KEYWORD_SONY_SUM]] = keyword_aggregate['sony'] if 'sony' in keyword_aggregate.keys() else 0
-            LABEL_MAP.loc[index, [WIKI_KEYWORD_WARN_SUM]] = keyword_aggregate['warner'] if 'warner' in keyword_aggregate.keys() else 0
-            LABEL_MAP.loc[index, [WIKI_KEYWORD_INDI_SUM]] = keyword_aggregate['independent'] if 'independent' in keyword_aggregate.keys() else 0
+def prefetch_positions(positions, discogs_wiki_urls):
+    # yields the positions, the pages of the discogs wiki urls of the next positions are fetched in one request
+    ahead = deque()
+    for position in positions:
+        ahead.append(position)
+        if len(ahead) >= wikipedia_api.MAX_TITLES:
+            prefetch_urls([discogs_wiki_urls[ahead_position] for ahead_position in ahead])
+            while len(ahead) > 0:
+                yield ahead.popleft()
+    prefetch_urls([discogs_wiki_urls[ahead_position] for ahead_position in ahead])
+    yield from ahead
 
-            indi_entry_aggregate = aggregate_indi(wikipedia_entry)
-            LABEL_MAP.loc[index, WIKI_HAS_INDI_LINK] = indi_entry_aggregate
 
-            if DEBUG: print(entry[RECORD_LABEL_LOW], ' --> ', wikipedia_entry.shortcut, keyword_aggregate, indi_entry_aggregate)
+def prefetch_urls(wiki_urls):
+    titles = [wikipedia_api.get_title(wiki_url) for wiki_url in wiki_urls
+              if type(wiki_url) is str and wiki_url not in ARCHIVE_LOOKUP]
+    wikipedia_api.prefetch(titles, INFOBOX_KEYWORDS, count_request)
 
-        if index % SAVE_AFTER == 0:
-            if DEBUG: print('saving at', index)
-            save_archives()
-            save_label_map()
 
-    save_archives()
-    save_label_map()
+def set_aggregates():
+    # keyword aggregate and indi flag of all labels with an archived page
+    evaluator = LinkGraphEvaluator(ARCHIVE_LOOKUP, MAX_DEPTH)
+    for position, wiki_url in enumerate(tqdm(LABEL_MAP[WIKI_URL].values)):
+        if type(wiki_url) is not str or wiki_url not in ARCHIVE_LOOKUP:
+            continue
+        keyword_aggregate = evaluator.get_keyword_aggregate(wiki_url, 0)
+        RESULT_BUFFER.set(position, WIKI_HAS_INDI_LINK, evaluator.get_indi(wiki_url, 0))
+        RESULT_BUFFER.set(position, WIKI_KEYWORD_UNIV_SUM, keyword_aggregate.get('universal', 0))
+        RESULT_BUFFER.set(position, WIKI_KEYWORD_SONY_SUM, keyword_aggregate.get('sony', 0))
+        RESULT_BUFFER.set(position, WIKI_KEYWORD_WARN_SUM, keyword_aggregate.get('warner', 0))
+        RESULT_BUFFER.set(position, WIKI_KEYWORD_INDI_SUM, keyword_aggregate.get('independent', 0))
+    if DEBUG: print('Evaluated', len(evaluator.keyword_aggregates), 'keyword aggregates and', len(evaluator.indi_flags),
+                    'indi flags')
 
 
 def get_major_label_classification(label_low, wiki_url_discogs) -> WikipediaEntry:
@@ -214,11 +382,15 @@ def get_wikipedia_url(label_name):
         search_string = clean_label(label_name)
 
         if DEBUG: print('search for:', search_string)
-        try:
-            search_res = wikipedia.search(search_string)
-        except (wikipedia.exceptions.WikipediaException, requests.exceptions.ConnectionError) as e:
-            if DEBUG: print('WikipediaException:', e)
-            return WIKI_ERROR_FLAG_WIKI_EXCEPTION
+        if WIKIPEDIA_DUMP is not None:
+            search_res = WIKIPEDIA_DUMP.search(search_string)
+        else:
+            try:
+                count_request()
+                search_res = wikipedia.search(search_string)
+            except (wikipedia.exceptions.WikipediaException, requests.exceptions.ConnectionError) as e:
+                if DEBUG: print('WikipediaException:', e)
+                return WIKI_ERROR_FLAG_WIKI_EXCEPTION
 
         if DEBUG: print(search_res)
         if len(search_res) > 0:
@@ -226,7 +398,10 @@ def get_wikipedia_url(label_name):
                 # list results are excluded as they are no real Wikipedia articles but rather overview pages
                 if 'list' not in current_res.lower():
                     if DEBUG: print('get wikipedia page for:', current_res)
+                    if WIKIPEDIA_DUMP is not None:
+                        return get_dump_url(label_name, current_res)
                     try:
+                        count_request()
                         wiki_url = wikipedia.page(current_res).url
                         ARCHIVE_URL_MAP[label_name] = wiki_url
                         return wiki_url
@@ -247,6 +422,25 @@ def get_wikipedia_url(label_name):
         return WIKI_NO_URL_FLAG
 
 
+def get_dump_url(label_name, title):
+    # url of the page of a search result in the dump, like wikipedia.page(title).url
+    page_title = WIKIPEDIA_DUMP.get_page_title(title)
+    if page_title is None:
+        if DEBUG: print('PageError:', title, 'is not in the dump')
+        return WIKI_ERROR_FLAG_PAGE
+    if wikipedia_dump.is_disambiguation(WIKIPEDIA_DUMP.get_page(page_title)):
+        if DEBUG: print('DisambiguationError:', page_title)
+        return WIKI_ERROR_FLAG_DISAMBIGUATION
+    wiki_url = WIKIPEDIA_BASE_URL + wikipedia_api.to_link(page_title)
+    ARCHIVE_URL_MAP[label_name] = wiki_url
+    return wiki_url
+
+
+def count_request():
+    if SCHEDULER is not None:
+        SCHEDULER.count_request()
+
+
 def clean_label(label):
     # Cleaning the label is necessary as "label_name" + "records" seemed to return in most results and first all similar
     # tokens are being removed
@@ -286,30 +480,33 @@ def extract_wikipedia_page(wiki_url, depth=0) -> WikipediaEntry:
     wiki_entry = WikipediaEntry(WIKI_TRY_FLAG)
     wiki_entry.url = wiki_url
     try:
-        response = requests.get(wiki_url)
-    except (requests.exceptions.ConnectionError, requests.exceptions.InvalidURL, wikipedia.exceptions.WikipediaException) as e:
+        page = get_page(wiki_url)
+    except (requests.exceptions.RequestException, ValueError, wikipedia.exceptions.WikipediaException) as e:
         if DEBUG:
             print('Connection error happened', e)
         wiki_entry.shortcut = WIKI_ERROR_FLAG_CONNECTION
         ARCHIVE_LOOKUP[wiki_url] = wiki_entry
         return wiki_entry
 
-    soup = BeautifulSoup(response.content, 'html.parser')
-    infoboxes = soup.find_all('table', {'class': 'infobox'})
-    if len(infoboxes) < 1:
+    if page is None:
+        if DEBUG:
+            print('Page does not exist')
+        wiki_entry.shortcut = WIKI_ERROR_FLAG_PAGE
+        ARCHIVE_LOOKUP[wiki_url] = wiki_entry
+        return wiki_entry
+
+    if page.infobox_links is None:
         if DEBUG:
             print('No infobox found, return with keyword collection')
-        wiki_entry.keywords = count_keywords(soup.get_text())
+        wiki_entry.keywords = count_keywords(page.text)
         wiki_entry.shortcut = WIKI_DE_FLAG + ' (no infobox)'
         ARCHIVE_LOOKUP[wiki_url] = wiki_entry
         return wiki_entry
     else:
-        infobox_rows = infoboxes[0].find_all('tr')
-
         # get extracted links from infobox
-        wiki_entry.parent_companies = extract_infobox_links(infobox_rows, ['parent company', 'parent', 'parents'])
-        wiki_entry.distributors = extract_infobox_links(infobox_rows, ['distributor(s)', 'distributors', 'distributor'])
-        wiki_entry.labels = extract_infobox_links(infobox_rows, ['label', 'labels', 'label(s)'])
+        wiki_entry.parent_companies = intern_links(clean_links(page.infobox_links['parent_companies']))
+        wiki_entry.distributors = intern_links(clean_links(page.infobox_links['distributors']))
+        wiki_entry.labels = intern_links(clean_links(page.infobox_links['labels']))
 
         # check if a parent is in the finals
         classification = compare_links_to_finals(wiki_entry.parent_companies)
@@ -334,6 +531,9 @@ def extract_wikipedia_page(wiki_url, depth=0) -> WikipediaEntry:
         classification_done = classification in FINALS
         if not classification_done:
             if DEBUG: print('unsuccessful classification')
+            if WIKI_USE_API and WIKIPEDIA_DUMP is None and depth < MAX_DEPTH:
+                # the pages of all links are fetched at once before they are looked up
+                prefetch_urls(wiki_entry.parent_companies + wiki_entry.distributors + wiki_entry.labels)
 
             if len(wiki_entry.parent_companies) > 0:
                 if DEBUG:
@@ -366,10 +566,9 @@ def extract_wikipedia_page(wiki_url, depth=0) -> WikipediaEntry:
                         break
 
             # check if link to genereal indi wiki page exists
-            for link in soup.find_all('a'):
-                if INDI_WIKI_URL == link.get('href'):
-                    if DEBUG: print('Contains link to wiki/indi page')
-                    wiki_entry.contains_indi = True
+            if INDI_WIKI_URL in page.links:
+                if DEBUG: print('Contains link to wiki/indi page')
+                wiki_entry.contains_indi = True
 
             if DEBUG:
                 print('No classification possible')
@@ -379,10 +578,34 @@ def extract_wikipedia_page(wiki_url, depth=0) -> WikipediaEntry:
         wiki_entry.shortcut = classification
 
 
-    wiki_entry.keywords = count_keywords(soup.get_text())
+    wiki_entry.keywords = count_keywords(page.text)
     ARCHIVE_LOOKUP[wiki_url] = wiki_entry
     return wiki_entry
 
+
+def get_page(wiki_url):
+    # WikiPage of the url (None if it does not exist), from the dump offline, from the action api if it's used (see
+    # wikipedia_api.py) else from the rendered html
+    if WIKIPEDIA_DUMP is not None:
+        # only pages of the english wikipedia are in the dump
+        title = wikipedia_api.get_title(wiki_url)
+        wikitext = WIKIPEDIA_DUMP.get_page(title) if title is not None else None
+        return wikipedia_api.parse_page(wikitext, INFOBOX_KEYWORDS) if wikitext is not None else None
+
+    title = wikipedia_api.get_title(wiki_url) if WIKI_USE_API else None
+    if title is not None:
+        return wikipedia_api.get_page(title, INFOBOX_KEYWORDS, count_request)
+
+    count_request()
+    response = requests.get(wiki_url)
+    soup = BeautifulSoup(response.content, 'html.parser')
+    infoboxes = soup.find_all('table', {'class': 'infobox'})
+    infobox_links = None
+    if len(infoboxes) > 0:
+        infobox_rows = infoboxes[0].find_all('tr')
+        infobox_links = {field: extract_infobox_links(infobox_rows, keywords) for field, keywords in INFOBOX_KEYWORDS.items()}
+    return wikipedia_api.WikiPage(infobox_links, soup.get_text(), [link.get('href') for link in soup.find_all('a')])
+
 stub_hrefs = ['/wiki/Parent_company', '/wiki/Record_label', '/wiki/Digital_distribution', ]
 def extract_infobox_links(rows, keywords):
     for row in rows:
@@ -400,6 +623,10 @@ def extract_infobox_links(rows, keywords):
     return []
 
 
+def clean_links(links):
+    return [link for link in links if link not in stub_hrefs]
+
+
 def extract_wiki_link(bs_element):
     if bs_element.find('a') is not None and bs_element.find('a').get('href') is not None:
         link = bs_element.find('a').get('href')
@@ -433,28 +660,6 @@ def count_keywords(text_soup):
     return collection
 
 
-def aggregate_keywords(entry: WikipediaEntry, depth=0):
-    res_collection = entry.keywords
-
-    if depth > MAX_DEPTH:
-        return res_collection
-    else:
-        depth += 1
-
-    if entry.keywords:
-        for parent in entry.parent_companies:
-            if parent in ARCHIVE_LOOKUP.keys():
-                res_collection = merge_keywords_collections(res_collection, aggregate_keywords(ARCHIVE_LOOKUP[parent], depth), depth)
-        for distributor in entry.distributors:
-            if distributor in ARCHIVE_LOOKUP.keys():
-                res_collection = merge_keywords_collections(res_collection, aggregate_keywords(ARCHIVE_LOOKUP[distributor], depth), depth)
-        for label in entry.distributors:
-            if label in ARCHIVE_LOOKUP.keys():
-                res_collection = merge_keywords_collections(res_collection, aggregate_keywords(ARCHIVE_LOOKUP[label], depth), depth)
-
-    return res_collection
-
-
 def merge_keywords_collections(col1, col2, depth):
     res_collection = {
         'universal': 0,
@@ -470,62 +675,44 @@ def merge_keywords_collections(col1, col2, depth):
     return res_collection
 
 
-def aggregate_indi(entry: WikipediaEntry, depth=0):
-    if depth > MAX_DEPTH:
-        return False
-
-    if entry.contains_indi:
-        return True
-    else:
-        for parent in entry.parent_companies:
-            if parent in ARCHIVE_LOOKUP.keys():
-                if aggregate_indi(ARCHIVE_LOOKUP[parent], depth+1):
-                    return True
-        for distributor in entry.distributors:
-            if distributor in ARCHIVE_LOOKUP.keys():
-                if aggregate_indi(ARCHIVE_LOOKUP[distributor], depth + 1):
-                    return True
-        for label in entry.distributors:
-            if label in ARCHIVE_LOOKUP.keys():
-                if aggregate_indi(ARCHIVE_LOOKUP[label], depth+1):
-                    return True
-
-    return False
-
-
 def load_archives():
     global ARCHIVE_LOOKUP, ARCHIVE_URL_MAP
 
-    try:
-        with open(ARCHIVE_WIKIPEDIA_LOOKUP_PATH, 'rb+') as read_file:
-            ARCHIVE_LOOKUP = pickle.load(read_file)
-    except FileNotFoundError as e:
-        if DEBUG: print('No archive existed at', ARCHIVE_WIKIPEDIA_LOOKUP_PATH, ', creating an empty one.')
-        ARCHIVE_LOOKUP = {}
-    try:
-        with open(ARCHIVE_WIKIPEDIA_URL_MAP_PATH, 'rb+') as read_file:
-            ARCHIVE_URL_MAP = pickle.load(read_file)
-    except FileNotFoundError as e:
-        if DEBUG: print('No archive existed at', ARCHIVE_WIKIPEDIA_URL_MAP_PATH, ', creating an empty one.')
-        ARCHIVE_URL_MAP = {}
+    ARCHIVE_LOOKUP = archive_store.open_archive(ARCHIVE_WIKIPEDIA_LOOKUP_PATH, archive_store.encode_record,
+                                                archive_store.get_record_decoder(WikipediaEntry))
+    ARCHIVE_URL_MAP = archive_store.open_archive(ARCHIVE_WIKIPEDIA_URL_MAP_PATH)
+    if DEBUG: print('Opened archives', ARCHIVE_LOOKUP.store_path, 'and', ARCHIVE_URL_MAP.store_path)
+
+
+def checkpoint():
+    if DEBUG: print('checkpoint')
+    if SCHEDULER is not None:
+        SCHEDULER.report(force=True)
+    if RESULT_BUFFER is not None:
+        RESULT_BUFFER.flush()
+    save_archives()
 
 
 def save_archives():
+    # only the entries set since the last save are written
     if DEBUG: print('saving archives')
-    with open(ARCHIVE_WIKIPEDIA_LOOKUP_PATH, 'wb+') as write_file:
-        pickle.dump(ARCHIVE_LOOKUP, write_file)
-    with open(ARCHIVE_WIKIPEDIA_URL_MAP_PATH, 'wb+') as write_file:
-        pickle.dump(ARCHIVE_URL_MAP, write_file)
+    if ARCHIVE_LOOKUP is not None:
+        ARCHIVE_LOOKUP.checkpoint()
+    if ARCHIVE_URL_MAP is not None:
+        ARCHIVE_URL_MAP.checkpoint()
 
 
 def save_label_map():
     if DEBUG: print('save label map')
-    LABEL_MAP.to_csv(OUTPUT_LABEL_MAP_EXT, index=False)
-    LABEL_MAP[[RECORD_LABEL_LOW, 'occurrences', CLASS_TRIVIAL, CLASS_DISCOGS, CLASS_WIKIPEDIA]].to_csv(OUTPUT_LABEL_MAP, index=False)
+    if RESULT_BUFFER is not None:
+        RESULT_BUFFER.flush()
+    atomic_to_csv(LABEL_MAP, OUTPUT_LABEL_MAP_EXT, index=False)
+    atomic_to_csv(LABEL_MAP[[RECORD_LABEL_LOW, 'occurrences', CLASS_TRIVIAL, CLASS_DISCOGS, CLASS_WIKIPEDIA]], OUTPUT_LABEL_MAP, index=False)
+    LABEL_MAP_JOURNAL.clear()
 
 
-def main(debug=None, max_depth=6, restart=False):
-    global DEBUG, MAX_DEPTH
+def main(debug=None, max_depth=6, restart=False, offline=None):
+    global DEBUG, MAX_DEPTH, WIKI_OFFLINE, WIKIPEDIA_DUMP
 
     print()
     print('##########################################################')
@@ -535,6 +722,13 @@ def main(debug=None, max_depth=6, restart=False):
     if debug is not None:
         DEBUG = debug
     MAX_DEPTH = max_depth
+    if offline is not None:
+        WIKI_OFFLINE = offline
+    if WIKI_OFFLINE:
+        WIKIPEDIA_DUMP = wikipedia_dump.open_dump()
+        if WIKIPEDIA_DUMP is None:
+            return -1
+        print('Read pages offline from', WIKIPEDIA_DUMP.db_path)
 
     if restart:
         print('PURGING ALL WIKI FILES')
@@ -546,14 +740,9 @@ def main(debug=None, max_depth=6, restart=False):
             os.remove(OUTPUT_LABEL_MAP)
         except FileNotFoundError:
             pass
-        try:
-            os.remove(ARCHIVE_WIKIPEDIA_URL_MAP_PATH)
-        except FileNotFoundError:
-            pass
-        try:
-            os.remove(ARCHIVE_WIKIPEDIA_LOOKUP_PATH)
-        except FileNotFoundError:
-            pass
+        archive_store.remove_archive(ARCHIVE_WIKIPEDIA_URL_MAP_PATH)
+        archive_store.remove_archive(ARCHIVE_WIKIPEDIA_LOOKUP_PATH)
+        LABEL_MAP_JOURNAL.clear()
 
     load_archives()
     # generate_major_entries()
@@ -570,6 +759,5 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         print('Keyboard Interrupt')
-        save_label_map()
-        save_archives()
+        checkpoint()
         sys.exit(-1)
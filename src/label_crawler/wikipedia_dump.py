@@ -0,0 +1,225 @@
+import sys
+import os
+import re
+import bz2
+import gzip
+import zlib
+import sqlite3
+import threading
+import xml.etree.ElementTree as ElementTree
+from tqdm import tqdm
+
+from src import constants
+
+""" Offline Wikipedia pages from the pages-articles dump
+
+Wikipedia publishes all articles as enwiki-<date>-pages-articles.xml.bz2 (https://dumps.wikimedia.org/enwiki/). ingest()
+streams the xml (or a pre-filtered subset of it in the same format, also uncompressed) into a SQLite file with one row
+per article of the main namespace: its title, the title it redirects to and its compressed wikitext. All titles,
+including redirects, are indexed for a full text search (FTS5). With --infobox-only only articles with an infobox,
+disambiguation pages and the redirects are kept, which is all the wikipedia crawler reads (disambiguation pages are
+flagged like in online mode).
+With WIKI_OFFLINE the wikipedia crawler reads pages and searches labels in this file instead of sending requests:
+    get_page()...   wikitext of a title, redirects are followed, None if there is no such page
+    search()...     titles of the best matches for a search string, like the search of the wikipedia api: titles
+                    which are the search string first, then titles ranked by bm25 (FTS5)
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+WIKIPEDIA_DUMP_PATH = constants.WIKIPEDIA_DUMP_PATH
+WIKIPEDIA_DUMP_DB_PATH = constants.WIKIPEDIA_DUMP_DB_PATH
+
+# pages inserted at once
+INSERT_BULK_SIZE = 10000
+# redirects followed at most, longer chains are cycles or broken
+MAX_REDIRECTS = 5
+# search results returned by default, the wikipedia api returns 10 as well
+SEARCH_LIMIT = 10
+
+INFOBOX_PATTERN = re.compile(r'\{\{\s*infobox', re.IGNORECASE)
+DISAMBIGUATION_PATTERN = re.compile(r'\{\{\s*(disambiguation|disambig|dab|hndis|geodis|surname|given name)\s*[|}]',
+                                    re.IGNORECASE)
+TOKEN_PATTERN = re.compile(r'\w+')
+# tokens appended to the label names by the wikipedia crawler (see clean_label), titles do not have to contain them
+OPTIONAL_TOKENS = ['records', 'record', 'recordings', 'recording']
+
+
+def get_title_key(title):
+    # titles are compared like mediawiki does: underscores are spaces and the first letter is upper case
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+def ingest(dump_path=WIKIPEDIA_DUMP_PATH, db_path=WIKIPEDIA_DUMP_DB_PATH, infobox_only=False):
+    print('Ingest Wikipedia pages from', dump_path)
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    connection.execute('CREATE TABLE pages (title TEXT PRIMARY KEY, redirect TEXT, wikitext BLOB) WITHOUT ROWID')
+    connection.execute('CREATE VIRTUAL TABLE titles USING fts5(title)')
+
+    rows = []
+    for title, redirect, wikitext in tqdm(iter_dump_pages(dump_path)):
+        if redirect is None and infobox_only and not is_crawled_page(wikitext):
+            continue
+        rows.append((title, redirect, zlib.compress(wikitext.encode('utf-8')) if redirect is None else None))
+        if len(rows) >= INSERT_BULK_SIZE:
+            insert_pages(connection, rows)
+            rows = []
+    insert_pages(connection, rows)
+
+    page_count = connection.execute('SELECT COUNT(*) FROM pages WHERE redirect IS NULL').fetchone()[0]
+    redirect_count = connection.execute('SELECT COUNT(*) FROM pages WHERE redirect IS NOT NULL').fetchone()[0]
+    connection.close()
+    os.replace(tmp_path, db_path)
+    print('Saved', page_count, 'pages and', redirect_count, 'redirects to', db_path)
+
+
+def insert_pages(connection, rows):
+    connection.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', rows)
+    connection.executemany('INSERT INTO titles (title) VALUES (?)', [(row[0],) for row in rows])
+    connection.commit()
+
+
+'''
+Streams the pages of the main namespace of the dump as (title, title of the redirect or None, wikitext). Parsed pages are
+cleared, so memory does not grow with the size of the dump. The xml namespace of the export format changes with its
+version, tags are compared without it.
+'''
+def iter_dump_pages(dump_path=WIKIPEDIA_DUMP_PATH):
+    if dump_path.endswith('.bz2'):
+        dump_file = bz2.open(dump_path, 'rb')
+    elif dump_path.endswith('.gz'):
+        dump_file = gzip.open(dump_path, 'rb')
+    else:
+        dump_file = open(dump_path, 'rb')
+
+    with dump_file:
+        root = None
+        for event, element in ElementTree.iterparse(dump_file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                continue
+            if get_tag(element) != 'page':
+                continue
+
+            fields = {get_tag(child): child for child in element}
+            if fields.get('ns') is not None and fields['ns'].text == '0':
+                redirect = fields.get('redirect')
+                text = element.find('./{*}revision/{*}text')
+                yield (get_title_key(fields['title'].text),
+                       get_title_key(redirect.get('title')) if redirect is not None else None,
+                       text.text if text is not None and text.text is not None else '')
+            root.clear()
+
+
+def get_tag(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def get_query(tokens, operator):
+    # FTS5 query of the tokens joined by AND or OR, they are quoted so tokens like 'and' or 'or' are no operators
+    return (' ' + operator + ' ').join('"' + token + '"' for token in tokens)
+
+
+def is_disambiguation(wikitext):
+    return DISAMBIGUATION_PATTERN.search(wikitext) is not None
+
+
+def is_crawled_page(wikitext):
+    # pages with an infobox are read by the crawler, disambiguation pages are needed to flag search results
+    return INFOBOX_PATTERN.search(wikitext) is not None or is_disambiguation(wikitext)
+
+
+class WikipediaDump:
+    def __init__(self, db_path=WIKIPEDIA_DUMP_DB_PATH):
+        self.db_path = db_path
+        # read only, a missing file is not created. Queries are serialized, so the dump can be shared by threads
+        self.connection = sqlite3.connect('file:' + db_path + '?mode=ro', uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def resolve_title(self, title):
+        # (title of the page after its redirects, compressed wikitext), None if there is no such page
+        title = get_title_key(title)
+        with self.lock:
+            for _ in range(MAX_REDIRECTS + 1):
+                row = self.connection.execute('SELECT redirect, wikitext FROM pages WHERE title = ?', (title,)).fetchone()
+                if row is None:
+                    return None
+                if row[0] is None:
+                    return title, row[1]
+                title = row[0]
+        if DEBUG: print('Too many redirects at', title)
+        return None
+
+    def get_page(self, title):
+        # wikitext of a title, redirects are followed
+        resolved = self.resolve_title(title)
+        if resolved is None:
+            return None
+        return zlib.decompress(resolved[1]).decode('utf-8')
+
+    def get_page_title(self, title):
+        # title of the page a title redirects to, the title itself if it's no redirect
+        resolved = self.resolve_title(title)
+        return resolved[0] if resolved is not None else None
+
+    def search(self, search_string, limit=SEARCH_LIMIT):
+        # titles (pages and redirects), best matches first: titles which are the search string with or without its
+        # optional tokens, titles with all tokens, titles with all tokens which are not optional and titles with any of
+        # them ('sony music records' -> 'Sony Music', 'Sony Music Records', ..., 'Sony Music Entertainment', ...)
+        tokens = TOKEN_PATTERN.findall(search_string.lower())
+        if len(tokens) == 0:
+            return []
+        label_tokens = [token for token in tokens if token not in OPTIONAL_TOKENS]
+        if len(label_tokens) == 0:
+            label_tokens = tokens
+
+        # dict: <title, None>, keeps the order of the results
+        results = {}
+        for exact_tokens in [tokens, label_tokens]:
+            for title in self.match('"' + ' '.join(exact_tokens) + '"', limit):
+                if TOKEN_PATTERN.findall(title.lower()) == exact_tokens:
+                    results[title] = None
+        for query in [get_query(tokens, 'AND'), get_query(label_tokens, 'AND'), get_query(label_tokens, 'OR')]:
+            if len(results) >= limit:
+                break
+            results.update(dict.fromkeys(self.match(query, limit)))
+        return list(results.keys())[:limit]
+
+    def match(self, query, limit):
+        # titles which match a FTS5 query, ranked by bm25
+        with self.lock:
+            rows = self.connection.execute('SELECT title FROM titles WHERE titles MATCH ? ORDER BY rank LIMIT ?',
+                                           (query, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+def open_dump(db_path=WIKIPEDIA_DUMP_DB_PATH):
+    if not os.path.exists(db_path):
+        print('No ingested Wikipedia dump at', db_path, '- run wikipedia_dump.py first')
+        return None
+    return WikipediaDump(db_path)
+
+
+def main():
+    # wikipedia_dump.py [dump path] [--infobox-only]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    ingest(args[0] if len(args) > 0 else WIKIPEDIA_DUMP_PATH, infobox_only='--infobox-only' in sys.argv)
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt')
+        sys.exit(-1)
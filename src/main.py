@@ -5,13 +5,15 @@ from src.preprocessing_spotify import run_preprocessing
 from src.label_crawler import run_label_crawler
 
 
-def main(path_to_label_map=None, track_start=False, analysis=False, debug=False):
+def main(path_to_label_map=None, track_start=False, analysis=False, debug=False, concurrent=False, cache_only=False,
+         pipeline=False):
     if track_start:
         print('Start from list of track_uris')
     else:
         print('Start from list of album_uris')
     run_preprocessing.main(path_to_label_map=path_to_label_map, start_from_track_uris=track_start,
-                           run_analysis=analysis, skip_preprocessing=skip_preprocessing, debug=debug)
+                           run_analysis=analysis, skip_preprocessing=skip_preprocessing, debug=debug,
+                           spotify_async=concurrent, spotify_cache_only=cache_only, spotify_pipeline=pipeline)
 
     run_label_crawler.main(run_analysis=analysis, track_start=track_start, debug=debug)
 
@@ -19,8 +21,9 @@ def main(path_to_label_map=None, track_start=False, analysis=False, debug=False)
 if __name__ == "__main__":
 
     argument_list = sys.argv[1:]
-    options = 'darts'
-    long_options = ['debug', 'analysis', 'reuse_label_map=', 'track_start', 'skip_preprocessing']
+    options = 'dartscop'
+    long_options = ['debug', 'analysis', 'reuse_label_map=', 'track_start', 'skip_preprocessing', 'concurrent',
+                    'cache_only', 'pipeline']
 
     try:
         arguments, values = getopt.getopt(argument_list, options, long_options)
@@ -29,6 +32,9 @@ if __name__ == "__main__":
         run_analysis = False
         debug = False
         skip_preprocessing = False
+        concurrent = False
+        cache_only = False
+        pipeline = False
 
         for curr_arg, curr_value in arguments:
             if curr_arg in ('-d', '--debug'):
@@ -41,8 +47,14 @@ if __name__ == "__main__":
                 path_to_label_map = curr_value
             if curr_arg in ('-t', '--track_start'):
                 track_start = True
+            if curr_arg in ('-c', '--concurrent'):
+                concurrent = True
+            if curr_arg in ('-o', '--cache_only'):
+                cache_only = True
+            if curr_arg in ('-p', '--pipeline'):
+                pipeline = True
 
-        main(path_to_label_map, track_start, run_analysis, debug)
+        main(path_to_label_map, track_start, run_analysis, debug, concurrent, cache_only, pipeline)
 
     except getopt.error as err:
         print(str(err))
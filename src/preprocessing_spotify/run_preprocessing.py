@@ -3,6 +3,7 @@ import sys
 
 from src.preprocessing_spotify import spotify_album_crawler
 from src.preprocessing_spotify import spotify_record_label_crawler
+from src.preprocessing_spotify import spotify_track_pipeline
 from src.preprocessing_spotify import spotify_crawler_postprocessing
 from src.preprocessing_spotify import spotify_crawler_analysis
 
@@ -21,9 +22,20 @@ SKIP_PREPROCESSING = False
 # show or hide detailed output of crawler steps
 DEBUG = False
 
+# send spotify bulk requests concurrently (see constants.SPOTIFY_MAX_IN_FLIGHT and SPOTIFY_RATE_LIMIT)
+SPOTIFY_ASYNC = False
 
-def main(path_to_label_map=None, start_from_track_uris=None, run_analysis=None, debug=None):
-    global START_FROM_TRACK_URIS, PATH_TO_LABEL_MAP, RUN_ANALYSIS, DEBUG
+# only use the persistent spotify response cache, no request is sent to spotify (see constants.SPOTIFY_CACHE_PATH)
+SPOTIFY_CACHE_ONLY = False
+
+# for track based runs: look up the albums while the tracks are still being resolved (see spotify_track_pipeline),
+# requests are always sent concurrently in this mode
+SPOTIFY_PIPELINE = False
+
+
+def main(path_to_label_map=None, start_from_track_uris=None, run_analysis=None, debug=None, spotify_async=None,
+         spotify_cache_only=None, spotify_pipeline=None):
+    global START_FROM_TRACK_URIS, PATH_TO_LABEL_MAP, RUN_ANALYSIS, DEBUG, SPOTIFY_ASYNC, SPOTIFY_CACHE_ONLY, SPOTIFY_PIPELINE
 
     if start_from_track_uris is not None:
         START_FROM_TRACK_URIS = start_from_track_uris
@@ -33,13 +45,24 @@ def main(path_to_label_map=None, start_from_track_uris=None, run_analysis=None,
         RUN_ANALYSIS = run_analysis
     if debug is not None:
         DEBUG = debug
+    if spotify_async is not None:
+        SPOTIFY_ASYNC = spotify_async
+    if spotify_cache_only is not None:
+        SPOTIFY_CACHE_ONLY = spotify_cache_only
+    if spotify_pipeline is not None:
+        SPOTIFY_PIPELINE = spotify_pipeline
+
+    if START_FROM_TRACK_URIS and SPOTIFY_PIPELINE and not SPOTIFY_CACHE_ONLY:
+        print('Run streaming spotify pipeline for track_uri to album_uri to label- and copyright info')
+        spotify_track_pipeline.main(debug=DEBUG)
+    else:
+        if START_FROM_TRACK_URIS:
+            print('Run spotify crawler for track_uri to album_uri ')
+            spotify_album_crawler.main(debug=DEBUG, spotify_async=SPOTIFY_ASYNC, spotify_cache_only=SPOTIFY_CACHE_ONLY)
 
-    if START_FROM_TRACK_URIS:
-        print('Run spotify crawler for track_uri to album_uri ')
-        spotify_album_crawler.main(debug=DEBUG)
-
-    print('Run spotify crawler for album_uri to label- and copyright info')
-    spotify_record_label_crawler.main(debug=DEBUG)
+        print('Run spotify crawler for album_uri to label- and copyright info')
+        spotify_record_label_crawler.main(debug=DEBUG, spotify_async=SPOTIFY_ASYNC,
+                                          spotify_cache_only=SPOTIFY_CACHE_ONLY)
 
     if PATH_TO_LABEL_MAP is not None:
         print('Create low-level record label list and fill with classification from', PATH_TO_LABEL_MAP)
@@ -54,8 +77,8 @@ def main(path_to_label_map=None, start_from_track_uris=None, run_analysis=None,
 
 if __name__ == "__main__":
     argument_list = sys.argv[1:]
-    options = 'dtra'
-    long_options = ['debug', 'track_start', 'reuse_label_map=', 'run_analysis']
+    options = 'dtracop'
+    long_options = ['debug', 'track_start', 'reuse_label_map=', 'run_analysis', 'concurrent', 'cache_only', 'pipeline']
 
     try:
         arguments, values = getopt.getopt(argument_list, options, long_options)
@@ -75,6 +98,15 @@ if __name__ == "__main__":
                 print('Using existing label map at:', curr_value)
                 RUN_ANALYSIS = True
 
+            if curr_arg in ('-c', '--concurrent'):
+                SPOTIFY_ASYNC = True
+
+            if curr_arg in ('-o', '--cache_only'):
+                SPOTIFY_CACHE_ONLY = True
+
+            if curr_arg in ('-p', '--pipeline'):
+                SPOTIFY_PIPELINE = True
+
         main()
 
     except getopt.error as err:
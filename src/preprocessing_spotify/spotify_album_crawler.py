@@ -2,11 +2,19 @@ import spotipy
 import sys
 import os
 import pandas as pd
+import numpy as np
 from spotipy.oauth2 import SpotifyClientCredentials
 from tqdm import tqdm
 
 from src import spotify_credentials
 from src import constants
+from src.preprocessing_spotify import spotify_async_client
+from src.preprocessing_spotify import spotify_bulk_lookup
+from src.preprocessing_spotify.spotify_response_cache import SpotifyResponseCache, CachedSpotify
+from src.utils.result_buffer import ResultBuffer
+from src.utils import track_album_index
+from src.utils.crawl_scheduler import CrawlScheduler
+from src.utils.checkpoint_journal import RowJournal, atomic_to_csv
 
 # get constants
 DEBUG = constants.DEBUG
@@ -16,6 +24,11 @@ SAVING_STEP = constants.SAVING_STEP
 TRACK_REQUEST_BULK_SIZE = constants.ALBUM_REQUEST_BULK_SIZE
 BULK_FAILED_FLAG = constants.BULK_FAILED_FLAG
 FAILED_LOOKUP_FLAG = constants.FAILED_LOOKUP_FLAG
+SPOTIFY_ASYNC = constants.SPOTIFY_ASYNC
+SPOTIFY_MAX_IN_FLIGHT = constants.SPOTIFY_MAX_IN_FLIGHT
+SPOTIFY_CACHE = constants.SPOTIFY_CACHE
+SPOTIFY_CACHE_ONLY = constants.SPOTIFY_CACHE_ONLY
+TRACK_ALBUM_INDEX = constants.TRACK_ALBUM_INDEX
 
 TRACK_URI = constants.TRACK_URI
 ALBUM_URI = constants.ALBUM_URI
@@ -26,77 +39,218 @@ OUTPUT_TRACK_URIS = constants.OUTPUT_TRACK_URIS
 OUTPUT_SORTED_ALBUM_URIS = constants.SORTED_ALBUM_URIS
 
 track_uri_df = pd.DataFrame()
+result_buffer = None
+# results since the last full save of the output csv, replayed when a run is resumed
+journal = RowJournal(OUTPUT_TRACK_URIS, TRACK_URI)
+spotify_cache = None
+scheduler = None
+# dict: <track_uri, position> of tracks whose bulk failed, they are retried in the final pass
+failure_queue = {}
+final_pass = False
+bulk_errors = 0
+lookup_errors = 0
+bulk_counter = 0
 
 
 def run_spotify_api_lookup_for_tracks(index_from=-1):
-    global track_uri_df
+    print('Start Spotify API lookup for albums on', INPUT_TRACK_URIS)
+    prepare_lookup(index_from)
+    create_scheduler()
 
-    spotify = get_spotipy_client()
+    if SPOTIFY_CACHE_ONLY:
+        print('Cache only mode, skip', get_pending_mask(index_from).sum() + len(failure_queue), 'tracks which are not cached')
+    else:
+        spotify = get_cached_spotipy_client()
+        run_bulks(spotify, scheduler.bulks(track_uri_df[TRACK_URI].values, get_pending_mask(index_from),
+                                           TRACK_REQUEST_BULK_SIZE))
+        result_buffer.flush()
+
+        if DEBUG: print('Rerun spotify requests for', len(failure_queue), 'tracks of failed bulk requests')
+        run_bulks(spotify, tqdm(scheduler.limit(start_final_pass())))
+        result_buffer.flush()
+    close_cache()
+
+    if DEBUG: print('final save, bulk_errors:', bulk_errors, ', lookup_errors:', lookup_errors)
+    save_album_uri_df()
+    create_sorted_album_uri_list()
+
+
+def prepare_lookup(index_from):
+    global result_buffer, spotify_cache, scheduler, failure_queue, final_pass, bulk_errors, lookup_errors, bulk_counter
+
+    scheduler = None
+    result_buffer = ResultBuffer(track_uri_df, [ALBUM_URI], journal)
+    replayed_rows = journal.replay(track_uri_df)
+    if DEBUG: print('Replayed', replayed_rows, 'rows from', journal.path)
+
+    # uris which are no valid spotify track uris would only poison the bulks they are sent in
+    invalid_mask = get_pending_mask(index_from) & spotify_bulk_lookup.get_invalid_uri_mask(track_uri_df[TRACK_URI], 'track')
+    if DEBUG: print('Invalid track uris:', invalid_mask.sum())
+    track_uri_df.loc[invalid_mask, ALBUM_URI] = FAILED_LOOKUP_FLAG
+
+    # tracks which failed in a previous run are retried together with the failures of this run
+    failed_mask = (track_uri_df[ALBUM_URI] == BULK_FAILED_FLAG) & (track_uri_df.index >= index_from)
+    failure_queue = dict(zip(track_uri_df.loc[failed_mask, TRACK_URI].values, np.flatnonzero(failed_mask.values)))
+
+    if TRACK_ALBUM_INDEX:
+        lookup_track_album_index(index_from)
 
-    print('Start Spotify API lookup for albums on', INPUT_TRACK_URIS)
-    track_uri_bulk = {}
     bulk_errors = 0
-    for index, entry in tqdm(track_uri_df.iterrows(), total=track_uri_df.shape[0]):
-        if index >= index_from and pd.isna(entry[ALBUM_URI]) and entry[ALBUM_URI] != BULK_FAILED_FLAG:
-            if len(track_uri_bulk) < TRACK_REQUEST_BULK_SIZE:
-                track_uri_bulk[entry[TRACK_URI]] = index
-            else:
-                try:
-                    res = spotify.tracks(track_uri_bulk.keys())
-                    if DEBUG: print('req:', track_uri_bulk.keys())
-                    for track in res['tracks']:
-                        # if a single album of the result is none, find all albums without low label and set bulk failed
-                        # lookup flag
-                        if track is None:
-                            for key in track_uri_bulk.keys():
-
-                                if pd.isna(track_uri_df.loc[track_uri_bulk[key], ALBUM_URI]):
-                                    track_uri_df.loc[track_uri_bulk[key], ALBUM_URI] = BULK_FAILED_FLAG
-                                    bulk_errors += 1
-                        # else assign it normally
-                        else:
-                            track_uri = track['uri']
-                            track_uri_df.loc[track_uri_bulk[track_uri], ALBUM_URI] = track['album']['uri']
-
-                            if DEBUG:
-                                print('Current album: ', track_uri,'(', track_uri_bulk[track_uri], ') --> ', track['album']['name'])
-                except Exception as e:
-                    if DEBUG: print('Bulk error', e)
-                    for key in track_uri_bulk.keys():
-                        track_uri_df.loc[track_uri_bulk[key], ALBUM_URI] = BULK_FAILED_FLAG
-                    bulk_errors += 1
-
-                track_uri_bulk.clear()
-                track_uri_bulk[entry[TRACK_URI]] = index
-
-        if index >= index_from and index % SAVING_STEP == 0:
-            if DEBUG: print('saving at', index, ', bulk_errors: ', bulk_errors)
-            save_album_uri_df()
-
-    if DEBUG: print('Rerun spotify requests for failed bulk requests individually')
     lookup_errors = 0
-    lookup_counter = 1
-    for index, entry in tqdm(track_uri_df.iterrows(), total=track_uri_df.shape[0]):
-        if index >= index_from and (entry[ALBUM_URI] == BULK_FAILED_FLAG or pd.isna(entry[ALBUM_URI])):
-            lookup_counter += 1
-            try:
-                res = spotify.track(entry[TRACK_URI])
-                track_uri_df.loc[index, ALBUM_URI] = res['album']['uri']
+    bulk_counter = 0
+    final_pass = False
+    spotify_cache = SpotifyResponseCache() if SPOTIFY_CACHE or SPOTIFY_CACHE_ONLY else None
+    if spotify_cache is not None:
+        # cached tracks are resolved first, without sending a request or using up the rate limit
+        cached_mask = get_pending_mask(index_from) & track_uri_df[TRACK_URI].isin(spotify_cache.get_cached_uris('track'))
+        if DEBUG: print('Look up', cached_mask.sum(), 'tracks in cache', spotify_cache.path)
+        spotify_bulk_lookup.run_bulks(CachedSpotify(None, spotify_cache), generate_track_uri_bulks(cached_mask), 'tracks',
+                                      on_bulk_result, on_bulk_error)
+        result_buffer.flush()
+
+
+def lookup_track_album_index(index_from):
+    index = track_album_index.open_index()
+    if index is None:
+        return
+
+    # tracks of the MPD are resolved from the index, only the remaining ones are requested from spotify
+    pending_mask = get_pending_mask(index_from) | track_uri_df[TRACK_URI].isin(failure_queue.keys())
+    pending_track_uris = track_uri_df.loc[pending_mask, TRACK_URI].values
+    indexed_albums = index.get_albums(pending_track_uris)
+    index.close()
+    for track_uri, position in zip(pending_track_uris, np.flatnonzero(pending_mask.values)):
+        album_uri = indexed_albums.get(track_uri)
+        if album_uri is not None:
+            result_buffer.set(position, ALBUM_URI, album_uri)
+            failure_queue.pop(track_uri, None)
+    result_buffer.flush()
+    if DEBUG: print('Resolved', len(indexed_albums), 'of', len(pending_track_uris), 'tracks from', index.index_path)
+
+
+def create_scheduler():
+    global scheduler
+
+    # tracks are requested by descending occurrences, tracks with an album (e.g. from the cache) count for the coverage
+    scheduler = CrawlScheduler(track_uri_df[OCC].values,
+                               track_uri_df[ALBUM_URI].astype(str).str.startswith('spotify:album:').values, 'album')
+    return scheduler
+
+
+def start_final_pass():
+    global failure_queue, final_pass
+
+    # all failed bulks are requested once more, errors in the final pass are bisected as well
+    final_pass = True
+    failed_track_uri_bulks = spotify_bulk_lookup.chunk_bulks(list(failure_queue.items()), TRACK_REQUEST_BULK_SIZE)
+    failure_queue = {}
+    return failed_track_uri_bulks
+
+
+def close_cache():
+    global spotify_cache
+
+    if spotify_cache is not None:
+        spotify_cache.close()
+        spotify_cache = None
+
+
+def run_bulks(spotify, track_uri_bulks):
+    if SPOTIFY_ASYNC:
+        if DEBUG: print('Run bulks asynchronously with', SPOTIFY_MAX_IN_FLIGHT, 'requests in flight')
+        spotify_async_client.run_bulks(track_uri_bulks, 'tracks', on_bulk_result, on_bulk_error,
+                                       max_in_flight=SPOTIFY_MAX_IN_FLIGHT,
+                                       client_factory=get_cached_async_spotipy_client, count_request=count_request)
+    else:
+        spotify_bulk_lookup.run_bulks(spotify, track_uri_bulks, 'tracks', on_bulk_result, on_bulk_error, count_request)
 
-                if DEBUG:
-                    print('Successful lookup for:', res['name'], ' --> ', res['album']['name'])
-            except Exception as e:
-                print('Error for', entry[TRACK_URI], ': ', e)
-                track_uri_df.loc[index, ALBUM_URI] = FAILED_LOOKUP_FLAG
-                lookup_errors += 1
 
-        if index >= index_from and lookup_counter % SAVING_STEP == 0:
-            if DEBUG: print('saving after', lookup_counter, ', errors: ', lookup_errors)
-            save_album_uri_df()
+def count_request():
+    if scheduler is not None:
+        scheduler.count_request()
 
-    if DEBUG: print('final save')
-    save_album_uri_df()
-    create_sorted_album_uri_list()
+
+def get_pending_mask(index_from):
+    return track_uri_df[ALBUM_URI].isna() & (track_uri_df.index >= index_from)
+
+
+def generate_track_uri_bulks(pending_mask):
+    pending_track_uris = track_uri_df.loc[pending_mask, TRACK_URI].values
+
+    return spotify_bulk_lookup.chunk_bulks(
+        tqdm(zip(pending_track_uris, np.flatnonzero(pending_mask.values)), total=len(pending_track_uris)),
+        TRACK_REQUEST_BULK_SIZE)
+
+
+def on_bulk_result(track_uri_bulk, res):
+    global lookup_errors
+
+    unresolved_bulk = dict(track_uri_bulk)
+    not_found_count = 0
+    try:
+        for track in res['tracks']:
+            # tracks which are not found are none, they stay unresolved
+            if track is None:
+                not_found_count += 1
+                continue
+
+            # relinked tracks are answered with the uri of the playable track, the requested one is in 'linked_from'
+            track_uri = track['linked_from']['uri'] if track.get('linked_from') else track['uri']
+            if track_uri in unresolved_bulk:
+                position = unresolved_bulk.pop(track_uri)
+                result_buffer.set(position, ALBUM_URI, track['album']['uri'])
+                if scheduler is not None:
+                    scheduler.resolve(position)
+
+                if DEBUG:
+                    print('Current album: ', track_uri, '(', track_uri_bulk[track_uri], ') --> ', track['album']['name'])
+    except Exception as e:
+        return on_bulk_error(track_uri_bulk, e)
+
+    on_bulk_done()
+    if len(unresolved_bulk) == 0:
+        return []
+
+    # a track which can't be found on its own or which is the only one not found in its bulk doesn't exist (anymore),
+    # the others are bisected until they're isolated
+    if len(unresolved_bulk) == 1 and (len(track_uri_bulk) == 1 or not_found_count == 1):
+        if DEBUG: print('Track not found:', next(iter(unresolved_bulk)))
+        result_buffer.set(next(iter(unresolved_bulk.values())), ALBUM_URI, FAILED_LOOKUP_FLAG)
+        lookup_errors += 1
+        return []
+    # a single track answered with another id than the requested one is requested again on its own
+    if len(unresolved_bulk) == 1:
+        return [unresolved_bulk]
+    return spotify_bulk_lookup.split_bulk(unresolved_bulk)
+
+
+def on_bulk_error(track_uri_bulk, e):
+    global bulk_errors, lookup_errors
+
+    if DEBUG: print('Bulk error', e)
+    if len(track_uri_bulk) > 1 and (final_pass or spotify_bulk_lookup.is_poisoned_bulk_error(e)):
+        return spotify_bulk_lookup.split_bulk(track_uri_bulk)
+
+    # other errors (e.g. connection errors) are retried once more in the final pass, after that the lookup failed
+    for track_uri, position in track_uri_bulk.items():
+        if final_pass:
+            result_buffer.set(position, ALBUM_URI, FAILED_LOOKUP_FLAG)
+            lookup_errors += 1
+        else:
+            result_buffer.set(position, ALBUM_URI, BULK_FAILED_FLAG)
+            failure_queue[track_uri] = position
+    bulk_errors += 1
+    on_bulk_done()
+    return []
+
+
+def on_bulk_done():
+    global bulk_counter
+
+    bulk_counter += 1
+    if (bulk_counter * TRACK_REQUEST_BULK_SIZE) % SAVING_STEP == 0:
+        if DEBUG: print('checkpoint after', bulk_counter, 'bulks, bulk_errors: ', bulk_errors)
+        result_buffer.flush()
 
 
 def get_spotipy_client():
@@ -113,6 +267,16 @@ def get_spotipy_client():
     return spotify
 
 
+def get_cached_spotipy_client():
+    spotify = get_spotipy_client()
+    return spotify if spotify_cache is None else CachedSpotify(spotify, spotify_cache)
+
+
+def get_cached_async_spotipy_client():
+    spotify = spotify_async_client.get_spotipy_client()
+    return spotify if spotify_cache is None else CachedSpotify(spotify, spotify_cache)
+
+
 def create_sorted_album_uri_list(sorted_album_uris_path=OUTPUT_SORTED_ALBUM_URIS):
     if DEBUG: print('Create sorted list of album_uris from <track_uri, album_uri> map at', sorted_album_uris_path)
     sorted_album_df = track_uri_df.drop([TRACK_URI], axis=1)
@@ -124,7 +288,10 @@ def create_sorted_album_uri_list(sorted_album_uris_path=OUTPUT_SORTED_ALBUM_URIS
 
 
 def save_album_uri_df(output_path=OUTPUT_TRACK_URIS):
-    track_uri_df.to_csv(output_path, index=False)
+    if result_buffer is not None:
+        result_buffer.flush()
+    atomic_to_csv(track_uri_df, output_path, index=False)
+    journal.clear()
 
 
 def load_df():
@@ -137,11 +304,15 @@ def load_df():
         track_uri_df = pd.read_csv(INPUT_TRACK_URIS)
 
 
-def main(debug=None):
-    global DEBUG
+def main(debug=None, spotify_async=None, spotify_cache_only=None):
+    global DEBUG, SPOTIFY_ASYNC, SPOTIFY_CACHE_ONLY
 
     if debug is not None:
         DEBUG = debug
+    if spotify_async is not None:
+        SPOTIFY_ASYNC = spotify_async
+    if spotify_cache_only is not None:
+        SPOTIFY_CACHE_ONLY = spotify_cache_only
 
     load_df()
     run_spotify_api_lookup_for_tracks()
@@ -152,7 +323,8 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         print('Keyboard Interrupt')
-        print('Saving current df to: ', OUTPUT_TRACK_URIS)
-        save_album_uri_df()
+        print('Saving results since the last checkpoint to: ', journal.path)
+        if result_buffer is not None:
+            result_buffer.flush()
         sys.exit(-1)
 
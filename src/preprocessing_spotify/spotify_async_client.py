@@ -0,0 +1,216 @@
+import asyncio
+import time
+import requests
+import spotipy
+from concurrent.futures import ThreadPoolExecutor
+from spotipy.oauth2 import SpotifyClientCredentials
+
+from src import spotify_credentials
+from src import constants
+
+""" Asynchronous spotify client
+
+Sends bulk requests (spotify.albums / spotify.tracks) concurrently instead of one after another:
+    max_in_flight...    number of bulk requests which are waiting for a response at the same time
+    rate_limit...       requests per second shared by all in-flight requests (token bucket)
+    rate_burst...       max. number of requests which can be sent at once after an idle period
+A 429 response pauses the whole bucket for 'Retry-After' seconds before the bulk is retried.
+
+The spotipy calls themselves are blocking, hence each of them runs in its own worker thread with its own client and
+session. All result callbacks are called from the event loop, so they never run at the same time.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+MAX_IN_FLIGHT = constants.SPOTIFY_MAX_IN_FLIGHT
+RATE_LIMIT = constants.SPOTIFY_RATE_LIMIT
+RATE_BURST = constants.SPOTIFY_RATE_BURST
+MAX_RETRIES = constants.SPOTIFY_MAX_RETRIES
+
+# used if a 429 response comes without a (valid) 'Retry-After' header
+DEFAULT_RETRY_AFTER_S = 1
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        # the lock has to be created inside the running event loop
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block_for(self, seconds):
+        # a rate limited response blocks all requests sharing this bucket, not only the one which got the 429
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class AsyncSpotifyClient:
+    def __init__(self, client_factory=None, max_in_flight=MAX_IN_FLIGHT, rate_limit=RATE_LIMIT, rate_burst=RATE_BURST):
+        client_factory = client_factory if client_factory is not None else get_spotipy_client
+        self.max_in_flight = max_in_flight
+        self.bucket = TokenBucket(rate_limit, rate_burst)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        # every in-flight request gets its own client, spotipy clients are not shared between threads
+        self.clients = asyncio.Queue()
+        for _ in range(max_in_flight):
+            self.clients.put_nowait(client_factory())
+
+        self.request_count = 0
+        self.rate_limited_count = 0
+
+    async def call(self, method, *args, count_request=None):
+        # count_request() is called for every request which is sent, retries of rate limited requests included
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            spotify = await self.clients.get()
+            try:
+                await self.bucket.acquire()
+                self.request_count += 1
+                if count_request is not None:
+                    count_request()
+                return await loop.run_in_executor(self.executor, getattr(spotify, method), *args)
+            except spotipy.SpotifyException as e:
+                if e.http_status != 429 or attempt >= MAX_RETRIES:
+                    raise
+                attempt += 1
+                self.rate_limited_count += 1
+                retry_after = get_retry_after(e)
+                if DEBUG: print('Rate limited, retry after', retry_after, 's (attempt', attempt, ')')
+                self.bucket.block_for(retry_after)
+            finally:
+                self.clients.put_nowait(spotify)
+
+    async def albums(self, album_uris):
+        return await self.call('albums', list(album_uris))
+
+    async def tracks(self, track_uris):
+        return await self.call('tracks', list(track_uris))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def get_retry_after(exception):
+    try:
+        return max(float(exception.headers.get('Retry-After')), 0)
+    except (AttributeError, TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER_S
+
+
+def get_spotipy_client():
+    # a plain session disables the urllib3 retries of spotipy, this way 429 responses reach the client together with
+    # their 'Retry-After' header instead of blocking a single worker thread
+    return spotipy.Spotify(
+        client_credentials_manager=SpotifyClientCredentials(
+            client_id=spotify_credentials.CLIENT_ID,
+            client_secret=spotify_credentials.CLIENT_SECRET
+        ),
+        requests_session=requests.Session()
+    )
+
+
+async def lookup_bulk(client, bulk, method, on_result, on_error, count_request=None):
+    try:
+        res = await client.call(method, list(bulk.keys()), count_request=count_request)
+    except Exception as e:
+        retry_bulks = on_error(bulk, e)
+    else:
+        retry_bulks = on_result(bulk, res)
+
+    # bulks returned by the callbacks (e.g. halves of a failed bulk) are requested before the next bulk is taken,
+    # the number of requests in flight is still limited by the client pool
+    if retry_bulks:
+        await asyncio.gather(*[lookup_bulk(client, retry_bulk, method, on_result, on_error, count_request)
+                               for retry_bulk in retry_bulks])
+
+
+'''
+Workers which run lookup(item) for the items put into their queue, until they get None. put() waits for a free place
+in the queue together with the running workers: a worker which dies (e.g. from an exception of a callback) raises its
+exception there instead of leaving the queue full forever. Has to be created inside the running event loop.
+'''
+class WorkerPool:
+    def __init__(self, lookup, worker_count, maxsize=0):
+        self.lookup = lookup
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = [asyncio.create_task(self.work()) for _ in range(worker_count)]
+
+    async def work(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            await self.lookup(item)
+
+    async def put(self, item):
+        put_task = asyncio.ensure_future(self.queue.put(item))
+        running = [task for task in self.workers if not task.done()]
+        while not put_task.done():
+            done, _ = await asyncio.wait([put_task] + running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not put_task and not task.cancelled() and task.exception() is not None:
+                    put_task.cancel()
+                    raise task.exception()
+            running = [task for task in running if not task.done()]
+        put_task.result()
+
+    def put_nowait(self, item):
+        # for unbounded queues, e.g. items which are found by the callbacks of another pool
+        self.queue.put_nowait(item)
+
+    async def join(self):
+        # waits until all items are looked up, the workers end afterwards
+        for _ in self.workers:
+            await self.put(None)
+        await asyncio.gather(*self.workers)
+
+    def cancel(self):
+        for task in self.workers:
+            task.cancel()
+
+
+async def _run_bulks(bulks, method, on_result, on_error, max_in_flight, client_factory, count_request):
+    client = AsyncSpotifyClient(client_factory=client_factory, max_in_flight=max_in_flight)
+
+    async def lookup(bulk):
+        await lookup_bulk(client, bulk, method, on_result, on_error, count_request)
+
+    pool = WorkerPool(lookup, max_in_flight, maxsize=2 * max_in_flight)
+    try:
+        for bulk in bulks:
+            await pool.put(bulk)
+        await pool.join()
+    finally:
+        pool.cancel()
+        client.close()
+
+    if DEBUG: print('Async lookup done:', client.request_count, 'requests,', client.rate_limited_count, 'rate limited')
+
+
+'''
+Sends all bulks (dicts of <uri, position>) with the given spotipy method ('albums' or 'tracks'). For every bulk either
+on_result(bulk, response) or on_error(bulk, exception) is called, in the order the responses arrive. Both callbacks
+return a list of bulks which are requested again (see spotify_bulk_lookup). count_request() is called for every request.
+'''
+def run_bulks(bulks, method, on_result, on_error, max_in_flight=MAX_IN_FLIGHT, client_factory=None, count_request=None):
+    asyncio.run(_run_bulks(bulks, method, on_result, on_error, max_in_flight, client_factory, count_request))
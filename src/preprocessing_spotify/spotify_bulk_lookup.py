@@ -0,0 +1,64 @@
+import spotipy
+
+from src import constants
+
+""" Bulk lookup helpers shared by the spotify crawlers
+
+Failed bulks are bisected instead of being retried uri by uri: a bulk which is rejected as a whole or which contains
+unresolved uris is split in two halves which are requested again, until the failing uri is isolated in a bulk of
+size one. Callbacks return the list of bulks (dicts of <uri, position>) which have to be requested again.
+"""
+
+SPOTIFY_ID_PATTERN = constants.SPOTIFY_ID_PATTERN
+
+# http status codes for which a single bad uri rejects the whole bulk
+POISONED_BULK_STATUS = [400, 404]
+
+
+def get_invalid_uri_mask(uris, uri_type):
+    return ~uris.astype(str).str.fullmatch('spotify:' + uri_type + ':' + SPOTIFY_ID_PATTERN)
+
+
+def is_poisoned_bulk_error(e):
+    return isinstance(e, spotipy.SpotifyException) and e.http_status in POISONED_BULK_STATUS
+
+
+def split_bulk(bulk):
+    # the non-empty halves of a bulk, a bulk of a single uri can't be split anymore
+    items = list(bulk.items())
+    if len(items) <= 1:
+        return []
+    half = (len(items) + 1) // 2
+    return [dict(items[:half]), dict(items[half:])]
+
+
+def chunk_bulks(uri_positions, bulk_size):
+    bulk = {}
+    for uri, position in uri_positions:
+        bulk[uri] = position
+        if len(bulk) == bulk_size:
+            yield bulk
+            bulk = {}
+
+    if len(bulk) > 0:
+        yield bulk
+
+
+'''
+Sends all bulks one after another with the given spotipy method ('albums' or 'tracks'). Bulks returned by the
+callbacks are requested right away, so a failed bulk is bisected before the next bulk is sent. count_request() is called
+for every request.
+'''
+def run_bulks(spotify, bulks, method, on_result, on_error, count_request=None):
+    for bulk in bulks:
+        open_bulks = [bulk]
+        while len(open_bulks) > 0:
+            current_bulk = open_bulks.pop()
+            if count_request is not None:
+                count_request()
+            try:
+                res = getattr(spotify, method)(list(current_bulk.keys()))
+            except Exception as e:
+                open_bulks.extend(on_error(current_bulk, e))
+            else:
+                open_bulks.extend(on_result(current_bulk, res))
@@ -8,6 +8,12 @@ from tqdm import tqdm
 
 from src import spotify_credentials
 from src import constants
+from src.preprocessing_spotify import spotify_async_client
+from src.preprocessing_spotify import spotify_bulk_lookup
+from src.preprocessing_spotify.spotify_response_cache import SpotifyResponseCache, CachedSpotify
+from src.utils.result_buffer import ResultBuffer
+from src.utils.checkpoint_journal import RowJournal, atomic_to_csv
+from src.utils.crawl_scheduler import CrawlScheduler
 
 # get constants
 DEBUG = constants.DEBUG
@@ -17,7 +23,12 @@ SAVING_STEP = constants.SAVING_STEP
 ALBUM_REQUEST_BULK_SIZE = constants.ALBUM_REQUEST_BULK_SIZE
 BULK_FAILED_FLAG = constants.BULK_FAILED_FLAG
 FAILED_LOOKUP_FLAG = constants.FAILED_LOOKUP_FLAG
+SPOTIFY_ASYNC = constants.SPOTIFY_ASYNC
+SPOTIFY_MAX_IN_FLIGHT = constants.SPOTIFY_MAX_IN_FLIGHT
+SPOTIFY_CACHE = constants.SPOTIFY_CACHE
+SPOTIFY_CACHE_ONLY = constants.SPOTIFY_CACHE_ONLY
 
+OCC = constants.OCC
 RECORD_LABEL_LOW = constants.RECORD_LABEL_LOW
 COPYRIGHT_P = constants.COPYRIGHT_P
 COPYRIGHT_C = constants.COPYRIGHT_C
@@ -26,89 +37,241 @@ SORTED_ALBUM_URIS = constants.SORTED_ALBUM_URIS
 ALBUM_URIS_WITH_LABEL_LOW = constants.ALBUM_URIS_WITH_LABEL_LOW
 PATH_TO_SLICES_ORIGINAL = constants.PATH_TO_SLICES_ORIGINAL
 
+# columns written by the crawler, in the order of format_new_entry()
+RESULT_COLUMNS = [RECORD_LABEL_LOW, COPYRIGHT_P, COPYRIGHT_C, 'artist_name']
+
 album_uri_df = pd.DataFrame()
+result_buffer = None
+# results since the last full save of the output csv, replayed when a run is resumed
+journal = RowJournal(ALBUM_URIS_WITH_LABEL_LOW, 'album_uri')
+spotify_cache = None
+scheduler = None
+# dict: <album_uri, position> of albums whose bulk failed, they are retried in the final pass
+failure_queue = {}
+final_pass = False
+bulk_errors = 0
+lookup_errors = 0
+bulk_counter = 0
 
 
 def run_spotify_api_lookup(album_uris=ALBUM_URIS_WITH_LABEL_LOW, index_from=LAST_SAVE_INDEX):
-    global album_uri_df
-
     print('Start Spotify API lookup for record labels on', album_uris)
-    spotify = get_spotipy_client()
-    album_uri_df = pd.read_csv(album_uris)
-    if RECORD_LABEL_LOW not in album_uri_df.columns:
-        album_uri_df[[RECORD_LABEL_LOW, COPYRIGHT_P, COPYRIGHT_C]] = [np.nan, np.nan, np.nan]
+    prepare_lookup(load_album_uri_df(album_uris), index_from)
+    create_scheduler()
+
+    if SPOTIFY_CACHE_ONLY:
+        print('Cache only mode, skip', get_pending_mask(index_from).sum() + len(failure_queue), 'albums which are not cached')
+    else:
+        spotify = get_cached_spotipy_client()
+        run_bulks(spotify, scheduler.bulks(album_uri_df['album_uri'].values, get_pending_mask(index_from),
+                                           ALBUM_REQUEST_BULK_SIZE))
+        result_buffer.flush()
+
+        if DEBUG: print('Rerun spotify requests for', len(failure_queue), 'albums of failed bulk requests')
+        run_bulks(spotify, tqdm(scheduler.limit(start_final_pass())))
+        result_buffer.flush()
+    close_cache()
+
+    finish_lookup()
+
+
+def load_album_uri_df(album_uris):
+    df = pd.read_csv(album_uris)
+    if RECORD_LABEL_LOW not in df.columns:
+        df[[RECORD_LABEL_LOW, COPYRIGHT_P, COPYRIGHT_C]] = [np.nan, np.nan, np.nan]
+    # results of an interrupted run since its last full save
+    replayed_rows = journal.replay(df)
+    if DEBUG: print('Replayed', replayed_rows, 'rows from', journal.path)
+    return df
+
+
+def prepare_lookup(df, index_from):
+    global spotify_cache, failure_queue
+
+    reset_lookup(df, journal)
+
+    # uris which are no valid spotify album uris would only poison the bulks they are sent in
+    invalid_mask = get_pending_mask(index_from) & spotify_bulk_lookup.get_invalid_uri_mask(album_uri_df['album_uri'], 'album')
+    if DEBUG: print('Invalid album uris:', invalid_mask.sum())
+    album_uri_df.loc[invalid_mask, RECORD_LABEL_LOW] = FAILED_LOOKUP_FLAG
+
+    # albums which failed in a previous run are retried together with the failures of this run
+    failed_mask = (album_uri_df[RECORD_LABEL_LOW] == BULK_FAILED_FLAG) & (album_uri_df.index >= index_from)
+    failure_queue = dict(zip(album_uri_df.loc[failed_mask, 'album_uri'].values, np.flatnonzero(failed_mask.values)))
 
     if DEBUG: print('Run spotify requests in bulks of ', ALBUM_REQUEST_BULK_SIZE)
-    album_uri_bulk = {}
+    spotify_cache = SpotifyResponseCache() if SPOTIFY_CACHE or SPOTIFY_CACHE_ONLY else None
+    if spotify_cache is not None:
+        # cached albums are resolved first, without sending a request or using up the rate limit
+        cached_mask = get_pending_mask(index_from) & album_uri_df['album_uri'].isin(spotify_cache.get_cached_uris('album'))
+        if DEBUG: print('Look up', cached_mask.sum(), 'albums in cache', spotify_cache.path)
+        spotify_bulk_lookup.run_bulks(CachedSpotify(None, spotify_cache), generate_album_uri_bulks(cached_mask), 'albums',
+                                      on_bulk_result, on_bulk_error)
+        result_buffer.flush()
+
+
+def reset_lookup(df, row_journal=None):
+    global album_uri_df, result_buffer, scheduler, failure_queue, final_pass, bulk_errors, lookup_errors, bulk_counter
+
+    album_uri_df = df
+    scheduler = None
+    result_buffer = ResultBuffer(album_uri_df, RESULT_COLUMNS, row_journal)
+    failure_queue = {}
+    final_pass = False
     bulk_errors = 0
-    for index, entry in tqdm(album_uri_df.iterrows(), total=album_uri_df.shape[0]):
-        if index >= index_from and pd.isna(entry[RECORD_LABEL_LOW]) and entry[RECORD_LABEL_LOW] != BULK_FAILED_FLAG:
-            if len(album_uri_bulk) < ALBUM_REQUEST_BULK_SIZE:
-                album_uri_bulk[entry['album_uri']] = index
-            else:
-                try:
-                    res = spotify.albums(album_uri_bulk.keys())
-                    for album in res['albums']:
-                        # if a single album of the result is none, find all albums without low label and set bulk failed
-                        # lookup flag
-                        if album is None:
-                            for key in album_uri_bulk.keys():
-
-                                if pd.isna(album_uri_df.loc[album_uri_bulk[key], RECORD_LABEL_LOW]):
-                                    album_uri_df.loc[album_uri_bulk[key], RECORD_LABEL_LOW] = BULK_FAILED_FLAG
-                                    bulk_errors += 1
-                        # else assign it normally
-                        else:
-                            uri = 'spotify:album:' + album['id']
-                            album_uri_df.loc[album_uri_bulk[uri], [RECORD_LABEL_LOW,
-                                                                   COPYRIGHT_P,
-                                                                   COPYRIGHT_C,
-                                                                   'artist_name']] = format_new_entry(album)
-
-                            if DEBUG:
-                                print('Current album: ', album['name'], ' --> ', album['label'])
-                except Exception as e:
-                    if DEBUG: print('Bulk error', e)
-                    for key in album_uri_bulk.keys():
-                        album_uri_df.loc[album_uri_bulk[key], RECORD_LABEL_LOW] = BULK_FAILED_FLAG
-                    bulk_errors += 1
-
-                album_uri_bulk.clear()
-                album_uri_bulk[entry['album_uri']] = index
-
-        if index > LAST_SAVE_INDEX and index % SAVING_STEP == 0:
-            if DEBUG: print('saving at', index, ', bulk_errors: ', bulk_errors)
-            save_album_uri_df(ALBUM_URIS_WITH_LABEL_LOW)
-
-    if DEBUG: print('Rerun spotify requests for failed bulk requests individually')
     lookup_errors = 0
-    lookup_counter = 1
-    for index, entry in tqdm(album_uri_df.iterrows(), total=album_uri_df.shape[0]):
-        if index >= index_from and (entry[RECORD_LABEL_LOW] == BULK_FAILED_FLAG or pd.isna(entry[RECORD_LABEL_LOW])):
-            lookup_counter += 1
-            try:
-                res = spotify.album(entry['album_uri'])
-                album_uri_df.loc[index, [RECORD_LABEL_LOW,
-                                         COPYRIGHT_P,
-                                         COPYRIGHT_C,
-                                         'artist_name']] = format_new_entry(res)
-
-                if DEBUG: print('Successful lookup for:', entry['album_uri'], f'({entry.occurrences:,} os)', ' --> ', res['label'])
-            except Exception as e:
-                if DEBUG: print('Error for', entry['album_uri'], ': ', e)
-                album_uri_df.loc[index, RECORD_LABEL_LOW] = FAILED_LOOKUP_FLAG
-                lookup_errors += 1
-
-        if index >= index_from and lookup_counter % SAVING_STEP == 0:
-            print('saving after', lookup_counter, ', errors: ', lookup_errors)
-            save_album_uri_df(ALBUM_URIS_WITH_LABEL_LOW)
+    bulk_counter = 0
+
+
+def create_scheduler():
+    global scheduler
+
+    # albums are requested by descending occurrences, albums with a label (e.g. from the cache) count for the coverage
+    resolved_mask = album_uri_df[RECORD_LABEL_LOW].notna() & ~album_uri_df[RECORD_LABEL_LOW].isin([BULK_FAILED_FLAG, FAILED_LOOKUP_FLAG])
+    scheduler = CrawlScheduler(album_uri_df[OCC].values, resolved_mask.values, 'record label')
+    return scheduler
+
+
+def start_final_pass():
+    global failure_queue, final_pass
+
+    # all failed bulks are requested once more, errors in the final pass are bisected as well
+    final_pass = True
+    failed_album_uri_bulks = spotify_bulk_lookup.chunk_bulks(list(failure_queue.items()), ALBUM_REQUEST_BULK_SIZE)
+    failure_queue = {}
+    return failed_album_uri_bulks
+
+
+def close_cache():
+    global spotify_cache
+
+    if spotify_cache is not None:
+        spotify_cache.close()
+        spotify_cache = None
+
 
+def grow_album_uri_df(size):
+    global album_uri_df
+
+    # used by the track pipeline, which adds albums to the lookup while they are found
+    result_buffer.flush()
+    album_uri_df = pd.concat([album_uri_df, pd.DataFrame(index=range(len(album_uri_df), size), columns=album_uri_df.columns)])
+    result_buffer.df = album_uri_df
+
+
+def finish_lookup(df=None):
+    global album_uri_df
+
+    result_buffer.flush()
+    if df is not None:
+        # the track pipeline passes the final, sorted album df which replaces the one used during the lookup
+        album_uri_df = df
     if DEBUG: print('Replace \'None|-\' with \'Unknown\'')
     album_uri_df.loc[album_uri_df[RECORD_LABEL_LOW].str.fullmatch('-|None', case=False, na=False), RECORD_LABEL_LOW] = 'Unknown'
-    print('final save')
+    print('final save, bulk_errors:', bulk_errors, ', lookup_errors:', lookup_errors)
     save_album_uri_df(ALBUM_URIS_WITH_LABEL_LOW)
 
 
+def run_bulks(spotify, album_uri_bulks):
+    if SPOTIFY_ASYNC:
+        if DEBUG: print('Run bulks asynchronously with', SPOTIFY_MAX_IN_FLIGHT, 'requests in flight')
+        spotify_async_client.run_bulks(album_uri_bulks, 'albums', on_bulk_result, on_bulk_error,
+                                       max_in_flight=SPOTIFY_MAX_IN_FLIGHT,
+                                       client_factory=get_cached_async_spotipy_client, count_request=count_request)
+    else:
+        spotify_bulk_lookup.run_bulks(spotify, album_uri_bulks, 'albums', on_bulk_result, on_bulk_error, count_request)
+
+
+def count_request():
+    if scheduler is not None:
+        scheduler.count_request()
+
+
+def get_pending_mask(index_from):
+    return album_uri_df[RECORD_LABEL_LOW].isna() & (album_uri_df.index >= index_from)
+
+
+def generate_album_uri_bulks(pending_mask):
+    pending_album_uris = album_uri_df.loc[pending_mask, 'album_uri'].values
+
+    return spotify_bulk_lookup.chunk_bulks(
+        tqdm(zip(pending_album_uris, np.flatnonzero(pending_mask.values)), total=len(pending_album_uris)),
+        ALBUM_REQUEST_BULK_SIZE)
+
+
+def on_bulk_result(album_uri_bulk, res):
+    global lookup_errors
+
+    unresolved_bulk = dict(album_uri_bulk)
+    not_found_count = 0
+    try:
+        for album in res['albums']:
+            # albums which are not found are none, they stay unresolved
+            if album is None:
+                not_found_count += 1
+                continue
+
+            uri = 'spotify:album:' + album['id']
+            # a single requested album can be assigned even if spotify answers with a relinked id
+            if uri not in unresolved_bulk and len(album_uri_bulk) == 1:
+                uri = next(iter(album_uri_bulk))
+            if uri in unresolved_bulk:
+                position = unresolved_bulk.pop(uri)
+                result_buffer.set_row(position, format_new_entry(album))
+                if scheduler is not None:
+                    scheduler.resolve(position)
+
+                if DEBUG:
+                    print('Current album: ', album['name'], ' --> ', album['label'])
+    except Exception as e:
+        return on_bulk_error(album_uri_bulk, e)
+
+    on_bulk_done()
+    if len(unresolved_bulk) == 0:
+        return []
+
+    # an album which can't be found on its own or which is the only one not found in its bulk doesn't exist (anymore),
+    # the others are bisected until they're isolated
+    if len(unresolved_bulk) == 1 and (len(album_uri_bulk) == 1 or not_found_count == 1):
+        if DEBUG: print('Album not found:', next(iter(unresolved_bulk)))
+        result_buffer.set(next(iter(unresolved_bulk.values())), RECORD_LABEL_LOW, FAILED_LOOKUP_FLAG)
+        lookup_errors += 1
+        return []
+    # a single album answered with another id than the requested one is requested again on its own
+    if len(unresolved_bulk) == 1:
+        return [unresolved_bulk]
+    return spotify_bulk_lookup.split_bulk(unresolved_bulk)
+
+
+def on_bulk_error(album_uri_bulk, e):
+    global bulk_errors, lookup_errors
+
+    if DEBUG: print('Bulk error', e)
+    if len(album_uri_bulk) > 1 and (final_pass or spotify_bulk_lookup.is_poisoned_bulk_error(e)):
+        return spotify_bulk_lookup.split_bulk(album_uri_bulk)
+
+    # other errors (e.g. connection errors) are retried once more in the final pass, after that the lookup failed
+    for uri, position in album_uri_bulk.items():
+        if final_pass:
+            result_buffer.set(position, RECORD_LABEL_LOW, FAILED_LOOKUP_FLAG)
+            lookup_errors += 1
+        else:
+            result_buffer.set(position, RECORD_LABEL_LOW, BULK_FAILED_FLAG)
+            failure_queue[uri] = position
+    bulk_errors += 1
+    on_bulk_done()
+    return []
+
+
+def on_bulk_done():
+    global bulk_counter
+
+    bulk_counter += 1
+    if (bulk_counter * ALBUM_REQUEST_BULK_SIZE) % SAVING_STEP == 0:
+        if DEBUG: print('checkpoint after', bulk_counter, 'bulks, bulk_errors: ', bulk_errors)
+        result_buffer.flush()
+
+
 def format_new_entry(album):
     # the artist name is being processed as there are sometimes multiple artist names in the original dataset, this step
     # helps to get a more general artist name for each album but this is only for readability and has no other purpose
@@ -139,15 +302,32 @@ def get_spotipy_client():
     return spotify
 
 
+def get_cached_spotipy_client():
+    spotify = get_spotipy_client()
+    return spotify if spotify_cache is None else CachedSpotify(spotify, spotify_cache)
+
+
+def get_cached_async_spotipy_client():
+    spotify = spotify_async_client.get_spotipy_client()
+    return spotify if spotify_cache is None else CachedSpotify(spotify, spotify_cache)
+
+
 def save_album_uri_df(output_path=ALBUM_URIS_WITH_LABEL_LOW):
-    album_uri_df.to_csv(output_path, index=False)
+    if result_buffer is not None:
+        result_buffer.flush()
+    atomic_to_csv(album_uri_df, output_path, index=False)
+    journal.clear()
 
 
-def main(debug=None):
-    global DEBUG
+def main(debug=None, spotify_async=None, spotify_cache_only=None):
+    global DEBUG, SPOTIFY_ASYNC, SPOTIFY_CACHE_ONLY
 
     if debug is not None:
         DEBUG = debug
+    if spotify_async is not None:
+        SPOTIFY_ASYNC = spotify_async
+    if spotify_cache_only is not None:
+        SPOTIFY_CACHE_ONLY = spotify_cache_only
 
     if os.path.exists(ALBUM_URIS_WITH_LABEL_LOW):
         # if an output file exists, reuse it
@@ -162,7 +342,8 @@ if __name__ == "__main__":
         main()
     except KeyboardInterrupt:
         print('Keyboard Interrupt')
-        print('Saving current df to: ', ALBUM_URIS_WITH_LABEL_LOW)
-        save_album_uri_df(ALBUM_URIS_WITH_LABEL_LOW)
+        print('Saving results since the last checkpoint to: ', journal.path)
+        if result_buffer is not None:
+            result_buffer.flush()
         sys.exit(-1)
 
@@ -0,0 +1,105 @@
+import json
+import sqlite3
+import threading
+import time
+
+from src import constants
+
+""" Persistent response cache for the spotify crawlers
+
+Stores the json of every album and track returned by spotify.albums() / spotify.tracks() in a SQLite file, keyed by
+the requested uri. The cache is not tagged with the dataset, so a _lfm run reuses all albums which were already
+crawled in a _mpd run (and the other way round).
+    ttl...  max. age of a cached response in seconds, older responses are requested again (None: never expire)
+Responses which are none (uri not found) are not cached. In cache only mode (constants.SPOTIFY_CACHE_ONLY) the
+crawlers only look up cached uris, all others are left for a later run with network access.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+SPOTIFY_CACHE_PATH = constants.SPOTIFY_CACHE_PATH
+SPOTIFY_CACHE_TTL = constants.SPOTIFY_CACHE_TTL
+
+# max. number of parameters in one sqlite query
+SQLITE_MAX_VARIABLES = 900
+
+
+class SpotifyResponseCache:
+    def __init__(self, path=SPOTIFY_CACHE_PATH, ttl=SPOTIFY_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        # the cache is shared by the worker threads of the async client, all access goes through the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                '(uri TEXT PRIMARY KEY, response TEXT NOT NULL, fetched_at REAL NOT NULL)')
+        self.connection.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_min_fetched_at(self):
+        return 0 if self.ttl is None else time.time() - self.ttl
+
+    def get_many(self, uris):
+        uris = list(uris)
+        responses = {}
+        with self.lock:
+            for i in range(0, len(uris), SQLITE_MAX_VARIABLES):
+                uri_chunk = uris[i:i + SQLITE_MAX_VARIABLES]
+                rows = self.connection.execute(
+                    'SELECT uri, response FROM responses WHERE fetched_at >= ? AND uri IN ('
+                    + ','.join('?' * len(uri_chunk)) + ')', [self.get_min_fetched_at()] + uri_chunk)
+                for uri, response in rows:
+                    responses[uri] = json.loads(response)
+            self.hits += len(responses)
+            self.misses += len(uris) - len(responses)
+        return responses
+
+    def put_many(self, responses):
+        fetched_at = time.time()
+        rows = [(uri, json.dumps(response), fetched_at) for uri, response in responses if response is not None]
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', rows)
+            self.connection.commit()
+
+    def get_cached_uris(self, uri_type):
+        # uri_type: 'album' or 'track'
+        with self.lock:
+            rows = self.connection.execute('SELECT uri FROM responses WHERE fetched_at >= ? AND uri LIKE ?',
+                                           (self.get_min_fetched_at(), 'spotify:' + uri_type + ':%'))
+            return set(uri for uri, in rows)
+
+    def close(self):
+        if DEBUG: print('Spotify cache:', self.hits, 'hits,', self.misses, 'misses')
+        with self.lock:
+            self.connection.close()
+
+
+# replaces the spotipy client for albums() and tracks(), only uris which are not cached are requested
+class CachedSpotify:
+    def __init__(self, spotify, cache):
+        # spotify is None in cache only mode, uris which are not cached are answered with none
+        self.spotify = spotify
+        self.cache = cache
+
+    def albums(self, album_uris):
+        return {'albums': self.lookup('albums', album_uris)}
+
+    def tracks(self, track_uris):
+        return {'tracks': self.lookup('tracks', track_uris)}
+
+    def lookup(self, method, uris):
+        uris = list(uris)
+        responses = self.cache.get_many(uris)
+        missing_uris = [uri for uri in uris if uri not in responses]
+
+        if len(missing_uris) > 0 and self.spotify is not None:
+            # spotify answers in the order of the request, relinked tracks are stored under the requested uri
+            res = getattr(self.spotify, method)(missing_uris)[method]
+            self.cache.put_many(zip(missing_uris, res))
+            responses.update(zip(missing_uris, res))
+
+        return [responses.get(uri) for uri in uris]
@@ -0,0 +1,257 @@
+import asyncio
+import os
+import numpy as np
+import pandas as pd
+
+from src import constants
+from src.preprocessing_spotify import spotify_album_crawler
+from src.preprocessing_spotify import spotify_record_label_crawler
+from src.preprocessing_spotify import spotify_async_client
+from src.preprocessing_spotify import spotify_bulk_lookup
+from src.preprocessing_spotify.spotify_response_cache import CachedSpotify
+from src.utils.checkpoint_journal import RowJournal
+
+""" Streaming spotify pipeline for track based runs
+
+Resolves tracks to albums and albums to record labels in one pass, instead of running the album crawler over all
+tracks before the record label crawler starts:
+    - every album uri found by a track lookup goes into a deduplicating album queue, full bulks of albums are requested
+      right away and share the client pool and rate limit with the track requests still in flight
+    - the occurrences of a track are added to its album as soon as the album is known
+At the end the same outputs as of the two separate crawlers are written (track to album map, sorted album uris and
+sorted albums with labels). Resolved tracks are checkpointed in the journal of the album crawler and resolved albums in
+a journal of the pipeline, which is keyed by album uri because the positions of the albums depend on the order they are
+found in. Albums which were resolved before are taken from this journal, an existing record label output and the spotify
+response cache.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+SPOTIFY_MAX_IN_FLIGHT = constants.SPOTIFY_MAX_IN_FLIGHT
+ALBUM_REQUEST_BULK_SIZE = constants.ALBUM_REQUEST_BULK_SIZE
+BULK_FAILED_FLAG = constants.BULK_FAILED_FLAG
+FAILED_LOOKUP_FLAG = constants.FAILED_LOOKUP_FLAG
+
+TRACK_URI = constants.TRACK_URI
+ALBUM_URI = constants.ALBUM_URI
+OCC = constants.OCC
+RECORD_LABEL_LOW = constants.RECORD_LABEL_LOW
+
+INPUT_TRACK_URIS = constants.INPUT_TRACK_URIS
+SORTED_ALBUM_URIS = constants.SORTED_ALBUM_URIS
+ALBUM_URIS_WITH_LABEL_LOW = constants.ALBUM_URIS_WITH_LABEL_LOW
+
+RESULT_COLUMNS = spotify_record_label_crawler.RESULT_COLUMNS
+ALBUM_URI_PREFIX = 'spotify:album:'
+# initial number of rows of the album df, it is doubled whenever it's full
+INITIAL_ALBUM_CAPACITY = 10000
+
+journal = RowJournal(ALBUM_URIS_WITH_LABEL_LOW + '.pipeline', ALBUM_URI)
+
+# album_uris in order of discovery, the index is the position in the album df of the record label crawler
+album_uris = []
+album_occurrences = []
+# dict: <album_uri, position>
+album_positions = {}
+# tracks whose occurrences were already added to their album
+counted_tracks = np.zeros(0, dtype=bool)
+# dict: <album_uri, list of result values> of albums which were resolved in a previous run
+existing_results = {}
+cached_album_uris = set()
+# bulks of found albums which are not complete yet: dict <album_uri, position>
+album_bulk = {}
+cached_album_bulk = {}
+# spotify_async_client.WorkerPool which looks up the full bulks of found albums
+album_pool = None
+
+
+def run_pipeline(index_from=-1):
+    print('Start streaming Spotify API lookup for albums and record labels on', INPUT_TRACK_URIS)
+    spotify_album_crawler.load_df()
+    spotify_album_crawler.prepare_lookup(index_from)
+
+    # the crawl budgets apply to the track requests, the albums of all resolved tracks are looked up
+    scheduler = spotify_album_crawler.create_scheduler()
+    track_uri_bulks = scheduler.bulks(spotify_album_crawler.track_uri_df[TRACK_URI].values,
+                                      spotify_album_crawler.get_pending_mask(index_from), ALBUM_REQUEST_BULK_SIZE)
+    asyncio.run(_run_pipeline(track_uri_bulks, SPOTIFY_MAX_IN_FLIGHT))
+    spotify_album_crawler.close_cache()
+
+    if DEBUG: print('final save, bulk_errors:', spotify_album_crawler.bulk_errors, ', lookup_errors:',
+                    spotify_album_crawler.lookup_errors)
+    spotify_album_crawler.save_album_uri_df()
+
+    sorted_album_df = create_sorted_album_df()
+    sorted_album_df[[ALBUM_URI, OCC]].to_csv(SORTED_ALBUM_URIS, index=False)
+    spotify_record_label_crawler.finish_lookup(sorted_album_df)
+    journal.clear()
+
+
+def prepare_album_lookup():
+    global album_uris, album_occurrences, album_positions, counted_tracks, existing_results, cached_album_uris
+    global album_bulk, cached_album_bulk
+
+    album_uri_df = pd.DataFrame({ALBUM_URI: np.full(INITIAL_ALBUM_CAPACITY, np.nan, dtype=object)})
+    spotify_record_label_crawler.reset_lookup(album_uri_df, journal)
+    album_uris = []
+    album_occurrences = []
+    album_positions = {}
+    album_bulk = {}
+    cached_album_bulk = {}
+
+    existing_results = {}
+    if os.path.exists(ALBUM_URIS_WITH_LABEL_LOW):
+        # albums which were already looked up (not in a failed bulk) are not requested again
+        existing_df = spotify_record_label_crawler.load_album_uri_df(ALBUM_URIS_WITH_LABEL_LOW).reindex(
+            columns=[ALBUM_URI] + RESULT_COLUMNS)
+        existing_df = existing_df[existing_df[RECORD_LABEL_LOW].notna() & (existing_df[RECORD_LABEL_LOW] != BULK_FAILED_FLAG)]
+        existing_results = dict(zip(existing_df[ALBUM_URI].values, existing_df[RESULT_COLUMNS].values.tolist()))
+        if DEBUG: print('Reuse', len(existing_results), 'albums of', ALBUM_URIS_WITH_LABEL_LOW)
+
+    # albums resolved by an interrupted run since the last full save
+    journaled_results = {}
+    for _, album_uri, values in journal.read():
+        journaled_results.setdefault(album_uri, {}).update(values)
+    for album_uri, values in journaled_results.items():
+        if values.get(RECORD_LABEL_LOW) not in [None, BULK_FAILED_FLAG]:
+            existing_results[album_uri] = [values.get(column, np.nan) for column in RESULT_COLUMNS]
+    if DEBUG: print('Replayed', len(journaled_results), 'albums from', journal.path)
+
+    spotify_cache = spotify_album_crawler.spotify_cache
+    cached_album_uris = spotify_cache.get_cached_uris('album') if spotify_cache is not None else set()
+
+    # albums of tracks which were resolved in a previous run or from the cache
+    track_uri_df = spotify_album_crawler.track_uri_df
+    counted_tracks = track_uri_df[ALBUM_URI].astype(str).str.startswith(ALBUM_URI_PREFIX).to_numpy(copy=True)
+    resolved_occurrences = track_uri_df[counted_tracks].groupby(ALBUM_URI, sort=False)[OCC].sum()
+    for album_uri, occurrences in zip(resolved_occurrences.index, resolved_occurrences.values):
+        add_album_occurrences(album_uri, occurrences)
+
+
+def add_album_occurrences(album_uri, occurrences):
+    position = album_positions.get(album_uri)
+    if position is None:
+        position = len(album_uris)
+        album_positions[album_uri] = position
+        album_uris.append(album_uri)
+        album_occurrences.append(0)
+        if position >= len(spotify_record_label_crawler.album_uri_df):
+            spotify_record_label_crawler.grow_album_uri_df(2 * len(spotify_record_label_crawler.album_uri_df))
+        # the album uri is the key of the journaled rows
+        album_uri_df = spotify_record_label_crawler.album_uri_df
+        album_uri_df.iat[position, album_uri_df.columns.get_loc(ALBUM_URI)] = album_uri
+        add_album(album_uri, position)
+
+    album_occurrences[position] += occurrences
+
+
+def add_album(album_uri, position):
+    global album_bulk, cached_album_bulk
+
+    if album_uri in existing_results:
+        spotify_record_label_crawler.result_buffer.set_row(position, existing_results[album_uri])
+    elif album_uri in cached_album_uris:
+        cached_album_bulk[album_uri] = position
+        if len(cached_album_bulk) == ALBUM_REQUEST_BULK_SIZE:
+            lookup_cached_albums(cached_album_bulk)
+            cached_album_bulk = {}
+    else:
+        album_bulk[album_uri] = position
+        if len(album_bulk) == ALBUM_REQUEST_BULK_SIZE:
+            album_pool.put_nowait(album_bulk)
+            album_bulk = {}
+
+
+def lookup_cached_albums(bulk):
+    # cached albums are resolved right away, without sending a request or using up the rate limit
+    cached_spotify = CachedSpotify(None, spotify_album_crawler.spotify_cache)
+    spotify_bulk_lookup.run_bulks(cached_spotify, [bulk], 'albums', spotify_record_label_crawler.on_bulk_result,
+                                  spotify_record_label_crawler.on_bulk_error)
+
+
+def on_track_bulk_result(track_uri_bulk, res):
+    retry_bulks = spotify_album_crawler.on_bulk_result(track_uri_bulk, res)
+
+    result_buffer = spotify_album_crawler.result_buffer
+    occurrences = spotify_album_crawler.track_uri_df[OCC].values
+    for position in track_uri_bulk.values():
+        album_uri = result_buffer.get(position, ALBUM_URI)
+        if not counted_tracks[position] and isinstance(album_uri, str) and album_uri.startswith(ALBUM_URI_PREFIX):
+            counted_tracks[position] = True
+            add_album_occurrences(album_uri, occurrences[position])
+
+    return retry_bulks
+
+
+async def _run_pipeline(track_uri_bulks, max_in_flight):
+    global album_pool
+
+    client = spotify_async_client.AsyncSpotifyClient(
+        client_factory=spotify_album_crawler.get_cached_async_spotipy_client, max_in_flight=max_in_flight)
+
+    async def lookup_tracks(bulk):
+        await spotify_async_client.lookup_bulk(client, bulk, 'tracks', on_track_bulk_result,
+                                               spotify_album_crawler.on_bulk_error, spotify_album_crawler.count_request)
+
+    async def lookup_albums(bulk):
+        await spotify_async_client.lookup_bulk(client, bulk, 'albums', spotify_record_label_crawler.on_bulk_result,
+                                               spotify_record_label_crawler.on_bulk_error)
+
+    # the pools have to be created inside the running event loop, the album pool before the first album is added
+    track_pool = spotify_async_client.WorkerPool(lookup_tracks, max_in_flight, maxsize=2 * max_in_flight)
+    album_pool = spotify_async_client.WorkerPool(lookup_albums, max_in_flight)
+    try:
+        prepare_album_lookup()
+        for bulk in track_uri_bulks:
+            await track_pool.put(bulk)
+        await track_pool.join()
+
+        if DEBUG: print('Rerun spotify requests for', len(spotify_album_crawler.failure_queue), 'tracks of failed bulk requests')
+        await asyncio.gather(*[lookup_tracks(bulk) for bulk in
+                               spotify_album_crawler.scheduler.limit(spotify_album_crawler.start_final_pass())])
+
+        # all albums are found, the last incomplete bulks are sent as well
+        if len(cached_album_bulk) > 0:
+            lookup_cached_albums(cached_album_bulk)
+        if len(album_bulk) > 0:
+            album_pool.put_nowait(album_bulk)
+        await album_pool.join()
+
+        if DEBUG: print('Rerun spotify requests for', len(spotify_record_label_crawler.failure_queue), 'albums of failed bulk requests')
+        await asyncio.gather(*[lookup_albums(bulk) for bulk in spotify_record_label_crawler.start_final_pass()])
+    finally:
+        track_pool.cancel()
+        album_pool.cancel()
+        client.close()
+
+    if DEBUG: print('Pipeline done:', client.request_count, 'requests,', client.rate_limited_count, 'rate limited,',
+                    len(album_uris), 'albums')
+
+
+def create_sorted_album_df():
+    spotify_record_label_crawler.result_buffer.flush()
+    album_df = spotify_record_label_crawler.album_uri_df.iloc[:len(album_uris)].copy()
+    album_df.insert(1, OCC, album_occurrences)
+
+    # tracks without album (failed lookups) are kept as a single row per flag, like in the sorted album uri list of
+    # the album crawler
+    track_uri_df = spotify_album_crawler.track_uri_df
+    failed_df = track_uri_df[track_uri_df[ALBUM_URI].notna() & ~counted_tracks].groupby(ALBUM_URI)[OCC].sum().reset_index()
+    failed_df[RECORD_LABEL_LOW] = FAILED_LOOKUP_FLAG
+
+    album_df = pd.concat([album_df, failed_df], ignore_index=True)
+    return album_df.sort_values([OCC], ascending=False).reset_index(drop=True)
+
+
+def main(debug=None):
+    global DEBUG
+
+    if debug is not None:
+        DEBUG = debug
+
+    run_pipeline()
+
+
+if __name__ == "__main__":
+    main()
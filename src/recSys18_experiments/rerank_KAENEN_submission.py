@@ -5,14 +5,15 @@ import json
 from tqdm import tqdm
 from src import constants
 from src.utils import plot_utils
+from src.utils import track_album_index
 
 ALBUM_URIS_ENRICHED = '../../data/generated/sorted_album_uris_enriched_mpd.csv'
 CHALLENGE_PATH = '../../data/challenge_set.json'
-TRACK_TO_ALBUM_MAP = '../../data/experiment_output/mpd_track_to_album_map.csv'
 SUBMISSION_PATH = '../../data/experiment_output/submission_KAENEN_500.csv'
 SUBMISSION_COLLECTION_PATH = '../../data/experiment_output/experiment_output_collection.csv'
 
-PATH_TO_SLICES = constants.PATH_TO_SLICES_ORIGINAL
+PATH_TO_SLICES = constants.MPD_SLICE_SOURCE
+TRACK_ALBUM_INDEX_PATH = constants.TRACK_ALBUM_INDEX_PATH
 
 ALBUM_URI = constants.ALBUM_URI
 TRACK_URI = constants.TRACK_URI
@@ -31,23 +32,10 @@ EMPTY_DICT = {
 }
 
 
-def create_track_to_album_mapping():
-    track_set = set()
-    track_to_album_map = {}
-
-    all_slices = os.listdir(PATH_TO_SLICES)
-    for filename in tqdm(all_slices, total=len(all_slices)):
-        if filename.startswith('mpd.slice') and filename.endswith('.json'):
-            with open(PATH_TO_SLICES + filename, 'r') as read_file:
-                for playlist in json.load(read_file)['playlists']:
-                    for track in playlist['tracks']:
-                        if track[TRACK_URI] not in track_set:
-                            track_set.add(track[TRACK_URI])
-                            track_to_album_map[track[TRACK_URI]] = track[ALBUM_URI]
-
-    track_map_df = pd.DataFrame.from_dict(track_to_album_map, orient='index', columns=[ALBUM_URI])
-    print(track_map_df)
-    track_map_df.to_csv(TRACK_TO_ALBUM_MAP)
+def create_track_to_album_mapping(rebuild=False):
+    # the index of all MPD tracks is only built once, the reranker looks up the tracks of the submission in it
+    if rebuild or not os.path.exists(TRACK_ALBUM_INDEX_PATH):
+        track_album_index.build_index(PATH_TO_SLICES, TRACK_ALBUM_INDEX_PATH)
 
 
 def create_SI_comparison(len_threshold=5, SI_thresholds=[0,0.6,1]):
@@ -172,9 +160,10 @@ def rerank_submission(dominant_major_per_playlist_dict, submission_length=500, r
     df_album_map = pd.read_csv(ALBUM_URIS_ENRICHED)
     album_to_major_map = dict(zip(df_album_map[ALBUM_URI], df_album_map[RECORD_LABEL_MAJOR]))
 
-    df_track_to_album_map = pd.read_csv(TRACK_TO_ALBUM_MAP, names=[TRACK_URI, ALBUM_URI], header=None, skiprows=1)
-    track_to_album_map = dict(zip(df_track_to_album_map[TRACK_URI], df_track_to_album_map[ALBUM_URI]))
     submission = pd.read_csv(SUBMISSION_PATH, skiprows=3, header=None)
+    index = track_album_index.TrackAlbumIndex(TRACK_ALBUM_INDEX_PATH)
+    track_to_album_map = index.get_albums(pd.unique(submission.iloc[:, 1:].values.ravel()))
+    index.close()
     reranked_submission_dict = {}
     for index, entry in tqdm(submission.iterrows(), total=submission.shape[0]):
         pid = entry[0]
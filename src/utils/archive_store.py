@@ -0,0 +1,169 @@
+import os
+import pickle
+import sqlite3
+import threading
+import numpy as np
+from collections.abc import MutableMapping
+
+from src import constants
+from src.utils.checkpoint_journal import DictJournal, remove_file, JOURNAL_SUFFIX
+
+""" Keyed on-disk archives of the crawlers
+
+The archives of the crawlers (e.g. discogs label id -> DiscogsEntry) are SQLite files with one row per entry instead of
+whole-dict pickles. ArchiveStore behaves like the dict it replaces:
+    - entries are read lazily with their first access and kept in memory afterwards, opening an archive reads nothing
+    - set entries are only kept in memory until checkpoint(), which upserts all entries set since the last checkpoint
+      in one transaction, a killed run loses at most the entries since the last checkpoint
+The values are stored as blobs of encode(value) (pickle by default). Entries of the crawlers are stored as records:
+encode_record() pickles the plain tuple of entry.to_record(), which starts with a version, and the decoder of
+get_record_decoder() builds the entry again with from_record(). The stored records do not depend on the entry classes,
+entries pickled as instances (older archives) are still read. The store of an archive is next to its old pickle
+(archive_discogs_lookup.pkl -> archive_discogs_lookup.sqlite), open_archive() migrates an existing pickle (and its
+journal, see utils/checkpoint_journal.py) once into the store, the pickle is not read or changed afterwards.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+STORE_SUFFIX = '.sqlite'
+# entries inserted at once while migrating a pickle
+INSERT_BULK_SIZE = 10000
+
+
+def to_key(key):
+    # numpy ints (e.g. ids read from a DataFrame) are stored like python ints
+    return key.item() if isinstance(key, np.generic) else key
+
+
+class ArchiveStore(MutableMapping):
+    def __init__(self, store_path, encode=pickle.dumps, decode=pickle.loads):
+        self.store_path = store_path
+        self.encode = encode
+        self.decode = decode
+        # the crawlers share an archive between their workers, all accesses of the connection are serialized
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(store_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS archive (key PRIMARY KEY, value BLOB NOT NULL)')
+        self.connection.commit()
+        # dict: <key, value> of all entries which were read or set
+        self.cache = {}
+        self.changed_keys = set()
+
+    def __getitem__(self, key):
+        key = to_key(key)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            row = self.connection.execute('SELECT value FROM archive WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            value = self.decode(row[0])
+            self.cache[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        key = to_key(key)
+        with self.lock:
+            self.cache[key] = value
+            self.changed_keys.add(key)
+
+    def __delitem__(self, key):
+        key = to_key(key)
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.cache.pop(key, None)
+            self.changed_keys.discard(key)
+            self.connection.execute('DELETE FROM archive WHERE key = ?', (key,))
+            self.connection.commit()
+
+    def __contains__(self, key):
+        key = to_key(key)
+        with self.lock:
+            if key in self.cache:
+                return True
+            return self.connection.execute('SELECT 1 FROM archive WHERE key = ?', (key,)).fetchone() is not None
+
+    def __iter__(self):
+        with self.lock:
+            stored_keys = [row[0] for row in self.connection.execute('SELECT key FROM archive')]
+            new_keys = self.changed_keys.difference(stored_keys)
+        yield from stored_keys
+        yield from new_keys
+
+    def __len__(self):
+        with self.lock:
+            stored_count = self.connection.execute('SELECT COUNT(*) FROM archive').fetchone()[0]
+            return stored_count + sum(1 for key in self.changed_keys
+                                      if self.connection.execute('SELECT 1 FROM archive WHERE key = ?',
+                                                                 (key,)).fetchone() is None)
+
+    def checkpoint(self):
+        # writes all entries set since the last checkpoint
+        with self.lock:
+            if len(self.changed_keys) == 0:
+                return
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO archive VALUES (?, ?)',
+                                            [(key, self.encode(self.cache[key])) for key in self.changed_keys])
+            if DEBUG: print('Wrote', len(self.changed_keys), 'entries to', self.store_path)
+            self.changed_keys.clear()
+
+    def close(self):
+        self.checkpoint()
+        with self.lock:
+            self.connection.close()
+
+
+def encode_record(entry):
+    return pickle.dumps(entry.to_record(), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def get_record_decoder(record_type):
+    def decode(blob):
+        value = pickle.loads(blob)
+        # entries which were pickled as instances are already entries of record_type
+        return record_type.from_record(value) if isinstance(value, tuple) else value
+    return decode
+
+
+def get_store_path(archive_path):
+    return os.path.splitext(archive_path)[0] + STORE_SUFFIX
+
+
+def open_archive(archive_path, encode=pickle.dumps, decode=pickle.loads):
+    # store of the archive at archive_path (the path of its pickle), an existing pickle is migrated first
+    store_path = get_store_path(archive_path)
+    if not os.path.exists(store_path) and (os.path.exists(archive_path) or os.path.exists(archive_path + JOURNAL_SUFFIX)):
+        migrate(archive_path, store_path, encode)
+    return ArchiveStore(store_path, encode, decode)
+
+
+def migrate(archive_path, store_path, encode=pickle.dumps):
+    print('Migrate archive', archive_path, 'to', store_path)
+    archive = DictJournal(archive_path).load()
+    tmp_path = store_path + '.tmp'
+    remove_file(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    connection.execute('CREATE TABLE archive (key PRIMARY KEY, value BLOB NOT NULL)')
+    rows = []
+    for key, value in archive.items():
+        rows.append((to_key(key), encode(value)))
+        if len(rows) >= INSERT_BULK_SIZE:
+            connection.executemany('INSERT OR REPLACE INTO archive VALUES (?, ?)', rows)
+            rows = []
+    connection.executemany('INSERT OR REPLACE INTO archive VALUES (?, ?)', rows)
+    connection.commit()
+    connection.close()
+    os.replace(tmp_path, store_path)
+    print('Migrated', len(archive), 'entries, the pickle at', archive_path, 'is not used anymore')
+
+
+def remove_archive(archive_path):
+    # removes the store of an archive and its old pickle and journal
+    store_path = get_store_path(archive_path)
+    for path in [store_path, store_path + '-wal', store_path + '-shm', archive_path, archive_path + JOURNAL_SUFFIX]:
+        remove_file(path)
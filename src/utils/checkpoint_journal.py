@@ -0,0 +1,177 @@
+import json
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+""" Append-only checkpoint journals for the crawlers
+
+Instead of rewriting the whole output csv (or archive pickle) at every checkpoint, only the results since the last
+checkpoint are appended to a journal next to the output file:
+    RowJournal...   jsonl file, one line [position, key, {column: value}] per changed row of a DataFrame
+    DictJournal...  stream of pickled (key, value) records for all changed entries of an archive dict
+On resume the journal is replayed onto the last full save, at the end of a run the output is written once (compaction)
+and the journal is removed. Full saves are written to a temporary file which replaces the output with os.replace(),
+a killed run therefore leaves either the old or the new file but never a partially written one.
+"""
+
+JOURNAL_SUFFIX = '.journal'
+
+
+def atomic_write(path, write, binary=False):
+    tmp_path = path + '.tmp'
+    if binary:
+        write_file = open(tmp_path, 'wb')
+    else:
+        write_file = open(tmp_path, 'w', encoding='utf-8', newline='')
+    with write_file:
+        write(write_file)
+        write_file.flush()
+        os.fsync(write_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_to_csv(df, path, **kwargs):
+    atomic_write(path, lambda write_file: df.to_csv(write_file, **kwargs))
+
+
+def atomic_pickle_dump(obj, path):
+    atomic_write(path, lambda write_file: pickle.dump(obj, write_file), binary=True)
+
+
+def to_json_value(value):
+    # numpy scalars (e.g. keyword sums) are not serializable by json
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Not serializable: ' + repr(value))
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def truncate_file(path, size):
+    if os.path.getsize(path) > size:
+        with open(path, 'r+b') as journal_file:
+            journal_file.truncate(size)
+
+
+class RowJournal:
+    def __init__(self, output_path, key_column):
+        # the key column (e.g. album_uri) is stored with each row, rows which don't match on replay are skipped
+        self.path = output_path + JOURNAL_SUFFIX
+        self.key_column = key_column
+
+    def append(self, df, rows):
+        # rows: dict <row position, dict <column, value>>
+        key_idx = df.columns.get_loc(self.key_column)
+        with open(self.path, 'a', encoding='utf-8') as journal_file:
+            for position, values in rows.items():
+                journal_file.write(json.dumps([int(position), df.iat[position, key_idx], values],
+                                              default=to_json_value) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def read(self):
+        # list of all journaled rows as (position, key, dict <column, value>), in the order they were appended
+        if not os.path.exists(self.path):
+            return []
+
+        rows = []
+        with open(self.path, 'rb') as journal_file:
+            valid_size = 0
+            for line in journal_file:
+                try:
+                    rows.append(tuple(json.loads(line.decode('utf-8'))))
+                except ValueError:
+                    break
+                valid_size += len(line)
+        # cut off the last line of a run which was killed while writing, new lines are appended after the valid ones
+        truncate_file(self.path, valid_size)
+        return rows
+
+    def replay(self, df):
+        if not os.path.exists(self.path):
+            return 0
+
+        keys = df[self.key_column].values
+        columns = {}
+        skipped = 0
+        for position, key, values in self.read():
+            if position >= len(keys) or keys[position] != key:
+                skipped += 1
+                continue
+            for column, value in values.items():
+                columns.setdefault(column, {})[position] = value
+
+        for column, values in columns.items():
+            if column not in df.columns:
+                df[column] = np.nan
+            positions = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+            df.iloc[positions, df.columns.get_loc(column)] = pd.Series(list(values.values())).values
+
+        if skipped > 0:
+            print('Skipped', skipped, 'journal entries of', self.path, 'which do not match the input anymore')
+        return max([len(values) for values in columns.values()], default=0)
+
+    def clear(self):
+        remove_file(self.path)
+
+
+# dict which remembers all keys set since the last checkpoint
+class JournaledDict(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed_keys = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed_keys.add(key)
+
+
+class DictJournal:
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.path = archive_path + JOURNAL_SUFFIX
+
+    def load(self):
+        try:
+            with open(self.archive_path, 'rb') as read_file:
+                archive = JournaledDict(pickle.load(read_file))
+        except FileNotFoundError:
+            archive = JournaledDict()
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal_file:
+                valid_size = 0
+                while True:
+                    try:
+                        key, value = pickle.load(journal_file)
+                    except (EOFError, pickle.UnpicklingError):
+                        break
+                    valid_size = journal_file.tell()
+                    dict.__setitem__(archive, key, value)
+            truncate_file(self.path, valid_size)
+        return archive
+
+    def checkpoint(self, archive):
+        if len(archive.changed_keys) == 0:
+            return
+        with open(self.path, 'ab') as journal_file:
+            for key in archive.changed_keys:
+                pickle.dump((key, archive[key]), journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        archive.changed_keys.clear()
+
+    def compact(self, archive):
+        # the archive is stored as plain dict, so it can still be read without this module
+        atomic_pickle_dump(dict(archive), self.archive_path)
+        remove_file(self.path)
+        archive.changed_keys.clear()
+
+    def clear(self):
+        remove_file(self.path)
@@ -0,0 +1,110 @@
+import time
+import numpy as np
+from tqdm import tqdm
+
+from src import constants
+
+""" Occurrence prioritized crawl scheduler
+
+Shared by the spotify, discogs and wikipedia crawlers. The pending rows of a crawler are looked up in the order of their
+occurrences (most frequent first), the scheduler keeps track of the share of all occurrences which is resolved and stops
+handing out rows as soon as one of the budgets is reached:
+    coverage_target...  share of all occurrences which is resolved (e.g. 0.99)
+    max_seconds...      wall-clock time since the scheduler was created
+    max_requests...     number of requests sent by the crawler, counted by the crawlers with count_request() for every
+                        request they send (including retries)
+The crawler then leaves its loop and saves as usual, all rows which were not looked up stay pending for the next run.
+The long tail of rows with a single occurrence is where most requests are spent, but barely moves the results.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+COVERAGE_TARGET = constants.CRAWL_COVERAGE_TARGET
+MAX_SECONDS = constants.CRAWL_MAX_SECONDS
+MAX_REQUESTS = constants.CRAWL_MAX_REQUESTS
+REPORT_EVERY_S = constants.CRAWL_REPORT_EVERY_S
+
+
+class CrawlScheduler:
+    def __init__(self, occurrences, resolved_mask, name, coverage_target=COVERAGE_TARGET, max_seconds=MAX_SECONDS,
+                 max_requests=MAX_REQUESTS):
+        # occurrences and resolved_mask are given for all rows, rows resolved in a previous run count for the coverage
+        self.occurrences = np.nan_to_num(np.asarray(occurrences, dtype=np.float64))
+        self.resolved = np.asarray(resolved_mask, dtype=bool).copy()
+        self.name = name
+        self.coverage_target = coverage_target
+        self.max_seconds = max_seconds
+        self.max_requests = max_requests
+
+        self.total_occurrences = self.occurrences.sum()
+        self.resolved_occurrences = self.occurrences[self.resolved].sum()
+        self.request_count = 0
+        self.started_at = time.monotonic()
+        self.reported_at = self.started_at
+        self.stop_reason = None
+
+    def get_coverage(self):
+        return self.resolved_occurrences / self.total_occurrences if self.total_occurrences > 0 else 1.0
+
+    def get_priority_order(self, pending_mask):
+        # positions of all pending rows, most occurrences first (stable, equal rows keep the order of the input)
+        positions = np.flatnonzero(np.asarray(pending_mask, dtype=bool))
+        return positions[np.argsort(-self.occurrences[positions], kind='stable')]
+
+    def resolve(self, position):
+        if not self.resolved[position]:
+            self.resolved[position] = True
+            self.resolved_occurrences += self.occurrences[position]
+        self.report()
+
+    def count_request(self, n=1):
+        self.request_count += n
+
+    def is_exhausted(self):
+        if self.stop_reason is None:
+            elapsed = time.monotonic() - self.started_at
+            if self.coverage_target is not None and self.get_coverage() >= self.coverage_target:
+                self.stop_reason = f'coverage target of {self.coverage_target:.2%} reached'
+            elif self.max_seconds is not None and elapsed >= self.max_seconds:
+                self.stop_reason = f'time budget of {self.max_seconds}s used up'
+            elif self.max_requests is not None and self.request_count >= self.max_requests:
+                self.stop_reason = f'request budget of {self.max_requests} requests used up'
+            else:
+                return False
+            print('Stop', self.name, 'crawler:', self.stop_reason, '- the remaining rows are looked up in the next run')
+            self.report(force=True)
+        return True
+
+    def positions(self, pending_mask):
+        # generator over the pending positions, one lookup (position) at a time until a budget is reached
+        priority_order = self.get_priority_order(pending_mask)
+        for position in tqdm(priority_order, total=len(priority_order)):
+            if self.is_exhausted():
+                return
+            yield position
+
+    def bulks(self, keys, pending_mask, bulk_size):
+        # generator over bulks (dicts of <key, position>) of pending rows
+        bulk = {}
+        for position in self.positions(pending_mask):
+            bulk[keys[position]] = position
+            if len(bulk) == bulk_size:
+                yield bulk
+                bulk = {}
+        if len(bulk) > 0 and not self.is_exhausted():
+            yield bulk
+
+    def limit(self, bulks):
+        # passes on given bulks (e.g. of a final pass) until a budget is reached
+        for bulk in bulks:
+            if self.is_exhausted():
+                return
+            yield bulk
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if force or now - self.reported_at >= REPORT_EVERY_S:
+            self.reported_at = now
+            print(f'{self.name}: {self.get_coverage():.2%} of {self.total_occurrences:,.0f} occurrences resolved, '
+                  f'{self.request_count:,} requests in {now - self.started_at:.0f}s')
@@ -0,0 +1,169 @@
+import sys
+import os
+import json
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from src import constants
+from src.utils.checkpoint_journal import atomic_write, remove_file
+
+""" Memory-mapped store of the LFM-2b listening events
+
+One-time conversion of listening-events.tsv (~2B rows) into fixed-width numpy arrays, one .npy file per column:
+    user_id...      int32
+    track_id...     int32
+    timestamp...    int64, seconds since epoch
+The events are sorted by user (stable, the events of a user keep the order of the tsv), user_offsets.npy holds the
+position of the first event of every user_id, the events of user u are [user_offsets[u], user_offsets[u + 1]). The
+arrays are opened with mmap_mode='r', analyses work on slices of them instead of parsing the tsv again.
+
+The conversion runs in bounded memory: the tsv is parsed once into unsorted raw files, the events per user are counted
+and the raw events are scattered chunk by chunk to their sorted positions (counting sort by user_id). info.json is
+written last and marks the store as complete.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+PATH_TO_LFM_LISTENING_EVENTS = constants.PATH_TO_LFM_LISTENING_EVENTS
+LISTENING_EVENT_STORE_PATH = constants.LISTENING_EVENT_STORE_PATH
+LISTENING_EVENTS_CHUNK_SIZE = constants.LISTENING_EVENTS_CHUNK_SIZE
+
+USER_ID = 'user_id'
+TRACK_ID = 'track_id'
+TIMESTAMP = 'timestamp'
+# dict: <column, dtype in the store>
+COLUMNS = {USER_ID: np.int32, TRACK_ID: np.int32, TIMESTAMP: np.int64}
+USER_OFFSETS = 'user_offsets'
+INFO_FILE = 'info.json'
+RAW_SUFFIX = '.raw'
+
+
+def convert(path=PATH_TO_LFM_LISTENING_EVENTS, store_path=LISTENING_EVENT_STORE_PATH, chunksize=LISTENING_EVENTS_CHUNK_SIZE):
+    print('Convert listening events at', path, 'to memory-mapped arrays at', store_path)
+    os.makedirs(store_path, exist_ok=True)
+    remove_file(os.path.join(store_path, INFO_FILE))
+
+    # parse the tsv once, the columns are appended to raw files and the events per user are counted
+    user_counts = np.zeros(0, dtype=np.int64)
+    raw_files = {column: open(get_path(column, store_path) + RAW_SUFFIX, 'wb') for column in COLUMNS.keys()}
+    try:
+        for chunk in tqdm(pd.read_csv(path, sep='\t', usecols=list(COLUMNS.keys()), chunksize=chunksize)):
+            for column, values in get_chunk_columns(chunk).items():
+                values.tofile(raw_files[column])
+            chunk_counts = np.bincount(chunk[USER_ID].values)
+            if len(chunk_counts) > len(user_counts):
+                user_counts = np.concatenate([user_counts, np.zeros(len(chunk_counts) - len(user_counts), dtype=np.int64)])
+            user_counts[:len(chunk_counts)] += chunk_counts
+    finally:
+        for raw_file in raw_files.values():
+            raw_file.close()
+
+    user_offsets = np.zeros(len(user_counts) + 1, dtype=np.int64)
+    np.cumsum(user_counts, out=user_offsets[1:])
+    event_count = int(user_offsets[-1])
+    if DEBUG: print('Sort', event_count, 'listening events of', np.count_nonzero(user_counts), 'users')
+
+    # scatter the raw events to their sorted positions
+    raw_arrays = {column: np.memmap(get_path(column, store_path) + RAW_SUFFIX, dtype=dtype, mode='r', shape=(event_count,))
+                  for column, dtype in COLUMNS.items()}
+    arrays = {column: np.lib.format.open_memmap(get_path(column, store_path), mode='w+', dtype=dtype, shape=(event_count,))
+              for column, dtype in COLUMNS.items()}
+    next_positions = user_offsets[:-1].copy()
+    for start in tqdm(range(0, event_count, chunksize)):
+        users = np.asarray(raw_arrays[USER_ID][start:start + chunksize])
+        order = np.argsort(users, kind='stable')
+        sorted_users = users[order]
+        # rank of an event among the events of its user in this chunk
+        group_starts = np.flatnonzero(np.r_[True, sorted_users[1:] != sorted_users[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, len(sorted_users)])
+        ranks = np.arange(len(sorted_users)) - np.repeat(group_starts, group_sizes)
+        positions = next_positions[sorted_users] + ranks
+        next_positions[sorted_users[group_starts]] += group_sizes
+        for column in COLUMNS.keys():
+            arrays[column][positions] = np.asarray(raw_arrays[column][start:start + chunksize])[order]
+
+    for column in COLUMNS.keys():
+        arrays[column].flush()
+        del raw_arrays[column]
+        remove_file(get_path(column, store_path) + RAW_SUFFIX)
+    del arrays
+    np.save(get_path(USER_OFFSETS, store_path), user_offsets)
+
+    info = {'source': path, 'events': event_count, 'users': int(np.count_nonzero(user_counts))}
+    atomic_write(os.path.join(store_path, INFO_FILE), lambda write_file: json.dump(info, write_file))
+    print('Saved', event_count, 'listening events to', store_path)
+
+
+def get_chunk_columns(chunk):
+    # columns of a chunk of the tsv in the dtypes of the store
+    return {
+        USER_ID: chunk[USER_ID].values.astype(np.int32),
+        TRACK_ID: chunk[TRACK_ID].values.astype(np.int32),
+        TIMESTAMP: pd.to_datetime(chunk[TIMESTAMP]).values.astype('datetime64[s]').astype(np.int64)
+    }
+
+
+def get_path(column, store_path=LISTENING_EVENT_STORE_PATH):
+    return os.path.join(store_path, column + '.npy')
+
+
+def exists(store_path=LISTENING_EVENT_STORE_PATH):
+    return os.path.exists(os.path.join(store_path, INFO_FILE))
+
+
+class ListeningEventStore:
+    def __init__(self, store_path=LISTENING_EVENT_STORE_PATH):
+        self.store_path = store_path
+        self.user_ids = np.load(get_path(USER_ID, store_path), mmap_mode='r')
+        self.track_ids = np.load(get_path(TRACK_ID, store_path), mmap_mode='r')
+        self.timestamps = np.load(get_path(TIMESTAMP, store_path), mmap_mode='r')
+        self.user_offsets = np.load(get_path(USER_OFFSETS, store_path))
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def get_user_events(self, user_id):
+        # (track_ids, timestamps) of one user
+        start, end = self.user_offsets[user_id], self.user_offsets[user_id + 1]
+        return self.track_ids[start:end], self.timestamps[start:end]
+
+    def get_chunk_bounds(self, chunk_events=LISTENING_EVENTS_CHUNK_SIZE):
+        # (start, end) of chunks with about chunk_events events, all events of a user are in the same chunk
+        bounds = []
+        start = 0
+        while start < len(self):
+            end = min(start + chunk_events, len(self))
+            if end < len(self):
+                # move the end to the first event of the next user
+                end = int(self.user_offsets[np.searchsorted(self.user_offsets, end, side='left')])
+            bounds.append((start, end))
+            start = end
+        return bounds
+
+    def iter_chunks(self, columns=(USER_ID, TRACK_ID), chunk_events=LISTENING_EVENTS_CHUNK_SIZE):
+        # DataFrames with the given columns, like the chunks of the tsv but without splitting users
+        arrays = {USER_ID: self.user_ids, TRACK_ID: self.track_ids, TIMESTAMP: self.timestamps}
+        for start, end in self.get_chunk_bounds(chunk_events):
+            yield pd.DataFrame({column: np.asarray(arrays[column][start:end]) for column in columns})
+
+
+def open_store(store_path=LISTENING_EVENT_STORE_PATH):
+    if not exists(store_path):
+        if DEBUG: print('No listening event store at', store_path)
+        return None
+    return ListeningEventStore(store_path)
+
+
+def main():
+    convert()
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt')
+        sys.exit(-1)
@@ -1,9 +1,9 @@
 import pandas as pd
-import pickle
 
 from src import constants
 from src.preprocessing_spotify import spotify_record_label_crawler as scm
 from src.label_crawler.discogs_label_crawler import DiscogsEntry
+from src.utils import archive_store
 
 pd.set_option('display.width', 1000)
 pd.set_option('display.max_columns', 8)
@@ -19,10 +19,9 @@ LABEL_MAP = pd.read_csv(LABEL_MAP)
 album_uri_map = pd.read_csv(ALBUM_URIS_WITH_LABEL_LOW)
 df = album_uri_map.merge(LABEL_MAP, on=[RECORD_LABEL_LOW], how='left')
 
-with open(ARCHIVE_LOOKUP_PATH, 'rb+') as read_file:
-    discogs_archive = pickle.load(read_file)
-with open(ARCHIVE_DISCOGS_ID_MAP_PATH, 'rb+') as read_file:
-    discogs_id_archive = pickle.load(read_file)
+discogs_archive = archive_store.open_archive(ARCHIVE_LOOKUP_PATH, archive_store.encode_record,
+                                             archive_store.get_record_decoder(DiscogsEntry))
+discogs_id_archive = archive_store.open_archive(ARCHIVE_DISCOGS_ID_MAP_PATH)
 
 print('Lookup utils')
 mode = ''
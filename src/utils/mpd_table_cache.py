@@ -0,0 +1,167 @@
+import sys
+import os
+import json
+import time
+from functools import partial
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from src import constants
+from src.utils.checkpoint_journal import atomic_write
+from src.utils import slice_source
+
+""" Columnar cache of the Million Playlist Dataset
+
+One-time conversion of the MPD json slices into two partitioned parquet tables (one file per slice):
+    tracks...       pid, pos, track_uri, album_uri, artist_uri, track_name, artist_name, album_name, duration_ms
+    playlists...    all fields of a playlist except its tracks (pid, name, description, num_tracks, ...)
+The names are dictionary encoded. The 'info' blocks of all slices are stored in info.json, which is written last and
+marks the cache as complete. Scripts which iterate over the slices (input list, output, analysis, reranker) read only
+the columns they need from the cache if it exists, instead of parsing ~33 GB of json. read_slice() restores a slice
+in its json structure for scripts which need all fields.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+MPD_SLICE_SOURCE = constants.MPD_SLICE_SOURCE
+MPD_TABLE_CACHE_PATH = constants.MPD_TABLE_CACHE_PATH
+INPUT_PROCESSES = constants.INPUT_PROCESSES
+
+TRACKS = 'tracks'
+PLAYLISTS = 'playlists'
+INFO_FILE = 'info.json'
+NAME_COLUMNS = ['track_name', 'artist_name', 'album_name']
+# order of the playlist keys in the slices, stored in the schema metadata of the playlist table
+PLAYLIST_KEYS = b'playlist_keys'
+
+
+def build_cache(path_to_slices=MPD_SLICE_SOURCE, cache_path=MPD_TABLE_CACHE_PATH, processes=INPUT_PROCESSES):
+    print('Convert MPD slices at', path_to_slices, 'to parquet tables at', cache_path)
+    start = time.time()
+    for table in [TRACKS, PLAYLISTS]:
+        os.makedirs(os.path.join(cache_path, table), exist_ok=True)
+    remove_info(cache_path)
+
+    # every worker converts its slices and writes their tables, only the info blocks are returned
+    infos = {}
+    source = slice_source.open_source(path_to_slices)
+    for slice_infos in tqdm(slice_source.map_slices(partial(convert_slices, cache_path=cache_path), source,
+                                                    processes=processes)):
+        infos.update(slice_infos)
+
+    atomic_write(os.path.join(cache_path, INFO_FILE), lambda write_file: json.dump(infos, write_file))
+    end = time.time()
+    print('Converted', len(infos), 'slices', f'({(end - start) / 60:.2}m)')
+
+
+def convert_slices(slices, cache_path=MPD_TABLE_CACHE_PATH):
+    return dict(convert_slice(filename, mpd_slice, cache_path) for filename, mpd_slice in slices)
+
+
+def convert_slice(filename, mpd_slice, cache_path=MPD_TABLE_CACHE_PATH):
+    playlist_rows = []
+    track_rows = []
+    playlist_keys = []
+    for playlist in mpd_slice['playlists']:
+        for key in playlist.keys():
+            if key not in playlist_keys:
+                playlist_keys.append(key)
+        playlist_rows.append(playlist)
+        for track in playlist['tracks']:
+            track_rows.append(dict(track, pid=playlist['pid']))
+
+    track_table = create_table(track_rows, ['pid'])
+    for column in NAME_COLUMNS:
+        if column in track_table.column_names:
+            track_table = track_table.set_column(track_table.column_names.index(column), column,
+                                                 track_table[column].dictionary_encode())
+    playlist_table = create_table(playlist_rows, exclude=[TRACKS])
+    playlist_table = playlist_table.replace_schema_metadata({PLAYLIST_KEYS: json.dumps(playlist_keys)})
+
+    slice_name = filename[:-len('.json')]
+    pq.write_table(track_table, get_table_path(TRACKS, slice_name, cache_path))
+    pq.write_table(playlist_table, get_table_path(PLAYLISTS, slice_name, cache_path))
+    return slice_name, mpd_slice['info']
+
+
+def create_table(rows, first_columns=(), exclude=()):
+    # columns in order of their first appearance, values which are missing in a row are null
+    columns = list(first_columns)
+    for row in rows:
+        for key in row.keys():
+            if key not in columns and key not in exclude:
+                columns.append(key)
+    return pa.Table.from_pydict({column: [row.get(column) for row in rows] for column in columns})
+
+
+def get_table_path(table, slice_name, cache_path=MPD_TABLE_CACHE_PATH):
+    return os.path.join(cache_path, table, slice_name + '.parquet')
+
+
+def remove_info(cache_path):
+    try:
+        os.remove(os.path.join(cache_path, INFO_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def exists(cache_path=MPD_TABLE_CACHE_PATH):
+    return os.path.exists(os.path.join(cache_path, INFO_FILE))
+
+
+def get_slice_infos(cache_path=MPD_TABLE_CACHE_PATH):
+    with open(os.path.join(cache_path, INFO_FILE), 'r') as read_file:
+        return json.load(read_file)
+
+
+def get_slice_names(cache_path=MPD_TABLE_CACHE_PATH):
+    return sorted(get_slice_infos(cache_path).keys())
+
+
+def read_table(table, columns=None, slice_names=None, cache_path=MPD_TABLE_CACHE_PATH):
+    # table: TRACKS or PLAYLISTS, only the given columns of the given slices (default: all) are read
+    slice_names = slice_names if slice_names is not None else get_slice_names(cache_path)
+    if DEBUG: print('Read', columns, 'of', len(slice_names), 'slices from', os.path.join(cache_path, table))
+    paths = [get_table_path(table, slice_name, cache_path) for slice_name in slice_names]
+    # fields which only exist in some slices (e.g. description) are null in the others
+    schema = pa.unify_schemas([pq.read_schema(path) for path in paths])
+    return ds.dataset(paths, schema=schema, format='parquet').to_table(columns=columns).to_pandas()
+
+
+def read_tracks(columns=None, slice_names=None, cache_path=MPD_TABLE_CACHE_PATH):
+    return read_table(TRACKS, columns, slice_names, cache_path)
+
+
+def read_playlists(columns=None, slice_names=None, cache_path=MPD_TABLE_CACHE_PATH):
+    return read_table(PLAYLISTS, columns, slice_names, cache_path)
+
+
+def read_slice(slice_name, cache_path=MPD_TABLE_CACHE_PATH):
+    # restores a slice in the structure of the json file, fields which are missing in a playlist are left out
+    playlist_table = pq.read_table(get_table_path(PLAYLISTS, slice_name, cache_path))
+    playlist_keys = json.loads(playlist_table.schema.metadata[PLAYLIST_KEYS])
+    tracks_per_playlist = {}
+    for track in pq.read_table(get_table_path(TRACKS, slice_name, cache_path)).to_pylist():
+        tracks_per_playlist.setdefault(track.pop('pid'), []).append(track)
+
+    playlists = []
+    for row in playlist_table.to_pylist():
+        row[TRACKS] = tracks_per_playlist.get(row['pid'], [])
+        playlists.append({key: row[key] for key in playlist_keys if row.get(key) is not None})
+    return {'info': get_slice_infos(cache_path)[slice_name], 'playlists': playlists}
+
+
+def main():
+    build_cache()
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt')
+        sys.exit(-1)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+""" Result buffer for crawler loops
+
+Collects the results of a crawler loop per column in dicts of <row position, value> instead of writing every single
+cell into the DataFrame with .loc. The buffered values are assigned to the DataFrame in one vectorized step per column
+when flush() is called, which happens at every checkpoint and at the end of a loop. If a journal is given (see
+checkpoint_journal.RowJournal), the flushed rows are appended to it before they are assigned.
+"""
+
+
+class ResultBuffer:
+    def __init__(self, df, columns, journal=None):
+        self.df = df
+        self.columns = list(columns)
+        self.journal = journal
+        self.values = {column: {} for column in self.columns}
+
+        # result columns which are not part of the input (e.g. artist_name for LFM-2b) are created empty
+        for column in self.columns:
+            if column not in self.df.columns:
+                self.df[column] = np.nan
+
+    def set(self, position, column, value):
+        self.values[column][position] = value
+
+    def set_row(self, position, values):
+        for column, value in zip(self.columns, values):
+            self.values[column][position] = value
+
+    def get(self, position, column):
+        if position in self.values[column]:
+            return self.values[column][position]
+        return self.df.iat[position, self.df.columns.get_loc(column)]
+
+    def __len__(self):
+        return max(len(values) for values in self.values.values())
+
+    def flush(self):
+        if self.journal is not None:
+            rows = {}
+            for column, values in self.values.items():
+                for position, value in values.items():
+                    rows.setdefault(position, {})[column] = value
+            if len(rows) > 0:
+                self.journal.append(self.df, rows)
+
+        for column, values in self.values.items():
+            if len(values) == 0:
+                continue
+            positions = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+            # let pandas infer the dtype of the new values, so numeric results stay numeric columns
+            self.df.iloc[positions, self.df.columns.get_loc(column)] = pd.Series(list(values.values())).values
+            values.clear()
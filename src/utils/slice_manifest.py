@@ -0,0 +1,106 @@
+import os
+import pickle
+
+from src import constants
+from src.utils.checkpoint_journal import atomic_pickle_dump, remove_file
+
+""" Manifest of parsed MPD slices
+
+Records for every slice which was parsed its stat (size, mtime), its hash (see utils/slice_source.py) and a pickle of its
+partial aggregate, next to the aggregate over all recorded slices. On a rerun only slices which are new or changed are
+parsed again:
+    - a slice with the same size and mtime is unchanged
+    - a slice with another size or mtime but the same hash was only touched (e.g. copied), its stat is updated
+    - the partial aggregates of changed and removed slices are taken out of the aggregate, the ones of the parsed
+      slices are added
+    - slices which are still in the source but not part of a run (playlist_max) are excluded: they are kept in the
+      manifest and only left out of the aggregate of that run
+The manifest is written with os.replace() after all partial aggregates of a run are written, partial files of a killed
+run which are not referenced by the manifest are removed on the next save.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+MPD_SLICE_MANIFEST_PATH = constants.MPD_SLICE_MANIFEST_PATH
+
+MANIFEST_FILE = 'manifest.pkl'
+PARTIALS = 'partials'
+
+
+class SliceManifest:
+    def __init__(self, manifest_path=MPD_SLICE_MANIFEST_PATH):
+        self.manifest_path = manifest_path
+        # dict: <slice file name, dict with the stat, hash and partial file of the slice>
+        self.entries = {}
+        # aggregate over the partial aggregates of all entries, None if nothing was recorded yet
+        self.aggregate = None
+        # increased with every save, part of the names of the partial files written in a run
+        self.generation = 0
+        self.modified = False
+
+        path = os.path.join(manifest_path, MANIFEST_FILE)
+        if os.path.exists(path):
+            with open(path, 'rb') as read_file:
+                state = pickle.load(read_file)
+            self.entries = state['entries']
+            self.aggregate = state['aggregate']
+            self.generation = state['generation']
+            if DEBUG: print('Loaded manifest of', len(self.entries), 'slices from', path)
+
+    def get_changes(self, source, slice_names=None):
+        # returns the slices which have to be parsed (new or changed), the recorded slices which are not in the source
+        # anymore and the recorded slices which are in the source but not in slice_names
+        stats = source.get_slice_stats()
+        slice_names = slice_names if slice_names is not None else sorted(stats.keys())
+
+        changed = []
+        self.new_entries = {}
+        for filename in slice_names:
+            entry = self.entries.get(filename)
+            if entry is not None and entry['stat'] == stats[filename]:
+                continue
+            slice_hash = source.get_slice_hash(filename)
+            if entry is not None and slice_hash is not None and entry['hash'] == slice_hash:
+                entry['stat'] = stats[filename]
+                self.modified = True
+                continue
+            changed.append(filename)
+            self.new_entries[filename] = {'stat': stats[filename], 'hash': slice_hash}
+
+        given_names = set(slice_names)
+        removed = [filename for filename in self.entries.keys() if filename not in stats]
+        excluded = [filename for filename in self.entries.keys() if filename in stats and filename not in given_names]
+        return changed, removed, excluded
+
+    def load_partial(self, filename):
+        with open(os.path.join(self.manifest_path, PARTIALS, self.entries[filename]['partial']), 'rb') as read_file:
+            return pickle.load(read_file)
+
+    def put(self, filename, partial):
+        # filename has to be one of the changed slices of get_changes()
+        partial_file = filename[:-len('.json')] + '.' + str(self.generation + 1) + '.pkl'
+        os.makedirs(os.path.join(self.manifest_path, PARTIALS), exist_ok=True)
+        atomic_pickle_dump(partial, os.path.join(self.manifest_path, PARTIALS, partial_file))
+        self.entries[filename] = dict(self.new_entries.pop(filename), partial=partial_file)
+        self.modified = True
+
+    def remove(self, filename):
+        del self.entries[filename]
+        self.modified = True
+
+    def save(self, aggregate):
+        self.generation += 1
+        self.aggregate = aggregate
+        os.makedirs(self.manifest_path, exist_ok=True)
+        atomic_pickle_dump({'entries': self.entries, 'aggregate': aggregate, 'generation': self.generation},
+                           os.path.join(self.manifest_path, MANIFEST_FILE))
+        self.modified = False
+
+        # partial files of changed and removed slices (and of killed runs)
+        referenced_files = set(entry['partial'] for entry in self.entries.values())
+        partials_path = os.path.join(self.manifest_path, PARTIALS)
+        for partial_file in os.listdir(partials_path) if os.path.exists(partials_path) else []:
+            if partial_file not in referenced_files:
+                remove_file(os.path.join(partials_path, partial_file))
+        if DEBUG: print('Saved manifest of', len(self.entries), 'slices to', self.manifest_path)
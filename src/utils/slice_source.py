@@ -0,0 +1,228 @@
+import os
+import json
+import tarfile
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from src import constants
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+""" Sources of MPD slices
+
+The MPD slices can be read from
+    - a directory of extracted json slices (e.g. constants.PATH_TO_SLICES_ORIGINAL)
+    - the distribution zip (spotify_million_playlist_dataset.zip), the slices are read from the members without
+      extracting them
+    - a .tar.zst archive (requires the optional package zstandard)
+open_source(path) returns the matching source, all of them list, load and iterate the slices the same way. Slices are
+identified by their file name (e.g. 'mpd.slice.0-999.json'), also if they are in a subfolder of an archive.
+
+map_slices() runs a function over tasks of slices in worker processes. For a directory or a zip every worker reads and
+decompresses its own slices. A .tar.zst archive is one compressed stream without random access, it is decompressed
+in the main process and only the parsing of the slices is done by the workers.
+
+get_slice_stats() and get_slice_hash() are used to detect changed slices (see utils/slice_manifest.py). The hash is the
+crc32 of the slice, which a zip already stores for its members, so it's the same for a slice in a directory and in a
+zip. The members of a .tar.zst have no hash without decompressing them, only their size and mtime are compared.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+MPD_SLICE_SOURCE = constants.MPD_SLICE_SOURCE
+INPUT_PROCESSES = constants.INPUT_PROCESSES
+
+# number of tasks per worker process which are submitted at once, limits the slices held in memory
+TASKS_IN_FLIGHT_PER_PROCESS = 2
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def is_slice(filename):
+    return filename.startswith('mpd.slice') and filename.endswith('.json')
+
+
+class DirectorySliceSource:
+    random_access = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_slice_names(self):
+        return sorted(filename for filename in os.listdir(self.path) if is_slice(filename))
+
+    def get_slice_stats(self):
+        # dict: <slice file name, (size, mtime)>
+        stats = {}
+        for filename in self.get_slice_names():
+            stat = os.stat(os.path.join(self.path, filename))
+            stats[filename] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    def get_slice_hash(self, filename):
+        crc = 0
+        with open(os.path.join(self.path, filename), 'rb') as read_file:
+            for chunk in iter(lambda: read_file.read(HASH_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+        return crc
+
+    def read_slice(self, filename):
+        with open(os.path.join(self.path, filename), 'rb') as read_file:
+            return read_file.read()
+
+    def load_slice(self, filename):
+        with open(os.path.join(self.path, filename), 'r') as read_file:
+            return json.load(read_file)
+
+    def iter_raw_slices(self, slice_names=None):
+        for filename in slice_names if slice_names is not None else self.get_slice_names():
+            yield filename, self.read_slice(filename)
+
+    def iter_slices(self, slice_names=None):
+        for filename in slice_names if slice_names is not None else self.get_slice_names():
+            yield filename, self.load_slice(filename)
+
+
+class ZipSliceSource(DirectorySliceSource):
+    random_access = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        # every process opens the zip on its own (see __getstate__)
+        self.zip_file = None
+        with zipfile.ZipFile(path) as zip_file:
+            # dict: <slice file name, member info in the zip>
+            self.members = {os.path.basename(info.filename): info for info in zip_file.infolist()
+                            if is_slice(os.path.basename(info.filename))}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['zip_file'] = None
+        return state
+
+    def get_slice_names(self):
+        return sorted(self.members.keys())
+
+    def get_slice_stats(self):
+        return {filename: (info.file_size, info.date_time) for filename, info in self.members.items()}
+
+    def get_slice_hash(self, filename):
+        return self.members[filename].CRC
+
+    def read_slice(self, filename):
+        if self.zip_file is None:
+            self.zip_file = zipfile.ZipFile(self.path)
+        return self.zip_file.read(self.members[filename])
+
+    def load_slice(self, filename):
+        return json.loads(self.read_slice(filename))
+
+
+class TarZstSliceSource:
+    random_access = False
+
+    def __init__(self, path):
+        if zstandard is None:
+            raise ImportError('Reading ' + path + ' requires the package zstandard (pip install zstandard)')
+        self.path = path
+
+    def get_slice_names(self):
+        # the whole archive has to be decompressed to list its members
+        return [filename for filename, _ in self.iter_members(read=False)]
+
+    def get_slice_stats(self):
+        return {filename: (member.size, member.mtime) for filename, member in self.iter_members(read=False)}
+
+    def get_slice_hash(self, filename):
+        return None
+
+    def iter_members(self, slice_names=None, read=True):
+        remaining_names = set(slice_names) if slice_names is not None else None
+        with open(self.path, 'rb') as archive_file:
+            with zstandard.ZstdDecompressor().stream_reader(archive_file) as reader:
+                with tarfile.open(fileobj=reader, mode='r|') as tar:
+                    for member in tar:
+                        filename = os.path.basename(member.name)
+                        if not member.isfile() or not is_slice(filename):
+                            continue
+                        if remaining_names is not None:
+                            if filename not in remaining_names:
+                                continue
+                            remaining_names.remove(filename)
+                        # read=False: only the member info is returned
+                        yield filename, tar.extractfile(member).read() if read else member
+                        if remaining_names is not None and len(remaining_names) == 0:
+                            return
+
+    def iter_raw_slices(self, slice_names=None):
+        # slices are returned in the order of the archive
+        return self.iter_members(slice_names)
+
+    def iter_slices(self, slice_names=None):
+        for filename, raw_slice in self.iter_members(slice_names):
+            yield filename, json.loads(raw_slice)
+
+
+def open_source(path=MPD_SLICE_SOURCE):
+    if os.path.isdir(path):
+        return DirectorySliceSource(path)
+    if path.endswith('.zip'):
+        return ZipSliceSource(path)
+    if path.endswith('.tar.zst') or path.endswith('.tzst'):
+        return TarZstSliceSource(path)
+    raise ValueError('Unknown source of MPD slices: ' + path)
+
+
+def load_and_call(function, source, slice_names):
+    # runs in a worker process, which reads (and decompresses) the slices on its own
+    return function([(filename, source.load_slice(filename)) for filename in slice_names])
+
+
+def parse_and_call(function, raw_slices):
+    # runs in a worker process, the slices were read from the archive by the main process
+    return function([(filename, json.loads(raw_slice)) for filename, raw_slice in raw_slices])
+
+
+def create_tasks(items, slices_per_task):
+    task = []
+    for item in items:
+        task.append(item)
+        if len(task) == slices_per_task:
+            yield task
+            task = []
+    if len(task) > 0:
+        yield task
+
+
+'''
+Calls function(list of (slice file name, slice)) for tasks of slices_per_task slices each and yields the results in the
+order of the tasks. The function has to be defined on module level (it's sent to the worker processes), with
+processes=1 everything runs in the main process.
+'''
+def map_slices(function, source, slice_names=None, slices_per_task=1, processes=INPUT_PROCESSES):
+    processes = processes if processes is not None else os.cpu_count()
+    if processes <= 1:
+        for task in create_tasks(source.iter_slices(slice_names), slices_per_task):
+            yield function(task)
+        return
+
+    if source.random_access:
+        slice_names = slice_names if slice_names is not None else source.get_slice_names()
+        tasks = ((load_and_call, function, source, task) for task in create_tasks(slice_names, slices_per_task))
+    else:
+        tasks = ((parse_and_call, function, task) for task in create_tasks(source.iter_raw_slices(slice_names), slices_per_task))
+
+    # only a few tasks are submitted ahead, so a streamed archive is not read into memory as a whole
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = deque()
+        for task in tasks:
+            futures.append(executor.submit(*task))
+            if len(futures) >= processes * TASKS_IN_FLIGHT_PER_PROCESS:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
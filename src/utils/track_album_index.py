@@ -0,0 +1,116 @@
+import sys
+import os
+import sqlite3
+from tqdm import tqdm
+
+from src import constants
+from src.utils import mpd_table_cache
+from src.utils import slice_source
+
+""" Track to album index of the MPD
+
+The MPD slices contain the album_uri of every track. This index stores the <track_uri, album_uri> pairs of all slices
+once in a SQLite file, so the album of a track can be looked up without scanning the slices again:
+    - spotify_album_crawler resolves all tracks which are in the index without a spotify request (e.g. the LFM-2b
+      tracks which also appear in the MPD)
+    - the reranker of the recSys18 experiments looks up the albums of the submitted tracks
+The index is not tagged with the dataset. If a track appears with multiple albums, the first one is kept.
+"""
+
+# get constants
+DEBUG = constants.DEBUG
+
+MPD_SLICE_SOURCE = constants.MPD_SLICE_SOURCE
+TRACK_ALBUM_INDEX_PATH = constants.TRACK_ALBUM_INDEX_PATH
+
+TRACK_URI = constants.TRACK_URI
+ALBUM_URI = constants.ALBUM_URI
+
+# max. number of parameters in one sqlite query
+SQLITE_MAX_VARIABLES = 900
+
+
+def build_index(path_to_slices=MPD_SLICE_SOURCE, index_path=TRACK_ALBUM_INDEX_PATH):
+    print('Build track to album index from MPD slices at', path_to_slices)
+    tmp_path = index_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    connection.execute('CREATE TABLE track_to_album (track_uri TEXT PRIMARY KEY, album_uri TEXT NOT NULL) WITHOUT ROWID')
+    for pairs in tqdm(generate_slice_pairs(path_to_slices)):
+        connection.executemany('INSERT OR IGNORE INTO track_to_album VALUES (?, ?)', pairs)
+        connection.commit()
+
+    track_count = connection.execute('SELECT COUNT(*) FROM track_to_album').fetchone()[0]
+    connection.close()
+    # the index is only replaced when it's complete
+    os.replace(tmp_path, index_path)
+    print('Saved index of', track_count, 'tracks to', index_path)
+
+
+def generate_slice_pairs(path_to_slices):
+    # <track_uri, album_uri> pairs of one slice after the other, from the parquet tables of the MPD if they exist
+    if path_to_slices == MPD_SLICE_SOURCE and mpd_table_cache.exists():
+        for slice_name in mpd_table_cache.get_slice_names():
+            track_df = mpd_table_cache.read_tracks([TRACK_URI, ALBUM_URI], slice_names=[slice_name])
+            track_df = track_df.drop_duplicates(TRACK_URI)
+            yield zip(track_df[TRACK_URI].values, track_df[ALBUM_URI].values)
+        return
+
+    source = slice_source.open_source(path_to_slices)
+    for pairs in slice_source.map_slices(get_slice_pairs, source):
+        yield pairs
+
+
+def get_slice_pairs(slices):
+    pairs = {}
+    for _, mpd_slice in slices:
+        for playlist in mpd_slice['playlists']:
+            for track in playlist['tracks']:
+                pairs.setdefault(track[TRACK_URI], track[ALBUM_URI])
+    return list(pairs.items())
+
+
+class TrackAlbumIndex:
+    def __init__(self, index_path=TRACK_ALBUM_INDEX_PATH):
+        self.index_path = index_path
+        # read only, a missing index is not created
+        self.connection = sqlite3.connect('file:' + index_path + '?mode=ro', uri=True)
+
+    def get_albums(self, track_uris):
+        # returns dict: <track_uri, album_uri> of all given tracks which are in the index
+        track_uris = list(track_uris)
+        albums = {}
+        for i in range(0, len(track_uris), SQLITE_MAX_VARIABLES):
+            track_uri_chunk = track_uris[i:i + SQLITE_MAX_VARIABLES]
+            albums.update(self.connection.execute(
+                'SELECT track_uri, album_uri FROM track_to_album WHERE track_uri IN ('
+                + ','.join('?' * len(track_uri_chunk)) + ')', track_uri_chunk))
+        return albums
+
+    def get_all(self):
+        return dict(self.connection.execute('SELECT track_uri, album_uri FROM track_to_album'))
+
+    def close(self):
+        self.connection.close()
+
+
+def open_index(index_path=TRACK_ALBUM_INDEX_PATH):
+    if not os.path.exists(index_path):
+        if DEBUG: print('No track to album index at', index_path)
+        return None
+    return TrackAlbumIndex(index_path)
+
+
+def main():
+    build_index()
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print('Keyboard Interrupt')
+        sys.exit(-1)
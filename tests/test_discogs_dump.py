@@ -0,0 +1,47 @@
+import os
+import pytest
+
+from src.label_crawler import discogs_dump
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'discogs_labels.xml')
+
+
+@pytest.fixture
+def dump(tmp_path):
+    db_path = str(tmp_path / 'discogs_labels.sqlite')
+    discogs_dump.ingest(FIXTURE_PATH, db_path)
+    dump = discogs_dump.open_dump(db_path)
+    yield dump
+    dump.close()
+
+
+def test_search_label_id_prefers_exact_name_without_number(dump):
+    assert dump.search_label_id('Planet E') == 1
+    assert dump.search_label_id('planet e') == 1
+    assert dump.search_label_id('Planet E (2)') == 2
+    assert dump.search_label_id('Antidote') == 3
+    assert dump.search_label_id('Unknown Label') is None
+
+
+def test_get_label(dump):
+    label = dump.get_label(1)
+    assert label.name == 'Planet E'
+    assert label.profile == 'Detroit label founded by Carl Craig.'
+    assert label.urls == ['http://www.planet-e.net']
+    assert label.parent_label is None
+
+    label = dump.get_label(4)
+    assert label.urls == ['https://www.columbiarecords.com', 'https://en.wikipedia.org/wiki/Columbia_Records']
+    assert (label.parent_label.id, label.parent_label.name) == (353657, 'Sony Music Entertainment')
+    assert dump.get_label(99) is None
+
+
+def test_get_sublabel_ids(dump):
+    assert dump.get_sublabel_ids(1) == [3]
+    assert dump.get_sublabel_ids(353657) == [4]
+    assert dump.get_sublabel_ids(4) == [6]
+    assert dump.get_sublabel_ids(3) == []
+
+
+def test_open_dump_without_ingested_file(tmp_path):
+    assert discogs_dump.open_dump(str(tmp_path / 'missing.sqlite')) is None
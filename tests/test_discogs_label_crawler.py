@@ -0,0 +1,168 @@
+import os
+import discogs_client
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from types import SimpleNamespace
+
+from src.utils import archive_store
+from src.utils.checkpoint_journal import RowJournal
+from src.label_crawler import discogs_dump
+from src.label_crawler import discogs_label_crawler
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'discogs_labels.xml')
+COLUMBIA_WIKI_PAGE = 'https://en.wikipedia.org/wiki/Columbia_Records'
+
+
+@pytest.fixture
+def offline_crawler(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'discogs_labels.sqlite')
+    discogs_dump.ingest(FIXTURE_PATH, db_path)
+    dump = discogs_dump.open_dump(db_path)
+    monkeypatch.setattr(discogs_label_crawler, 'DISCOGS_DUMP', dump)
+    monkeypatch.setattr(discogs_label_crawler, 'ARCHIVE_LOOKUP', {})
+    monkeypatch.setattr(discogs_label_crawler, 'ARCHIVE_ID_MAP', {})
+    yield discogs_label_crawler
+    dump.close()
+
+
+def test_offline_label_below_major(offline_crawler):
+    entry = offline_crawler.get_major_label_classification('Columbia')
+    assert entry.shortcut == offline_crawler.FINAL_SONY
+    assert entry.parent_label == offline_crawler.SONY_DISCOGS_ID
+    assert entry.wiki_page == COLUMBIA_WIKI_PAGE
+    assert offline_crawler.ARCHIVE_ID_MAP['Columbia'] == 4
+
+
+def test_offline_major_reached_through_parent(offline_crawler):
+    entry = offline_crawler.get_major_label_classification('Columbia Nashville')
+    assert entry.shortcut == offline_crawler.FINAL_SONY
+    assert entry.parent_label == 4
+    # the wiki page of the parent is taken if the label has none
+    assert entry.wiki_page == COLUMBIA_WIKI_PAGE
+    assert set(offline_crawler.ARCHIVE_LOOKUP.keys()) == {6, 4}
+
+
+def test_offline_label_without_parent(offline_crawler):
+    entry = offline_crawler.get_major_label_classification('Planet E')
+    assert entry.shortcut == offline_crawler.DISCOGS_NO_PAR_FLAG
+    assert entry.description == 'Detroit label founded by Carl Craig.'
+
+    entry = offline_crawler.get_major_label_classification('Antidote')
+    assert entry.shortcut == offline_crawler.DISCOGS_NO_PAR_FLAG
+    assert entry.parent_label == 1
+
+
+def test_offline_unknown_label(offline_crawler):
+    entry = offline_crawler.get_major_label_classification('Unknown Label')
+    assert entry.shortcut == offline_crawler.DISCOGS_NO_ID_FLAG
+    assert offline_crawler.ARCHIVE_ID_MAP['Unknown Label'] == offline_crawler.DISCOGS_NO_ID_FLAG
+
+
+class FakeSearchResult:
+    def __init__(self, label_ids):
+        self.label_ids = label_ids
+
+    def page(self, index):
+        return [SimpleNamespace(id=label_id) for label_id in self.label_ids]
+
+
+class FakeClient:
+    # answers label searches by name, searches for names in failing fail like a rate limited request
+    def __init__(self, label_ids, failing=()):
+        self.label_ids = label_ids
+        self.failing = set(failing)
+
+    def search(self, label_name, **kwargs):
+        if label_name in self.failing:
+            raise discogs_client.exceptions.HTTPError('Service Unavailable', 503)
+        return FakeSearchResult([self.label_ids[label_name]] if label_name in self.label_ids else [])
+
+
+@pytest.fixture
+def online_crawler(tmp_path, monkeypatch):
+    # crawler on a label map in tmp_path, the requests are answered by the tests
+    input_map = str(tmp_path / 'label_map_trivial.csv')
+    output_map_ext = str(tmp_path / 'label_map_discogs_ext.csv')
+    pd.DataFrame({
+        discogs_label_crawler.RECORD_LABEL_LOW: ['Columbia', 'Planet E'],
+        discogs_label_crawler.CLASS_TRIVIAL: [np.nan, np.nan],
+        'occurrences': [2, 1]
+    }).to_csv(input_map, index=False)
+
+    monkeypatch.setattr(discogs_label_crawler, 'INPUT_LABEL_MAP', input_map)
+    monkeypatch.setattr(discogs_label_crawler, 'OUTPUT_LABEL_MAP', str(tmp_path / 'label_map_discogs.csv'))
+    monkeypatch.setattr(discogs_label_crawler, 'OUTPUT_LABEL_MAP_EXT', output_map_ext)
+    monkeypatch.setattr(discogs_label_crawler, 'LABEL_MAP_JOURNAL',
+                        RowJournal(output_map_ext, discogs_label_crawler.RECORD_LABEL_LOW))
+    monkeypatch.setattr(discogs_label_crawler, 'ARCHIVE_LOOKUP', archive_store.ArchiveStore(
+        str(tmp_path / 'archive_lookup.sqlite'), archive_store.encode_record,
+        archive_store.get_record_decoder(discogs_label_crawler.DiscogsEntry)))
+    monkeypatch.setattr(discogs_label_crawler, 'ARCHIVE_ID_MAP',
+                        archive_store.ArchiveStore(str(tmp_path / 'archive_id_map.sqlite')))
+    monkeypatch.setattr(discogs_label_crawler, 'DISCOGS_DUMP', None)
+    monkeypatch.setattr(discogs_label_crawler, 'DISCOGS_MAX_IN_FLIGHT', 1)
+    return discogs_label_crawler
+
+
+def get_classification(crawler, label_name):
+    label_map = pd.read_csv(crawler.OUTPUT_LABEL_MAP_EXT)
+    return label_map.loc[label_map[crawler.RECORD_LABEL_LOW] == label_name, crawler.CLASS_DISCOGS].item()
+
+
+def test_failed_search_is_retried_in_next_run(online_crawler, monkeypatch):
+    # the page of the label is archived already, only the search is sent
+    online_crawler.ARCHIVE_LOOKUP[4] = online_crawler.DiscogsEntry(online_crawler.FINAL_SONY)
+    client = FakeClient({'Columbia': 4}, failing=['Columbia'])
+    monkeypatch.setattr(online_crawler, 'DISCOGS_CLIENT', client)
+
+    online_crawler.run_crawler(online_crawler.INPUT_LABEL_MAP)
+    assert get_classification(online_crawler, 'Columbia') == online_crawler.DISCOGS_FAIL_FLAG
+    assert get_classification(online_crawler, 'Planet E') == online_crawler.DISCOGS_NO_ID_FLAG
+    assert 'Columbia' not in online_crawler.ARCHIVE_ID_MAP
+
+    client.failing.clear()
+    online_crawler.run_crawler(online_crawler.OUTPUT_LABEL_MAP_EXT)
+    assert get_classification(online_crawler, 'Columbia') == online_crawler.FINAL_SONY
+    assert get_classification(online_crawler, 'Planet E') == online_crawler.DISCOGS_NO_ID_FLAG
+
+
+class FakeLabelApi:
+    # answers GET /labels/{id} with the json of the labels, all requests fail while failing is set
+    def __init__(self, payloads):
+        self.payloads = payloads
+        self.failing = True
+
+    def send(self, bucket, request, url, **kwargs):
+        label_id = int(url.rsplit('/', 1)[1])
+        response = requests.Response()
+        response.url = url
+        if self.failing:
+            response.status_code = 503
+        elif label_id in self.payloads:
+            response.status_code = 200
+            response._content = json.dumps(self.payloads[label_id]).encode()
+        else:
+            response.status_code = 404
+        return response
+
+
+def test_failed_label_request_is_retried_in_next_run(online_crawler, monkeypatch):
+    monkeypatch.setattr(online_crawler, 'DISCOGS_CLIENT', FakeClient({'Columbia': 4}))
+    api = FakeLabelApi({
+        4: {'id': 4, 'name': 'Columbia', 'urls': [COLUMBIA_WIKI_PAGE],
+            'parent_label': {'id': online_crawler.SONY_DISCOGS_ID, 'name': 'Sony Music Entertainment'}},
+        online_crawler.SONY_DISCOGS_ID: {'id': online_crawler.SONY_DISCOGS_ID, 'name': 'Sony Music Entertainment'}
+    })
+    monkeypatch.setattr(online_crawler.discogs_rate_limiter, 'send', api.send)
+
+    online_crawler.run_crawler(online_crawler.INPUT_LABEL_MAP)
+    assert get_classification(online_crawler, 'Columbia') == online_crawler.DISCOGS_FAIL_FLAG
+    assert 4 not in online_crawler.ARCHIVE_LOOKUP
+
+    api.failing = False
+    online_crawler.run_crawler(online_crawler.OUTPUT_LABEL_MAP_EXT)
+    assert get_classification(online_crawler, 'Columbia') == online_crawler.FINAL_SONY
+    assert online_crawler.ARCHIVE_LOOKUP[4].shortcut == online_crawler.FINAL_SONY
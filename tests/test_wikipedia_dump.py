@@ -0,0 +1,99 @@
+import os
+import pytest
+
+from src.label_crawler import wikipedia_dump
+from src.label_crawler import wikipedia_crawler
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'wikipedia_pages.xml')
+
+
+def open_fixture_dump(tmp_path, infobox_only=False):
+    db_path = str(tmp_path / 'wikipedia_pages.sqlite')
+    wikipedia_dump.ingest(FIXTURE_PATH, db_path, infobox_only)
+    return wikipedia_dump.open_dump(db_path)
+
+
+@pytest.fixture
+def dump(tmp_path):
+    dump = open_fixture_dump(tmp_path)
+    yield dump
+    dump.close()
+
+
+@pytest.fixture
+def offline_crawler(dump, monkeypatch):
+    monkeypatch.setattr(wikipedia_crawler, 'WIKIPEDIA_DUMP', dump)
+    monkeypatch.setattr(wikipedia_crawler, 'ARCHIVE_URL_MAP', {})
+    return wikipedia_crawler
+
+
+def test_ingest_keeps_main_namespace_pages_and_redirects(dump):
+    titles = [row[0] for row in dump.connection.execute('SELECT title FROM pages')]
+    assert 'Sony Music' in titles
+    assert 'SME' in titles
+    assert 'Wikipedia:About' not in titles
+
+
+def test_get_page_follows_redirects(dump):
+    assert dump.get_page('Sony Music').startswith('{{Infobox record label')
+    assert dump.get_page('SME') == dump.get_page('Sony Music')
+    assert dump.get_page('xl_Recordings') is None
+    assert dump.get_page('XL_Recordings') is not None
+    assert dump.get_page('Missing Page') is None
+
+
+def test_get_page_title(dump):
+    assert dump.get_page_title('SME') == 'Sony Music'
+    assert dump.get_page_title('Sony Music Entertainment') == 'Sony Music'
+    assert dump.get_page_title('columbia Records') == 'Columbia Records'
+    assert dump.get_page_title('Missing Page') is None
+
+
+def test_is_disambiguation(dump):
+    assert wikipedia_dump.is_disambiguation(dump.get_page('Columbia'))
+    assert not wikipedia_dump.is_disambiguation(dump.get_page('Columbia Records'))
+
+
+@pytest.mark.parametrize('label_name, first_result', [
+    ('Sony Music', 'Sony Music'),
+    ('SME', 'SME'),
+    ('XL Recordings', 'XL Recordings'),
+    ('Columbia Records', 'Columbia Records'),
+])
+def test_search_cleaned_label_names(dump, label_name, first_result):
+    assert dump.search(wikipedia_crawler.clean_label(label_name))[0] == first_result
+
+
+def test_search_without_matching_title(dump):
+    assert dump.search(wikipedia_crawler.clean_label('Nothing Here')) == []
+    assert dump.search('') == []
+
+
+def test_get_dump_url(offline_crawler):
+    assert offline_crawler.get_dump_url('SME', 'SME') == 'https://en.wikipedia.org/wiki/Sony_Music'
+    assert offline_crawler.ARCHIVE_URL_MAP['SME'] == 'https://en.wikipedia.org/wiki/Sony_Music'
+    assert offline_crawler.get_dump_url('Columbia', 'Columbia') == offline_crawler.WIKI_ERROR_FLAG_DISAMBIGUATION
+    assert offline_crawler.get_dump_url('Missing', 'Missing Page') == offline_crawler.WIKI_ERROR_FLAG_PAGE
+    assert 'Columbia' not in offline_crawler.ARCHIVE_URL_MAP
+
+
+def test_get_wikipedia_url_offline(offline_crawler):
+    assert offline_crawler.get_wikipedia_url('Sony Music') == 'https://en.wikipedia.org/wiki/Sony_Music'
+    assert offline_crawler.get_wikipedia_url('XL Recordings') == 'https://en.wikipedia.org/wiki/XL_Recordings'
+
+
+def test_infobox_only_keeps_disambiguation_pages(tmp_path, monkeypatch):
+    dump = open_fixture_dump(tmp_path, infobox_only=True)
+    try:
+        assert dump.get_page('Record label') is None
+        assert dump.get_page_title('SME') == 'Sony Music'
+        monkeypatch.setattr(wikipedia_crawler, 'WIKIPEDIA_DUMP', dump)
+        monkeypatch.setattr(wikipedia_crawler, 'ARCHIVE_URL_MAP', {})
+        flag = wikipedia_crawler.get_dump_url('Columbia', 'Columbia')
+        assert flag == wikipedia_crawler.WIKI_ERROR_FLAG_DISAMBIGUATION
+    finally:
+        dump.close()
+
+
+def test_open_dump_without_ingested_file(tmp_path):
+    assert wikipedia_dump.open_dump(str(tmp_path / 'missing.sqlite')) is None